@@ -17,6 +17,39 @@ app.config['TEMPLATES_AUTO_RELOAD'] = True
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///server/db.sqlite3'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['CLIENT_PATH'] = app.root_path + '/client/'
+# Number of datasources (and their approximate memory, in bytes) kept loaded at once
+app.config['DATASOURCE_CACHE_SIZE'] = int(os.environ.get('MINERVA_DATASOURCE_CACHE_SIZE', 4))
+app.config['DATASOURCE_CACHE_BYTES'] = int(os.environ.get('MINERVA_DATASOURCE_CACHE_BYTES', 16 * 1024 ** 3))
+# Cell centroid index used for lens queries: 'kd_tree', 'grid' or 'ball_tree'
+app.config['SPATIAL_INDEX_BACKEND'] = os.environ.get('MINERVA_SPATIAL_INDEX_BACKEND', 'kd_tree')
+# Bytes of gate masks cached per datasource, see /get_gating_cache_stats to tune
+app.config['GATING_CACHE_BYTES'] = int(os.environ.get('MINERVA_GATING_CACHE_BYTES', 256 * 1024 ** 2))
+# Build the whole-slide spatial correlation layer in worker processes after an import
+app.config['SPATIAL_CORR_AT_IMPORT'] = os.environ.get('MINERVA_SPATIAL_CORR_AT_IMPORT', '0').lower() in \
+    ('1', 'true', 'yes')
+# Trace the outlines of all cells of the segmentation in worker processes after an import
+app.config['CELL_OUTLINES_AT_IMPORT'] = os.environ.get('MINERVA_CELL_OUTLINES_AT_IMPORT', '0').lower() in \
+    ('1', 'true', 'yes')
+# Index the bounds, area and centroid of every label of the segmentation after an import
+app.config['LABEL_INDEX_AT_IMPORT'] = os.environ.get('MINERVA_LABEL_INDEX_AT_IMPORT', '0').lower() in \
+    ('1', 'true', 'yes')
+# Encoded image tiles kept in memory (bytes), optionally also on disk, and how long browsers may reuse them
+app.config['TILE_CACHE_BYTES'] = int(os.environ.get('MINERVA_TILE_CACHE_BYTES', 512 * 1024 ** 2))
+app.config['TILE_CACHE_DIRECTORY'] = os.environ.get('MINERVA_TILE_CACHE_DIRECTORY')
+app.config['TILE_CACHE_MAX_AGE'] = int(os.environ.get('MINERVA_TILE_CACHE_MAX_AGE', 3600))
+# Threads decoding the neighbours of requested tiles ahead of time (0 disables prefetching) and their queue size
+app.config['TILE_PREFETCH_WORKERS'] = int(os.environ.get('MINERVA_TILE_PREFETCH_WORKERS', 2))
+app.config['TILE_PREFETCH_QUEUE'] = int(os.environ.get('MINERVA_TILE_PREFETCH_QUEUE', 256))
+# 8 bit channel planes kept per datasource for the histogram similarity search (bytes)
+app.config['SIMILARITY_CACHE_BYTES'] = int(os.environ.get('MINERVA_SIMILARITY_CACHE_BYTES', 512 * 1024 ** 2))
+# Windowed histograms of the similarity search: 'fft' (disk window, low memory), 'integral' (square window,
+# fastest) or 'rank' (skimage, a float64 histogram per pixel)
+app.config['SIMILARITY_ENGINE'] = os.environ.get('MINERVA_SIMILARITY_ENGINE', 'fft')
+# Colour lookup tables (192 KB each for 16 bit channels) kept for server-side compositing
+app.config['COMPOSITE_TABLE_CACHE_SIZE'] = int(os.environ.get('MINERVA_COMPOSITE_TABLE_CACHE_SIZE', 128))
+# Image files written at import: 'tiff' reads channels from the given OME-TIFF and pyramids single-level masks as
+# BigTIFF, 'zarr' converts both to chunked multiscale zarr stores with one chunk per tile (can be chosen per upload)
+app.config['IMPORT_FORMAT'] = os.environ.get('MINERVA_IMPORT_FORMAT', 'tiff')
 
 # If you're running the pyinstaller version of the code, create a
 # new directory for the data (this will be at ~/ on mac)
@@ -1,4 +1,4 @@
-from minerva_analysis.server.models import data_model
+from minerva_analysis.server.models import data_model, similarity_cache
 import numpy as np
 import scipy.misc as sp
 import time
@@ -18,7 +18,8 @@ from skimage import measure
 import cv2
 
 
-from minerva_analysis import data_path
+from minerva_analysis import app, data_path
+from minerva_analysis.server.analytics import windowed_histograms
 
 def prepSlidingWindow():
     print('hi')
@@ -26,6 +27,7 @@ def prepSlidingWindow():
 
 def histogramComparison(x, y, datasource_name, r, channels, viewport, zoomlevel, sensibility):
     tic = time.perf_counter()
+    ds = data_model.get_datasource(datasource_name)
     print("histogram comparison..")
     print("load image sections")
 
@@ -35,8 +37,8 @@ def histogramComparison(x, y, datasource_name, r, channels, viewport, zoomlevel,
     png =[]
     roi = []
     for channel in channels:
-        png.append(loadPngSection(datasource_name, channel, min(zoomlevel+1, len(data_model.channels)-1), viewport))
-        roi.append(loadPngSection(datasource_name, channel, min(zoomlevel+1, len(data_model.channels)-1), np.array([x-r,y-r,x+r,y+r]).astype(int)))
+        png.append(loadQuantizedSection(datasource_name, channel, min(zoomlevel+1, len(ds.channels)-1), viewport))
+        roi.append(loadQuantizedSection(datasource_name, channel, min(zoomlevel+1, len(ds.channels)-1), np.array([x-r,y-r,x+r,y+r]).astype(int)))
 
 
     tac = time.perf_counter()
@@ -47,28 +49,10 @@ def histogramComparison(x, y, datasource_name, r, channels, viewport, zoomlevel,
     # cv2.imwrite('minerva_analysis/server/analytics/img/roi.png', roi)
 
     # calc image similarity map
-    print("calculate image similarity maps for each channel...")
-    i = 0
-    sim_map = []
-    combined_png = []
-    combined_roi = []
-    for channel in channels:
-        print("sim map for " + str(channel))
-        if (i == 0):
-            combined_png = png[i]
-            combined_roi = roi[i]
-        if (i > 0):
-            combined_png = np.add(combined_png, png[i])
-            combined_roi = np.add(combined_roi, roi[i])
-        i += 1
-    # cv2.imwrite('minerva_analysis/server/analytics/img/sim_map.jpg', sim_map)
-
-    # normalize by num channels considered
+    # mean of the 8 bit sections of the channels, see similarity_cache.combine
     print("combining whole channels, combine lens parts. Norm by num channels")
-    if (len(channels) > 1):
-        combined_png = np.floor_divide(combined_png, len(channels))
-        combined_roi = np.floor_divide(combined_roi, len(channels))
-
+    combined_png = similarity_cache.combine(png)
+    combined_roi = similarity_cache.combine(roi)
 
     print("compute similarity maps")
     combined_sim_map = calc_sim(combined_png, combined_roi)
@@ -80,11 +64,11 @@ def histogramComparison(x, y, datasource_name, r, channels, viewport, zoomlevel,
     # labels = find_labels(png, sim_map, sensibility)
 
     #get global contour positions
-    length = len(data_model.channels[0].shape);
-    layerviewport = getLayerViewport( data_model.channels[0].shape[length-2],
-                               data_model.channels[0].shape[length-1],
-                              data_model.channels[min(zoomlevel+1, len(data_model.channels)-1)].shape[length-2],
-                              data_model.channels[min(zoomlevel+1, len(data_model.channels)-1)].shape[length-1],
+    length = len(ds.channels[0].shape);
+    layerviewport = getLayerViewport( ds.channels[0].shape[length-2],
+                               ds.channels[0].shape[length-1],
+                              ds.channels[min(zoomlevel+1, len(ds.channels)-1)].shape[length-2],
+                              ds.channels[min(zoomlevel+1, len(ds.channels)-1)].shape[length-1],
                               viewport)
     contours = toWorldCoordinates(contours, viewport, layerviewport)
     toc = time.perf_counter()
@@ -94,6 +78,7 @@ def histogramComparison(x, y, datasource_name, r, channels, viewport, zoomlevel,
 
 def histogramComparisonSimMap(x, y, datasource_name, r, channels, viewport, zoomlevel, sensibility):
         tic = time.perf_counter()
+        ds = data_model.get_datasource(datasource_name)
         print("histogram comparison..")
         print("load image sections")
 
@@ -103,9 +88,9 @@ def histogramComparisonSimMap(x, y, datasource_name, r, channels, viewport, zoom
         png = []
         roi = []
         for channel in channels:
-            png.append(loadPngSection(datasource_name, channel, zoomlevel+1, viewport))
+            png.append(loadQuantizedSection(datasource_name, channel, min(zoomlevel+1, len(ds.channels)-1), viewport))
             roi.append(
-                loadPngSection(datasource_name, channel, min(zoomlevel+1, len(data_model.channels)-1), np.array([x - r, y - r, x + r, y + r]).astype(int)))
+                loadQuantizedSection(datasource_name, channel, min(zoomlevel+1, len(ds.channels)-1), np.array([x - r, y - r, x + r, y + r]).astype(int)))
 
         tac = time.perf_counter()
         print("cropped sections loaded after " + str(tac - tic))
@@ -115,27 +100,10 @@ def histogramComparisonSimMap(x, y, datasource_name, r, channels, viewport, zoom
         # cv2.imwrite('minerva_analysis/server/analytics/img/roi.png', roi)
 
         # calc image similarity map
-        print("calculate image similarity maps for each channel...")
-        i = 0
-        sim_map = []
-        combined_png = []
-        combined_roi = []
-        for channel in channels:
-            print("sim map for " + str(channel))
-            if (i == 0):
-                combined_png = png[i]
-                combined_roi = roi[i]
-            if (i > 0):
-                combined_png = np.add(combined_png, png[i])
-                combined_roi = np.add(combined_roi, roi[i])
-            i += 1
-        # cv2.imwrite('minerva_analysis/server/analytics/img/sim_map.jpg', sim_map)
-
-        # normalize by num channels considered
+        # mean of the 8 bit sections of the channels, see similarity_cache.combine
         print("combining whole channels, combine lens parts. Norm by num channels")
-        if (len(channels) > 1):
-            combined_png = np.floor_divide(combined_png, len(channels))
-            combined_roi = np.floor_divide(combined_roi, len(channels))
+        combined_png = similarity_cache.combine(png)
+        combined_roi = similarity_cache.combine(roi)
 
         print("compute similarity maps")
         combined_sim_map = calc_sim(combined_png, combined_roi)
@@ -146,11 +114,11 @@ def histogramComparisonSimMap(x, y, datasource_name, r, channels, viewport, zoom
 
 
         # get global contour positions
-        length = len(data_model.channels[0].shape);
-        layerviewport = getLayerViewport(data_model.channels[0].shape[length - 2],
-                                         data_model.channels[0].shape[length - 1],
-                                         data_model.channels[min(zoomlevel+1, len(data_model.channels)-1)].shape[length - 2],
-                                         data_model.channels[min(zoomlevel+1, len(data_model.channels)-1)].shape[length - 1],
+        length = len(ds.channels[0].shape);
+        layerviewport = getLayerViewport(ds.channels[0].shape[length - 2],
+                                         ds.channels[0].shape[length - 1],
+                                         ds.channels[min(zoomlevel+1, len(ds.channels)-1)].shape[length - 2],
+                                         ds.channels[min(zoomlevel+1, len(ds.channels)-1)].shape[length - 1],
                                          viewport)
         cv2.imwrite('minerva_analysis/server/analytics/img/sim_map_strange.jpg', combined_sim_map)
         mask = imageToWorldCoordinates(combined_sim_map, viewport, layerviewport)
@@ -256,42 +224,59 @@ def getLayerViewport(imageHeight, imageWidth, layerHeight, layerWidth, viewport)
 
 # load a channel as png using zarr in full width and height
 def loadPngSection(datasource_name, channel,  zoomlevel, viewport):
+    ds = data_model.get_datasource(datasource_name)
     print("chosen zoom level:")
     print(zoomlevel)
 
     # convert viewport to image layer: image height, width, layer height width, viewport
-    length = len(data_model.channels[0].shape)
-    viewport = getLayerViewport( data_model.channels[0].shape[length-2],
-                               data_model.channels[0].shape[length-1],
-                              data_model.channels[min(zoomlevel, len(data_model.channels)-1)].shape[length-2],
-                              data_model.channels[min(zoomlevel, len(data_model.channels)-1)].shape[length-1],
+    length = len(ds.channels[0].shape)
+    viewport = getLayerViewport( ds.channels[0].shape[length-2],
+                               ds.channels[0].shape[length-1],
+                              ds.channels[min(zoomlevel, len(ds.channels)-1)].shape[length-2],
+                              ds.channels[min(zoomlevel, len(ds.channels)-1)].shape[length-1],
                               viewport)
 
     # print(data_model.get_channel_names(datasource_name, shortnames=False))
     channel = data_model.get_channel_names(datasource_name, shortnames=False).index(channel)
 
 
-    if isinstance(data_model.channels, zarr.Array):
-        tile = data_model.channels[channel, viewport[1]:viewport[3], viewport[0]:viewport[2]]
+    if isinstance(ds.channels, zarr.Array):
+        tile = ds.channels[channel, viewport[1]:viewport[3], viewport[0]:viewport[2]]
     else:
-        tile = data_model.channels[min(zoomlevel, len(data_model.channels)-1)][channel, viewport[1]:viewport[3], viewport[0]:viewport[2]]
+        tile = ds.channels[min(zoomlevel, len(ds.channels)-1)][channel, viewport[1]:viewport[3], viewport[0]:viewport[2]]
 
     return tile
 
 
+# load a channel section as 8 bit intensities (the input of calc_sim), cached per channel and level
+def loadQuantizedSection(datasource_name, channel, zoomlevel, viewport):
+    ds = data_model.get_datasource(datasource_name)
+    length = len(ds.channels[0].shape)
+    level = 0 if isinstance(ds.channels, zarr.Array) else min(zoomlevel, len(ds.channels)-1)
+    image = ds.channels if isinstance(ds.channels, zarr.Array) else ds.channels[level]
+    viewport = getLayerViewport( ds.channels[0].shape[length-2],
+                               ds.channels[0].shape[length-1],
+                              ds.channels[min(zoomlevel, len(ds.channels)-1)].shape[length-2],
+                              ds.channels[min(zoomlevel, len(ds.channels)-1)].shape[length-1],
+                              viewport)
+    channel = data_model.get_channel_names(datasource_name, shortnames=False).index(channel)
+    return ds.similarity_cache.get_section(image, channel, level, viewport)
+
+
 # load a channel as png using zarr in full width and height
 def loadPngAtZoomLevel(datasource_name, channel, zoomlevel):
+    ds = data_model.get_datasource(datasource_name)
     ix = 0
     iy = 0
     print(channel)
     print(data_model.get_channel_names(datasource_name, shortnames=False))
     channel = data_model.get_channel_names(datasource_name, shortnames=False).index(channel)
 
-    if isinstance(data_model.channels, zarr.Array):
-        tile = data_model.channels[channel, ix:data_model.config[datasource_name]["width"],
+    if isinstance(ds.channels, zarr.Array):
+        tile = ds.channels[channel, ix:data_model.config[datasource_name]["width"],
                iy:data_model.config[datasource_name]["height"]]
     else:
-        tile = data_model.channels[min(zoomlevel, len(data_model.channels)-1)][channel, ix:data_model.config[datasource_name]["width"],
+        tile = ds.channels[min(zoomlevel, len(ds.channels)-1)][channel, ix:data_model.config[datasource_name]["width"],
                iy:data_model.config[datasource_name]["height"]]
 
     tile = np.ascontiguousarray(tile, dtype='uint32')
@@ -336,31 +321,10 @@ def plotting_thread(fig, axe):
 
 
 def windowed_histogram_similarity(image, selem, reference_hist, n_bins):
-    # Compute normalized windowed histogram feature vector for each pixel
-    px_histograms = rank.windowed_histogram(image, selem, n_bins=n_bins)
-
-    # Reshape coin histogram to (1,1,N) for broadcast when we want to use it in
-    # arithmetic operations with the windowed histograms from the image
-    reference_hist = reference_hist.reshape((1, 1) + reference_hist.shape)
-
-    # Compute Chi squared distance metric: sum((X-Y)^2 / (X+Y));
-    # a measure of distance between histograms
-    X = px_histograms
-    Y = reference_hist
-
-    num = (X - Y) ** 2
-    denom = X + Y
-    denom[denom == 0] = np.infty
-    frac = num / denom
-
-    chi_sqr = 0.5 * np.sum(frac, axis=2)
-
-    # Generate a similarity measure. It needs to be low when distance is high
-    # and high when distance is low; taking the reciprocal will do this.
-    # Chi squared will always be >= 0, add small value to prevent divide by 0.
-    similarity = 1 / (chi_sqr + 1.0e-4)
-
-    return similarity
+    # Similarity of the histogram of the window around each pixel to the reference (1 / chi squared distance),
+    # computed by the engine configured as SIMILARITY_ENGINE, see windowed_histograms
+    return windowed_histograms.windowed_histogram_similarity(image, selem, reference_hist, n_bins,
+                                                             app.config['SIMILARITY_ENGINE'])
 
 
 def calc_sim(img, coin):
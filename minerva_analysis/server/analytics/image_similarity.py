@@ -130,16 +130,17 @@ def loadPng(datasource_name, channel):
     #     data_model.load_db(datasource)
     # channel_io = tf.TiffFile(str(data_model.config[datasource]['channelFile']), is_ome=False)
     # channel_num = 6
+    ds = data_model.get_datasource(datasource_name)
     ix = 0
     iy = 0
     print(channel)
     channel = data_model.get_channel_names(datasource_name, shortnames=False).index(channel)
 
-    if isinstance(data_model.channels, zarr.Array):
-        tile = data_model.channels[channel, ix:data_model.config[datasource_name]["width"],
+    if isinstance(ds.channels, zarr.Array):
+        tile = ds.channels[channel, ix:data_model.config[datasource_name]["width"],
                iy:data_model.config[datasource_name]["height"]]
     else:
-        tile = data_model.channels[8][channel, ix:data_model.config[datasource_name]["width"],
+        tile = ds.channels[8][channel, ix:data_model.config[datasource_name]["width"],
                iy:data_model.config[datasource_name]["height"]]
 
     tile = np.ascontiguousarray(tile, dtype='uint32')
@@ -0,0 +1,127 @@
+# Windowed histogram similarity without a per-pixel histogram stack.
+#
+# skimage.filters.rank.windowed_histogram returns a (h, w, bins) float64 stack of
+# the normalized histogram of the window around every pixel, which calc_sim then
+# reduces to a chi-squared distance to the lens histogram. With large lenses and
+# viewports the stack dominates memory and time. The engines below compute the
+# same map bin by bin in float32, a strip of rows at a time, so only a strip of
+# window counts and the (h, w) distance are kept:
+#   'fft'       window counts of each bin by FFT convolution of the bin indicator
+#               with the footprint (any footprint, calc_sim uses a disk), rounded
+#               to integers, so the map equals the rank one up to float32 precision
+#   'integral'  window counts from per-bin integral images, exact and independent
+#               of the window size, but the window is the square bounding the
+#               footprint, a close approximation of the disk
+#   'rank'      skimage's windowed_histogram, the reference
+# As in skimage, counts are normalized by the number of window pixels inside the
+# image, so windows at the image border are not biased towards empty bins.
+
+import numpy as np
+import scipy.fft
+from skimage.filters import rank
+
+ENGINES = ('fft', 'integral', 'rank')
+# Pixels of a strip of rows (plus the window margin) processed at once, unless the window is larger
+STRIP_PIXELS = 2 ** 21
+
+
+def chi_squared_term(histogram, reference):
+    """
+    0.5 * (X - Y)^2 / (X + Y) of one bin, 0 where both are 0.
+    """
+    if reference == 0:
+        return 0.5 * histogram
+    return 0.5 * (histogram - reference) ** 2 / (histogram + reference)
+
+
+def get_strips(height, width, radius):
+    # At least as many rows as the window margin, so strips overlap by at most half
+    rows = max(2 * radius + 1, STRIP_PIXELS // (width + 2 * radius) - 2 * radius)
+    return [(y, min(y + rows, height)) for y in range(0, height, rows)]
+
+
+def pad_strip(image, y0, y1, radius):
+    """
+    Rows y0 - radius to y1 + radius of image with a radius wide border on every
+    side, -1 outside the image.
+    """
+    height, width = image.shape
+    top, bottom = max(0, y0 - radius), min(height, y1 + radius)
+    padded = np.full((y1 - y0 + 2 * radius, width + 2 * radius), -1, dtype=np.int16)
+    padded[top - (y0 - radius):bottom - (y0 - radius), radius:radius + width] = image[top:bottom]
+    return padded
+
+
+def fft_counts(indicator, footprint_fft, fft_shape, out_shape, radius):
+    """
+    Footprint sums of a padded strip indicator, the valid part of the circular
+    convolution (fft_shape is at least the strip shape, so nothing wraps around).
+    """
+    counts = scipy.fft.irfft2(scipy.fft.rfft2(indicator.astype(np.float32), s=fft_shape) * footprint_fft,
+                              s=fft_shape)
+    return np.rint(counts[2 * radius:2 * radius + out_shape[0], 2 * radius:2 * radius + out_shape[1]])
+
+
+def integral_counts(indicator, out_shape, radius):
+    """
+    Sums of a padded strip indicator over (2 radius + 1) squares, from its
+    integral image.
+    """
+    integral = np.zeros((indicator.shape[0] + 1, indicator.shape[1] + 1), dtype=np.int32)
+    np.cumsum(np.cumsum(indicator, axis=0, dtype=np.int32), axis=1, out=integral[1:, 1:])
+    size = 2 * radius + 1
+    h, w = out_shape
+    return (integral[size:size + h, size:size + w] - integral[:h, size:size + w]
+            - integral[size:size + h, :w] + integral[:h, :w]).astype(np.float32)
+
+
+def windowed_chi_squared(image, footprint, reference_hist, engine='fft'):
+    """
+    Chi-squared distance between the normalized histogram of the footprint window
+    around each pixel of image (bin indices) and reference_hist, as float32.
+    """
+    radius = footprint.shape[0] // 2
+    reference_hist = np.asarray(reference_hist, dtype=np.float32)
+    height, width = image.shape
+    chi_sqr = np.zeros((height, width), dtype=np.float32)
+    footprint_ffts = {}
+    for y0, y1 in get_strips(height, width, radius):
+        padded = pad_strip(image, y0, y1, radius)
+        out_shape = (y1 - y0, width)
+        if engine != 'integral':
+            fft_shape = tuple(scipy.fft.next_fast_len(size, real=True) for size in padded.shape)
+            if fft_shape not in footprint_ffts:
+                footprint_ffts[fft_shape] = scipy.fft.rfft2(footprint.astype(np.float32), s=fft_shape)
+
+        def counts(indicator):
+            if engine == 'integral':
+                return integral_counts(indicator, out_shape, radius)
+            return fft_counts(indicator, footprint_ffts[fft_shape], fft_shape, out_shape, radius)
+
+        population = counts(padded >= 0)
+        np.maximum(population, 1, out=population)
+        strip = chi_sqr[y0:y1]
+        for b, reference in enumerate(reference_hist):
+            histogram = counts(padded == b)
+            histogram /= population
+            strip += chi_squared_term(histogram, reference)
+    return chi_sqr
+
+
+def windowed_histogram_similarity(image, footprint, reference_hist, n_bins, engine='fft'):
+    """
+    1 / (chi-squared distance + 1e-4) of the windowed histograms of image (bin
+    indices below n_bins) to reference_hist, see the module description.
+    """
+    if engine not in ENGINES:
+        raise ValueError('Unknown similarity engine ' + str(engine))
+    if engine == 'rank':
+        px_histograms = rank.windowed_histogram(image, footprint, n_bins=n_bins)
+        reference_hist = np.asarray(reference_hist).reshape((1, 1) + np.shape(reference_hist))
+        num = (px_histograms - reference_hist) ** 2
+        denom = px_histograms + reference_hist
+        denom[denom == 0] = np.inf
+        chi_sqr = 0.5 * np.sum(num / denom, axis=2)
+    else:
+        chi_sqr = windowed_chi_squared(image, footprint, reference_hist[:n_bins], engine)
+    return 1 / (chi_sqr + 1.0e-4)
@@ -0,0 +1,304 @@
+# Cell outline layer of a segmentation mask.
+#
+# The outline of every cell is traced once, offline and in worker processes, from
+# the full resolution label image and simplified for several levels of detail:
+# level l keeps the outline within 2 ** l / 2 pixels, half a screen pixel at
+# pyramid level l. The image is processed in tiles; a cell belongs to the tile
+# containing the top left corner of its bounding box, and tiles are read with a
+# margin below and to the right so cells crossing the tile border are traced whole
+# (cells larger than the margin are cut and reported).
+#
+# The layer is stored next to the feature cache:
+#   <datasource>/cell_outlines/labels.npy        uint32 (cells,), sorted
+#   <datasource>/cell_outlines/bounds.npy        int32 (cells, 4), x0, y0, x1, y1 (exclusive) of each cell
+#   <datasource>/cell_outlines/offsets.npy       int64 (levels, cells + 1), first vertex of each outline
+#   <datasource>/cell_outlines/points.npy        uint16 (vertices, 2), x, y relative to (x0 - 1, y0 - 1)
+#   <datasource>/cell_outlines/grid.npy          int32 (cells,), cell indices ordered by grid bucket
+#   <datasource>/cell_outlines/grid_offsets.npy  int64 (buckets + 1,), first entry of each bucket in grid
+#   <datasource>/cell_outlines/manifest.json     source fingerprint, image size, levels and grid
+# Cells are bucketed on a grid of bucket_size pixels by the top left corner of
+# their bounds, so a viewport query reads only the buckets it overlaps (extended
+# by the largest cell) and everything is memory-mapped.
+#
+# Usage: python -m minerva_analysis.server.models.cell_outlines --labels mask.ome.tif \
+#            --out minerva_analysis/data/<datasource>/cell_outlines
+
+import argparse
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import cv2
+import numpy as np
+from scipy import ndimage
+
+from minerva_analysis.server.models import image_readers
+
+LAYER_VERSION = 1
+LAYER_DIRECTORY = 'cell_outlines'
+MANIFEST_FILE = 'manifest.json'
+LEVELS = 6
+TILE_SIZE = 1024
+MARGIN = 256
+BUCKET_SIZE = 512
+
+# Label image of the worker processes, set by init_worker
+worker_state = {}
+
+
+def get_tolerances(levels=LEVELS):
+    return [2 ** level / 2 for level in range(levels)]
+
+
+def trace(mask, tolerances):
+    """
+    Simplified outlines (one (n, 2) array of x, y per tolerance) through the
+    centres of the boundary pixels of the largest part of a boolean cell mask,
+    relative to one pixel above and left of the mask.
+    """
+    # [-2] picks the contours from the results of both OpenCV 3 and 4
+    contours = cv2.findContours(np.pad(mask, 1).astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+    contour = max(contours, key=cv2.contourArea)
+    return [cv2.approxPolyDP(contour, tolerance, True).reshape(-1, 2).astype(np.uint16) for tolerance in tolerances]
+
+
+def trace_window(labels, origin, shape, tile_size, tolerances):
+    """
+    Outlines of the cells of the tile at origin (y, x) of a label image of shape.
+    labels is the window from one pixel above and left of the tile to margin
+    pixels below and right of it. Returns (labels, areas, bounds, outlines per
+    tolerance, number of cut cells).
+    """
+    oy, ox = origin
+    ids, inverse = np.unique(labels, return_inverse=True)
+    inverse = inverse.reshape(labels.shape)
+    # Cells seen in the border row or column above / left of the tile belong to another tile
+    foreign = np.zeros(len(ids), dtype=bool)
+    if oy > 0:
+        foreign[inverse[0]] = True
+    if ox > 0:
+        foreign[inverse[:, 0]] = True
+    border_y, border_x = (1 if oy > 0 else 0), (1 if ox > 0 else 0)
+    cut_y = oy - border_y + labels.shape[0] < shape[0]
+    cut_x = ox - border_x + labels.shape[1] < shape[1]
+    cells, areas, bounds, cut = [], [], [], 0
+    outlines = [[] for _ in tolerances]
+    for index, slices in enumerate(ndimage.find_objects(inverse + 1)):
+        if slices is None or ids[index] == 0 or foreign[index]:
+            continue
+        ys, xs = slices
+        if ys.start - border_y >= tile_size or xs.start - border_x >= tile_size:
+            continue
+        if (cut_y and ys.stop == labels.shape[0]) or (cut_x and xs.stop == labels.shape[1]):
+            cut += 1
+        mask = inverse[slices] == index
+        y0, x0 = oy + ys.start - border_y, ox + xs.start - border_x
+        cells.append(ids[index])
+        areas.append(int(mask.sum()))
+        bounds.append((x0, y0, x0 + mask.shape[1], y0 + mask.shape[0]))
+        for outline, level_outlines in zip(trace(mask, tolerances), outlines):
+            level_outlines.append(outline)
+    return cells, areas, bounds, outlines, cut
+
+
+def init_worker(path, tile_size, margin, tolerances):
+    worker_state['labels'], worker_state['tiff'] = image_readers.open_labels(path)
+    worker_state['tile_size'] = tile_size
+    worker_state['margin'] = margin
+    worker_state['tolerances'] = tolerances
+
+
+def trace_tile(origin):
+    labels = worker_state['labels']
+    tile_size = worker_state['tile_size']
+    oy, ox = origin
+    window = labels[max(0, oy - 1):oy + tile_size + worker_state['margin'],
+                    max(0, ox - 1):ox + tile_size + worker_state['margin']]
+    if window.dtype == np.int32:
+        window = window.view('uint32')
+    return trace_window(window, origin, labels.shape, tile_size, worker_state['tolerances'])
+
+
+def get_layer_path(datasource_directory):
+    return Path(datasource_directory) / LAYER_DIRECTORY
+
+
+def read_manifest(path):
+    try:
+        with open(Path(path) / MANIFEST_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def build(path, labels_path, source, levels=LEVELS, tile_size=TILE_SIZE, margin=MARGIN, bucket_size=BUCKET_SIZE,
+          n_workers=None):
+    """
+    Traces the outlines of the cells of the segmentation at labels_path and
+    writes the layer to path. source is the fingerprint of the segmentation the
+    layer belongs to. Like the spatial correlation layer, the layer is written to
+    a temporary directory that is renamed into place once complete.
+    """
+    path = Path(path)
+    n_workers = n_workers or os.cpu_count() or 1
+    tolerances = get_tolerances(levels)
+    image, tiff = image_readers.open_labels(labels_path)
+    shape = image.shape[-2:]
+    if tiff is not None:
+        tiff.close()
+    origins = [(y, x) for y in range(0, shape[0], tile_size) for x in range(0, shape[1], tile_size)]
+    print("Tracing cell outlines of a {} x {} segmentation in {} tiles, {} workers".format(
+        shape[1], shape[0], len(origins), n_workers))
+
+    cells, areas, bounds, cut = [], [], [], 0
+    outlines = [[] for _ in tolerances]
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker,
+                             initargs=(str(labels_path), tile_size, margin, tolerances)) as executor:
+        for i, result in enumerate(executor.map(trace_tile, origins)):
+            tile_cells, tile_areas, tile_bounds, tile_outlines, tile_cut = result
+            cells += tile_cells
+            areas += tile_areas
+            bounds += tile_bounds
+            for level_outlines, tile_level_outlines in zip(outlines, tile_outlines):
+                level_outlines += tile_level_outlines
+            cut += tile_cut
+            if (i + 1) % max(1, len(origins) // 20) == 0 or i + 1 == len(origins):
+                print("Cell outlines: {}/{} tiles".format(i + 1, len(origins)))
+    if cut > 0:
+        print("{} cells are larger than the tile margin ({} px), their outlines are cut".format(cut, margin))
+
+    # Sorted by label; a label split over several tiles keeps its largest part
+    cells = np.asarray(cells, dtype=np.uint32)
+    order = np.lexsort((-np.asarray(areas, dtype=np.int64), cells))
+    order = order[np.concatenate([[True], cells[order][1:] != cells[order][:-1]])] if len(order) > 0 else order
+    cells = cells[order]
+    bounds = np.asarray(bounds, dtype=np.int32).reshape(-1, 4)[order]
+
+    tmp_path = path.with_name(path.name + '.tmp')
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    # The outlines of all levels share points, level after level
+    offsets = np.zeros((levels, len(cells) + 1), dtype=np.int64)
+    start = 0
+    for level, level_outlines in enumerate(outlines):
+        offsets[level] = start + np.concatenate([[0], np.cumsum([len(level_outlines[i]) for i in order])])
+        start = int(offsets[level, -1])
+    points = np.lib.format.open_memmap(tmp_path / 'points.npy', mode='w+', dtype=np.uint16, shape=(start, 2))
+    for level, level_outlines in enumerate(outlines):
+        if len(order) > 0:
+            points[offsets[level, 0]:offsets[level, -1]] = np.concatenate([level_outlines[i] for i in order])
+    points.flush()
+    del points
+
+    grid_width = -(-shape[1] // bucket_size)
+    grid_height = -(-shape[0] // bucket_size)
+    buckets = (bounds[:, 1] // bucket_size).astype(np.int64) * grid_width + bounds[:, 0] // bucket_size
+    grid = np.argsort(buckets, kind='stable').astype(np.int32)
+    grid_offsets = np.zeros(grid_width * grid_height + 1, dtype=np.int64)
+    grid_offsets[1:] = np.cumsum(np.bincount(buckets, minlength=grid_width * grid_height))
+    extent = bounds[:, 2:] - bounds[:, :2]
+
+    np.save(tmp_path / 'labels.npy', cells)
+    np.save(tmp_path / 'bounds.npy', bounds)
+    np.save(tmp_path / 'offsets.npy', offsets)
+    np.save(tmp_path / 'grid.npy', grid)
+    np.save(tmp_path / 'grid_offsets.npy', grid_offsets)
+    manifest = {'version': LAYER_VERSION, 'source': source, 'width': int(shape[1]), 'height': int(shape[0]),
+                'levels': levels, 'tolerances': tolerances, 'bucket_size': bucket_size, 'grid_width': grid_width,
+                'grid_height': grid_height, 'max_extent': int(extent.max()) if len(cells) > 0 else 0,
+                'cells': len(cells), 'cut_cells': cut}
+    with open(tmp_path / MANIFEST_FILE, 'w') as f:
+        json.dump(manifest, f, indent=4)
+
+    if path.exists():
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    print("Cell outline layer built, {} cells.".format(len(cells)))
+
+
+def load(path, source):
+    """
+    Memory maps the layer at path, or returns None if it is missing or was built
+    for another segmentation.
+    """
+    path = Path(path)
+    manifest = read_manifest(path)
+    if manifest is None or manifest.get('version') != LAYER_VERSION or manifest.get('source') != source:
+        return None
+    for name in ['labels', 'bounds', 'offsets', 'points', 'grid', 'grid_offsets']:
+        manifest[name] = np.load(path / (name + '.npy'), mmap_mode='r')
+    return manifest
+
+
+def query_viewport(layer, viewport):
+    """
+    Indices of the cells whose bounds intersect viewport [x0, y0, x1, y1].
+    """
+    x0, y0, x1, y1 = viewport
+    bucket_size = layer['bucket_size']
+    # A cell starts at most max_extent pixels before the viewport
+    bx0 = max(0, int(x0 - layer['max_extent']) // bucket_size)
+    by0 = max(0, int(y0 - layer['max_extent']) // bucket_size)
+    bx1 = min(layer['grid_width'] - 1, int(x1) // bucket_size)
+    by1 = min(layer['grid_height'] - 1, int(y1) // bucket_size)
+    if bx1 < bx0 or by1 < by0:
+        return np.zeros(0, dtype=np.int64)
+    grid_offsets = layer['grid_offsets']
+    rows = [layer['grid'][grid_offsets[by * layer['grid_width'] + bx0]:grid_offsets[by * layer['grid_width'] + bx1 + 1]]
+            for by in range(by0, by1 + 1)]
+    indices = np.sort(np.concatenate(rows)).astype(np.int64)
+    bounds = layer['bounds'][indices]
+    inside = (bounds[:, 0] < x1) & (bounds[:, 2] > x0) & (bounds[:, 1] < y1) & (bounds[:, 3] > y0)
+    return indices[inside]
+
+
+def query_labels(layer, labels):
+    """
+    Indices of the cells of the given labels that have an outline.
+    """
+    labels = np.unique(np.asarray(labels, dtype=np.int64))
+    labels = labels[(labels >= 0) & (labels < 2 ** 32)].astype(np.uint32)
+    if len(layer['labels']) == 0:
+        return np.zeros(0, dtype=np.int64)
+    positions = np.minimum(np.searchsorted(layer['labels'], labels), len(layer['labels']) - 1)
+    return positions[layer['labels'][positions] == labels]
+
+
+def get_outlines(layer, indices, level=0):
+    """
+    Outlines of the cells at indices at the level of detail for a pyramid level,
+    as labels, offsets into points (one entry per cell plus the end) and the flat
+    absolute x, y coordinates of all vertices.
+    """
+    level = min(max(int(level), 0), layer['levels'] - 1)
+    indices = np.asarray(indices, dtype=np.int64)
+    offsets = layer['offsets'][level]
+    starts = offsets[indices]
+    lengths = offsets[indices + 1] - starts
+    ends = np.cumsum(lengths)
+    # Vertex i of the result is vertex i - (first result vertex of its cell) of the cell's outline
+    vertices = np.arange(ends[-1] if len(ends) > 0 else 0) + np.repeat(starts - (ends - lengths), lengths)
+    origin = np.repeat(layer['bounds'][indices][:, :2].astype(np.int64) - 1, lengths, axis=0)
+    points = layer['points'][vertices].astype(np.int64) + origin
+    return {
+        'labels': np.asarray(layer['labels'][indices]),
+        'offsets': np.concatenate([[0], ends]).astype(np.int64),
+        'points': points.reshape(-1)
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Builds the cell outline layer of a segmentation mask")
+    parser.add_argument('--labels', required=True, help="Segmentation (TIFF or zarr)")
+    parser.add_argument('--out', required=True, help="Layer directory, <datasource directory>/" + LAYER_DIRECTORY)
+    parser.add_argument('--workers', type=int, help="Worker processes (default: all cores)")
+    args = parser.parse_args(argv)
+    # The source the server checks when loading the layer
+    build(args.out, args.labels, image_readers.get_image_token([args.labels]), n_workers=args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# Server-side compositing of channel tiles into one RGB tile.
+#
+# Every channel is mapped through a contrast window [lo, hi] to a colour ramp from
+# black to its colour, and the channels are added and clipped like the additive
+# blending of the viewer. For 8 and 16 bit channels the mapping is a lookup table
+# of all possible values to RGB, cached per (dtype, lo, hi, colour) so repeated
+# renders of the same settings only gather from the tables. The table does not
+# depend on the channel itself, so channels with equal settings share one.
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import ImageColor
+
+
+def parse_color(color):
+    """
+    (r, g, b) of '#ff0000', 'ff0000', 'red' or an [r, g, b] list.
+    """
+    if isinstance(color, str):
+        if not color.startswith('#') and len(color) in (3, 6) and all(c in '0123456789abcdefABCDEF' for c in color):
+            color = '#' + color
+        return ImageColor.getrgb(color)[:3]
+    return tuple(int(c) for c in color[:3])
+
+
+def color_ramp(values, lo, hi, color):
+    """
+    RGB float32 values (0-255) of values through the window [lo, hi].
+    """
+    if hi > lo:
+        intensity = np.clip((values.astype(np.float32) - np.float32(lo)) / np.float32(hi - lo), 0, 1)
+    else:
+        intensity = (values >= hi).astype(np.float32)
+    return intensity[..., np.newaxis] * np.asarray(color, dtype=np.float32)
+
+
+class Compositor:
+
+    def __init__(self, max_tables=128):
+        self.max_tables = max_tables
+        # (dtype, lo, hi, colour) -> (2 ** bits, 3) uint8 table, least recently used first
+        self.tables = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def lookup_table(self, dtype, lo, hi, color):
+        key = (np.dtype(dtype).str, float(lo), float(hi), color)
+        with self.lock:
+            table = self.tables.get(key)
+            if table is not None:
+                self.tables.move_to_end(key)
+                self.hits += 1
+                return table
+            self.misses += 1
+        values = np.arange(np.iinfo(dtype).min, np.iinfo(dtype).max + 1)
+        table = np.rint(color_ramp(values, lo, hi, color)).astype(np.uint8)
+        with self.lock:
+            self.tables[key] = table
+            while len(self.tables) > self.max_tables:
+                self.tables.popitem(last=False)
+        return table
+
+    def composite(self, layers):
+        """
+        RGB uint8 tile of layers given as (tile, (lo, hi), colour) with 2D tiles
+        of equal shape.
+        """
+        shape = layers[0][0].shape
+        rgb = np.zeros(shape + (3,), dtype=np.uint16)
+        rgb_float = None
+        for tile, (lo, hi), color in layers:
+            color = parse_color(color)
+            if tile.dtype.kind in 'iu' and tile.dtype.itemsize <= 2:
+                table = self.lookup_table(tile.dtype, lo, hi, color)
+                offset = -np.iinfo(tile.dtype).min
+                indices = tile if offset == 0 else tile.astype(np.int32) + offset
+                rgb += np.take(table, indices, axis=0)
+            else:
+                if rgb_float is None:
+                    rgb_float = np.zeros(shape + (3,), dtype=np.float32)
+                rgb_float += color_ramp(tile, lo, hi, color)
+        if rgb_float is not None:
+            rgb_float += rgb
+            return np.rint(np.minimum(rgb_float, 255)).astype(np.uint8)
+        return np.minimum(rgb, 255).astype(np.uint8)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'tables': len(self.tables),
+                    'tables_bytes': sum(table.nbytes for table in self.tables.values())}
@@ -1,7 +1,8 @@
 import json
 import os
-import pickle
 import re
+import threading
+from collections import OrderedDict
 from pathlib import Path
 
 import dateutil.parser
@@ -11,58 +12,188 @@ import tifffile as tf
 import zarr
 from PIL import ImageColor
 from ome_types import from_xml
-from sklearn.neighbors import BallTree
 
-from minerva_analysis import config_json_path, data_path
-from minerva_analysis.server.models import database_model
-from minerva_analysis.server.utils import pyramid_assemble
+from minerva_analysis import app, config_json_path, data_path
+from minerva_analysis.server.models import cell_outlines, compositor, database_model, feature_cache, gating, \
+    image_readers, label_index, label_tiles, similarity_cache, spatial_correlation, spatial_index, tile_cache, \
+    tile_prefetcher
+from minerva_analysis.server.utils import pyramid_assemble, tile_encoding, zarr_pyramid
 
-ball_tree = None
-database = None
-source = None
 config = None
-seg = None
-channels = None
-metadata = None
+
+# Resident datasources, least recently used first. Several slides can be open in
+# concurrent sessions, so each one keeps its own frame, spatial index and image
+# handles instead of sharing (and thrashing) a single global slot.
+datasources = OrderedDict()
+datasources_lock = threading.RLock()
+loading_locks = {}
+# Datasources whose whole-slide spatial correlation layer is being built
+spatial_corr_jobs = set()
+# Datasources whose cell outline layer is being built
+cell_outline_jobs = set()
+# Datasources whose label index is being built
+label_index_jobs = set()
+# Encoded image tiles of all datasources
+encoded_tiles = tile_cache.TileCache(app.config['TILE_CACHE_BYTES'], app.config['TILE_CACHE_DIRECTORY'])
+tile_compositor = compositor.Compositor(app.config['COMPOSITE_TABLE_CACHE_SIZE'])
+# Threads decoding neighbouring tiles into encoded_tiles, started with the first tile request
+tile_prefetch = tile_prefetcher.TilePrefetcher(lambda *key: prefetch_tile(*key), lambda *key: get_tile_grid(*key),
+                                               lambda *key: is_prefetch_done(*key),
+                                               n_workers=app.config['TILE_PREFETCH_WORKERS'],
+                                               max_queue=app.config['TILE_PREFETCH_QUEUE'])
+# Set in threads that must not load datasources (the prefetch workers), see get_datasource
+resident_only = threading.local()
+
+
+class NotResidentError(Exception):
+    pass
+
+
+class LoadedDatasource:
+    def __init__(self, name):
+        self.name = name
+        self.frame = None
+        self.spatial_index = None
+        self.spatial_corr = None
+        self.cell_outlines = None
+        self.label_index = None
+        self.gating = None
+        # Segmentation loaded into memory (.zarr), otherwise read through seg_reader
+        self.seg_data = None
+        self.seg_reader = None
+        self.channel_reader = None
+        self.metadata = None
+        self.image_token = None
+        # Sets of visible cells for segmentation tiles, see set_visible_labels
+        self.label_filters = label_tiles.LabelFilters()
+        # Quantized channel sections of the similarity search, see analytics/comparison
+        self.similarity_cache = similarity_cache.SimilarityCache(app.config['SIMILARITY_CACHE_BYTES'])
+
+    @property
+    def channels(self):
+        return self.channel_reader.get()
+
+    @property
+    def seg(self):
+        if self.seg_reader is not None:
+            return self.seg_reader.get()
+        return self.seg_data
+
+    def nbytes(self):
+        size = 0
+        if self.frame is not None:
+            size += int(self.frame.memory_usage(index=True).sum())
+        if self.spatial_index is not None:
+            size += self.spatial_index.nbytes()
+        if self.gating is not None:
+            size += self.gating.nbytes()
+        if isinstance(self.seg_data, np.ndarray):
+            size += self.seg_data.nbytes
+        size += self.label_filters.nbytes()
+        size += self.similarity_cache.nbytes()
+        return size
+
+    def close(self):
+        for reader in [self.channel_reader, self.seg_reader]:
+            if reader is not None:
+                reader.close()
+
+    def reader_stats(self):
+        return {name: reader.stats() for name, reader in [('channels', self.channel_reader), ('seg', self.seg_reader)]
+                if reader is not None}
 
 
 def init(datasource_name):
-    load_ball_tree(datasource_name)
+    get_datasource(datasource_name)
+
+
+def get_datasource(datasource_name):
+    """
+    Returns the resident datasource, loading it first if it is not in memory
+    (raises NotResidentError instead in resident_only threads).
+    """
+    with datasources_lock:
+        if datasource_name in datasources:
+            datasources.move_to_end(datasource_name)
+            return datasources[datasource_name]
+    if getattr(resident_only, 'active', False):
+        raise NotResidentError(datasource_name)
+    return load_datasource(datasource_name)
 
 
 def load_datasource(datasource_name, reload=False):
-    global datasource
-    global source
-    global config
-    global seg
-    global channels
-    global metadata
-    if source is datasource_name and datasource is not None and reload is False:
-        return
-    load_config(datasource_name)
-    if reload:
-        load_ball_tree(datasource_name, reload=reload)
-    csvPath = Path(config[datasource_name]['featureData'][0]['src'])
-    print("Loading csv data.. (this can take some time)")
-    datasource = pd.read_csv(csvPath)
-    datasource['id'] = datasource.index
-    datasource = datasource.replace(-np.Inf, 0)
-    source = datasource_name
-    print("Loading segmentation.")
-    if config[datasource_name]['segmentation'].endswith('.zarr'):
-        seg = zarr.load(config[datasource_name]['segmentation'])
-    else:
-        seg_io = tf.TiffFile(config[datasource_name]['segmentation'], is_ome=False)
-        seg = zarr.open(seg_io.series[0].aszarr())
-    channel_io = tf.TiffFile(config[datasource_name]['channelFile'], is_ome=False)
-    print("Loading image descriptions.")
-    try:
-        xml = channel_io.pages[0].tags['ImageDescription'].value
-        metadata = from_xml(xml).images[0].pixels
-    except:
-        metadata = {}
-    channels = zarr.open(channel_io.series[0].aszarr())
-    print("Data loading done.")
+    # One lock per datasource, so loading a slide does not block requests on others
+    with datasources_lock:
+        loading_lock = loading_locks.setdefault(datasource_name, threading.Lock())
+    with loading_lock:
+        with datasources_lock:
+            if datasource_name in datasources and reload is False:
+                datasources.move_to_end(datasource_name)
+                return datasources[datasource_name]
+        ds = LoadedDatasource(datasource_name)
+        with datasources_lock:
+            load_config(datasource_name)
+        csvPath = Path(config[datasource_name]['featureData'][0]['src'])
+        print("Loading feature data.")
+        ds.frame = feature_cache.load(csvPath)
+        ds.frame['id'] = ds.frame.index
+        ds.frame = ds.frame.replace(-np.Inf, 0)
+        load_spatial_index(ds, reload=reload)
+        load_spatial_corr_layer(ds)
+        ds.gating = gating.GatingEngine(ds.frame, max_bytes=app.config['GATING_CACHE_BYTES'])
+        print("Loading segmentation.")
+        if config[datasource_name]['segmentation'].endswith('.zarr') and not zarr_pyramid.is_multiscale(
+                config[datasource_name]['segmentation']):
+            ds.seg_data = zarr.load(config[datasource_name]['segmentation'])
+        else:
+            ds.seg_reader = image_readers.ReaderPool(config[datasource_name]['segmentation'])
+        ds.channel_reader = image_readers.ReaderPool(config[datasource_name]['channelFile'])
+        print("Loading image descriptions.")
+        try:
+            xml = ds.channel_reader.description()
+            ds.metadata = from_xml(xml).images[0].pixels
+        except:
+            ds.metadata = {}
+        ds.image_token = image_readers.get_image_token([config[datasource_name]['channelFile'],
+                                                        config[datasource_name]['segmentation']])
+        load_cell_outlines(ds)
+        load_label_index(ds)
+        with datasources_lock:
+            previous = datasources.pop(datasource_name, None)
+            if previous is not None:
+                previous.close()
+            datasources[datasource_name] = ds
+            evict_datasources()
+        print("Data loading done.")
+        return ds
+
+
+def evict_datasources():
+    """
+    Drops least recently used datasources until the cache fits its configured
+    item count and memory budget. The most recently used one is always kept.
+    """
+    max_items = app.config['DATASOURCE_CACHE_SIZE']
+    max_bytes = app.config['DATASOURCE_CACHE_BYTES']
+    with datasources_lock:
+        while len(datasources) > 1:
+            total_bytes = sum(ds.nbytes() for ds in datasources.values())
+            if len(datasources) <= max_items and total_bytes <= max_bytes:
+                break
+            name, ds = datasources.popitem(last=False)
+            print("Evicting datasource", name)
+            ds.close()
+            encoded_tiles.discard(name)
+            tile_prefetch.cancel(name)
+
+
+def unload_datasource(datasource_name):
+    with datasources_lock:
+        ds = datasources.pop(datasource_name, None)
+    if ds is not None:
+        ds.close()
+    encoded_tiles.discard(datasource_name)
+    tile_prefetch.cancel(datasource_name)
 
 
 def load_config(datasource_name):
@@ -96,44 +227,206 @@ def load_config(datasource_name):
             configJson.truncate()
 
 
-def load_ball_tree(datasource_name_name, reload=False):
-    global ball_tree
-    global datasource
-    global config
-    if datasource_name_name != source:
-        load_datasource(datasource_name_name)
-    pickled_kd_tree_path = str(
-        Path(
-            os.path.join(os.getcwd())) / data_path / datasource_name_name / "ball_tree.pickle")
-    if os.path.isfile(pickled_kd_tree_path) and reload is False:
-        print("Pickled KD Tree Exists, Loading")
-        ball_tree = pickle.load(open(pickled_kd_tree_path, "rb"))
-        print("Pickled KD Tree Loaded.")
+def load_spatial_index(ds, reload=False):
+    datasource_name = ds.name
+    datasource_directory = Path(os.path.join(os.getcwd())) / data_path / datasource_name
+    xCoordinate = config[datasource_name]['featureData'][0]['xCoordinate']
+    yCoordinate = config[datasource_name]['featureData'][0]['yCoordinate']
+    csvPath = Path(config[datasource_name]['featureData'][0]['src'])
+    backend = app.config['SPATIAL_INDEX_BACKEND']
+    header = spatial_index.make_header(backend, feature_cache.fingerprint(csvPath), xCoordinate, yCoordinate,
+                                       len(ds.frame))
+    index_path = spatial_index.get_index_path(datasource_directory)
+    ds.spatial_index = None
+    if reload is False:
+        ds.spatial_index = spatial_index.load_index(index_path, header)
+    if ds.spatial_index is None:
+        print("Creating spatial index ({}).".format(backend))
+        ds.spatial_index = spatial_index.build_index(ds.frame[[xCoordinate, yCoordinate]].to_numpy(), backend)
+        spatial_index.save_index(index_path, ds.spatial_index, header)
+        # Drop the index format used by older versions
+        pickled_kd_tree_path = datasource_directory / "ball_tree.pickle"
+        if pickled_kd_tree_path.is_file():
+            os.remove(pickled_kd_tree_path)
+        print('Creating spatial index done.')
     else:
-        print("Creating KD Tree.")
-        xCoordinate = config[datasource_name_name]['featureData'][0]['xCoordinate']
-        yCoordinate = config[datasource_name_name]['featureData'][0]['yCoordinate']
-        csvPath = Path(config[datasource_name_name]['featureData'][0]['src'])
-        raw_data = pd.read_csv(csvPath)
-        points = pd.DataFrame({'x': raw_data[xCoordinate], 'y': raw_data[yCoordinate]})
-        ball_tree = BallTree(points, metric='euclidean')
-        pickle.dump(ball_tree, open(pickled_kd_tree_path, 'wb'))
-        print('Creating KD Tree done.')
+        print("Spatial index loaded.")
+
+
+def load_spatial_corr_layer(ds):
+    datasource_directory = Path(os.path.join(os.getcwd())) / data_path / ds.name
+    csvPath = Path(config[ds.name]['featureData'][0]['src'])
+    ds.spatial_corr = spatial_correlation.load(spatial_correlation.get_layer_path(datasource_directory),
+                                               feature_cache.fingerprint(csvPath), len(ds.frame))
+    if ds.spatial_corr is not None:
+        print("Spatial correlation layer loaded.")
+
+
+def build_spatial_corr_layer(datasource_name, n_workers=None):
+    """
+    Precomputes the spatial correlation of every cell over the whole slide, so
+    lens requests become lookups. Returns False if a build is already running.
+    """
+    with datasources_lock:
+        if datasource_name in spatial_corr_jobs:
+            return False
+        spatial_corr_jobs.add(datasource_name)
+    try:
+        ds = get_datasource(datasource_name)
+        datasource_directory = Path(os.path.join(os.getcwd())) / data_path / datasource_name
+        x_coordinate = config[datasource_name]['featureData'][0]['xCoordinate']
+        y_coordinate = config[datasource_name]['featureData'][0]['yCoordinate']
+        csvPath = Path(config[datasource_name]['featureData'][0]['src'])
+        channels = [d['fullname'] for d in config[datasource_name]['imageData']][1:]
+        channels = [channel for channel in channels if channel in ds.frame.columns]
+        spatial_correlation.build(spatial_correlation.get_layer_path(datasource_directory), ds.frame, x_coordinate,
+                                  y_coordinate, channels, feature_cache.fingerprint(csvPath), n_workers=n_workers)
+        load_spatial_corr_layer(ds)
+        return True
+    finally:
+        with datasources_lock:
+            spatial_corr_jobs.discard(datasource_name)
+
+
+def start_spatial_corr_layer(datasource_name, n_workers=None):
+    thread = threading.Thread(target=build_spatial_corr_layer, args=(datasource_name, n_workers), daemon=True)
+    thread.start()
+
+
+def load_cell_outlines(ds):
+    datasource_directory = Path(os.path.join(os.getcwd())) / data_path / ds.name
+    ds.cell_outlines = cell_outlines.load(cell_outlines.get_layer_path(datasource_directory),
+                                          image_readers.get_image_token([config[ds.name]['segmentation']]))
+    if ds.cell_outlines is not None:
+        print("Cell outline layer loaded.")
+
+
+def build_cell_outlines(datasource_name, n_workers=None):
+    """
+    Traces the outlines of all cells of the segmentation for get_cell_outlines.
+    Returns False if a build is already running.
+    """
+    with datasources_lock:
+        if datasource_name in cell_outline_jobs:
+            return False
+        cell_outline_jobs.add(datasource_name)
+    try:
+        ds = get_datasource(datasource_name)
+        datasource_directory = Path(os.path.join(os.getcwd())) / data_path / datasource_name
+        segmentation = config[datasource_name]['segmentation']
+        cell_outlines.build(cell_outlines.get_layer_path(datasource_directory), segmentation,
+                            image_readers.get_image_token([segmentation]), n_workers=n_workers)
+        load_cell_outlines(ds)
+        return True
+    finally:
+        with datasources_lock:
+            cell_outline_jobs.discard(datasource_name)
+
+
+def start_cell_outlines(datasource_name, n_workers=None):
+    thread = threading.Thread(target=build_cell_outlines, args=(datasource_name, n_workers), daemon=True)
+    thread.start()
+
+
+def get_cell_outlines(datasource_name, level, viewport=None, labels=None, ids=None):
+    """
+    Outlines of the cells in viewport [x0, y0, x1, y1] (full resolution pixels),
+    of the visible labels registered as labels (see set_visible_labels) and of
+    the cell labels ids, whichever are given, at the level of detail of a
+    pyramid level. None if the layer has not been built.
+    """
+    ds = get_datasource(datasource_name)
+    layer = ds.cell_outlines
+    if layer is None:
+        return None
+    selected = None
+    if viewport is not None:
+        selected = cell_outlines.query_viewport(layer, viewport)
+    if ids is not None:
+        indices = cell_outlines.query_labels(layer, ids)
+        selected = indices if selected is None else np.intersect1d(selected, indices)
+    if labels is not None:
+        visible = ds.label_filters.get(labels)
+        if visible is None:
+            raise KeyError('Unknown label filter ' + labels)
+        if selected is None:
+            selected = np.flatnonzero(label_tiles.is_visible(np.asarray(layer['labels']), visible))
+        else:
+            selected = selected[label_tiles.is_visible(np.asarray(layer['labels'][selected]), visible)]
+    if selected is None:
+        selected = np.arange(len(layer['labels']))
+    return cell_outlines.get_outlines(layer, selected, level)
+
+
+def load_label_index(ds):
+    datasource_directory = Path(os.path.join(os.getcwd())) / data_path / ds.name
+    ds.label_index = label_index.load(label_index.get_layer_path(datasource_directory),
+                                      image_readers.get_image_token([config[ds.name]['segmentation']]))
+    if ds.label_index is not None:
+        print("Label index loaded.")
+
+
+def build_label_index(datasource_name, n_workers=None):
+    """
+    Indexes the bounds, area and centroid of every label of the segmentation for
+    get_cell_bounds. Returns False if a build is already running.
+    """
+    with datasources_lock:
+        if datasource_name in label_index_jobs:
+            return False
+        label_index_jobs.add(datasource_name)
+    try:
+        ds = get_datasource(datasource_name)
+        datasource_directory = Path(os.path.join(os.getcwd())) / data_path / datasource_name
+        segmentation = config[datasource_name]['segmentation']
+        label_index.build(label_index.get_layer_path(datasource_directory), segmentation,
+                          image_readers.get_image_token([segmentation]), n_workers=n_workers)
+        load_label_index(ds)
+        return True
+    finally:
+        with datasources_lock:
+            label_index_jobs.discard(datasource_name)
+
+
+def start_label_index(datasource_name, n_workers=None):
+    thread = threading.Thread(target=build_label_index, args=(datasource_name, n_workers), daemon=True)
+    thread.start()
+
+
+def get_cell_bounds(datasource_name, ids):
+    """
+    Bounds [x0, y0, x1, y1], pixel area and centroid [x, y] in the mask of the
+    cells with the labels ids (None for labels not in the mask), or None if the
+    label index has not been built.
+    """
+    ds = get_datasource(datasource_name)
+    if ds.label_index is None:
+        return None
+    return label_index.lookup(ds.label_index, ids)
+
+
+def validate_label_index(datasource_name):
+    """
+    Compares the cell ids of the feature table (the idField column) with the
+    labels of the mask, None if the label index has not been built.
+    """
+    ds = get_datasource(datasource_name)
+    if ds.label_index is None:
+        return None
+    id_field = config[datasource_name]['featureData'][0].get('idField', 'CellID')
+    ids = ds.frame[id_field] if id_field in ds.frame.columns else ds.frame['id']
+    return label_index.validate(ds.label_index, ids.to_numpy())
 
 
 def query_for_closest_cell(x, y, datasource_name):
-    global datasource
-    global source
-    global ball_tree
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
-    distance, index = ball_tree.query([[x, y]], k=1)
+    ds = get_datasource(datasource_name)
+    distance, index = ds.spatial_index.query_nearest(x, y)
     if distance == np.inf:
         return {}
     #         Nothing found
     else:
         try:
-            row = datasource.iloc[index[0]]
+            row = ds.frame.iloc[[index]]
             obj = row.to_dict(orient='records')[0]
             if 'celltype' not in obj:
                 obj['celltype'] = ''
@@ -143,21 +436,14 @@ def query_for_closest_cell(x, y, datasource_name):
 
 
 def get_row(row, datasource_name):
-    global database
-    global source
-    global ball_tree
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
-    obj = database.loc[[row]].to_dict(orient='records')[0]
+    ds = get_datasource(datasource_name)
+    obj = ds.frame.loc[[row]].to_dict(orient='records')[0]
     obj['id'] = row
     return obj
 
 
 def get_channel_names(datasource_name, shortnames=True):
-    global datasource
-    global source
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
+    get_datasource(datasource_name)
     if shortnames:
         channel_names = [channel['name'] for channel in config[datasource_name]['imageData'][1:]]
     else:
@@ -166,27 +452,16 @@ def get_channel_names(datasource_name, shortnames=True):
 
 
 def get_channel_cells(datasource_name, channels):
-    global datasource
-    global source
-    global ball_tree
-
     range = [0, 65536]
 
-    # Load if not loaded
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
+    ds = get_datasource(datasource_name)
 
     origId = config[datasource_name]['featureData'][0]['idField']
 
-    query_string = ''
-    for c in channels:
-        if query_string != '':
-            query_string += ' and '
-        query_string += str(range[0]) + ' < ' + c + ' < ' + str(range[1])
-    if query_string == None or query_string == "":
-        return []
-    query = datasource.query(query_string)[['id', origId]].to_dict(orient='records')
-    return query
+    if len(channels) == 0:
+        return pd.DataFrame(columns=['id', origId])
+    ids = ds.gating.gated_ids({c: range for c in channels})
+    return pd.DataFrame({'id': ids, origId: ds.frame[origId].to_numpy()[ids]})
 
 
 def get_phenotype_description(datasource):
@@ -214,15 +489,9 @@ def get_phenotype_column_name(datasource):
 
 
 def get_cells_phenotype(datasource_name):
-    global datasource
-    global source
-    global ball_tree
-
     range = [0, 65536]
 
-    # Load if not loaded
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
+    ds = get_datasource(datasource_name)
 
     try:
         id_field = config[datasource_name]['featureData'][0]['idField']
@@ -232,14 +501,12 @@ def get_cells_phenotype(datasource_name):
     except TypeError:
         phenotype_field = 'celltype'
 
-    query = datasource[['id', id_field, phenotype_field]].to_dict(orient='records')
+    query = ds.frame[['id', id_field, phenotype_field]]
     return query
 
 
 def get_phenotypes(datasource_name):
-    global datasource
-    global source
-    global config
+    ds = get_datasource(datasource_name)
     try:
         phenotype_field = config[datasource_name]['featureData'][0]['celltype']
     except KeyError:
@@ -247,56 +514,50 @@ def get_phenotypes(datasource_name):
     except TypeError:
         phenotype_field = 'celltype'
 
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
-    if phenotype_field in datasource.columns:
-        return sorted(datasource[phenotype_field].unique().tolist())
+    if phenotype_field in ds.frame.columns:
+        return sorted(ds.frame[phenotype_field].unique().tolist())
     else:
         return ['']
 
 
+def get_column_positions(frame, columns):
+    """
+    Positions of columns in frame, raises a KeyError for unknown names (get_indexer
+    returns -1 for them, which iloc would take as the last column).
+    """
+    positions = frame.columns.get_indexer(columns)
+    if (positions < 0).any():
+        raise KeyError([column for column, position in zip(columns, positions) if position < 0])
+    return positions
+
+
 def get_neighborhood(x, y, datasource_name, r=100, fields=None):
-    global database
-    global datasource
-    global source
-    global ball_tree
-    if datasource_name != source:
-        load_datasource(datasource_name)
-    index = ball_tree.query_radius([[x, y]], r=r)
-    neighbors = index[0]
+    ds = get_datasource(datasource_name)
+    neighbors = ds.spatial_index.query_radius(x, y, r)
     try:
         if fields and len(fields) > 0:
             fields.append('id') if 'id' not in fields else fields
-            if len(fields) > 1:
-                neighborhood = datasource.iloc[neighbors][fields].to_dict(orient='records')
-            else:
-                neighborhood = datasource.iloc[neighbors][fields].to_dict()
+            neighborhood = ds.frame.iloc[neighbors, get_column_positions(ds.frame, fields)]
         else:
-            neighborhood = datasource.iloc[neighbors].to_dict(orient='records')
+            neighborhood = ds.frame.iloc[neighbors]
 
         return neighborhood
     except:
-        return {}
+        return pd.DataFrame()
 
 
 def get_neighborhood_for_spat_corr(x, y, datasource_name, r=100, fields=None):
-    global database
-    global datasource
-    global source
-    global ball_tree
-    if datasource_name != source:
-        load_datasource(datasource_name)
-    index = ball_tree.query_radius([[x, y]], r=r)
-    neighbors = index[0]
+    ds = get_datasource(datasource_name)
+    neighbors = ds.spatial_index.query_radius(x, y, r)
     try:
         if fields and len(fields) > 0:
             fields.append('id') if 'id' not in fields else fields
             if len(fields) > 1:
-                neighborhood = datasource.iloc[neighbors][fields].to_dict(orient='records')
+                neighborhood = ds.frame.iloc[neighbors][fields].to_dict(orient='records')
             else:
-                neighborhood = datasource.iloc[neighbors][fields].to_dict()
+                neighborhood = ds.frame.iloc[neighbors][fields].to_dict()
         else:
-            neighborhood = datasource.iloc[neighbors].to_dict(orient='records')
+            neighborhood = ds.frame.iloc[neighbors].to_dict(orient='records')
 
         # print(datasource)
         return neighborhood
@@ -305,16 +566,9 @@ def get_neighborhood_for_spat_corr(x, y, datasource_name, r=100, fields=None):
 
 
 def get_k_results_for_spat_corr(x, y, datasource_name, r=100, channels=[], fields=None):
-    global config
-    global database
-    global datasource
-    global source
-    global ball_tree
-    if datasource_name != source:
-        load_datasource(datasource_name)
-
-    index = ball_tree.query_radius([[x, y]], r=r)
-    neighbors = index[0]
+    ds = get_datasource(datasource_name)
+
+    neighbors = ds.spatial_index.query_radius(x, y, r)
     try:
 
         # Settings, configs
@@ -324,20 +578,21 @@ def get_k_results_for_spat_corr(x, y, datasource_name, r=100, channels=[], field
         index = config[datasource_name]['featureData'][0]['idField']
 
         # Filter dataframe
-        neighborhood_df = datasource.iloc[neighbors][channels + ['id', x_coordinate, y_coordinate, index]]
-
-        # Iterate k
-        for k in range(k_range[0], k_range[1]):
-
-            # Spatial analysis
+        neighborhood_df = ds.frame.iloc[neighbors][channels + ['id', x_coordinate, y_coordinate, index]]
+
+        # Whole-slide values from the precomputed layer if there is one, otherwise
+        # spatial analysis of the lens cells for every k from a single neighbour query
+        ks = range(k_range[0], k_range[1])
+        new_data = spatial_correlation.lookup(ds.spatial_corr, neighbors, channels, ks)
+        if new_data is not None:
+            new_data = pd.DataFrame(new_data)
+        else:
             new_data = spatial_corr(adata=neighborhood_df, x_coordinate=x_coordinate, y_coordinate=y_coordinate,
-                                    index='id', channels=channels, k=k)
-            # print(new_data)
+                                    index='id', channels=channels, ks=ks)
 
-            # Update dataframe
-            for name, values in new_data.iteritems():
-                new_column = f'{name}_{k}'
-                neighborhood_df[new_column] = values
+        # Update dataframe
+        new_data.index = neighborhood_df.index
+        neighborhood_df = pd.concat([neighborhood_df, new_data], axis=1)
 
         # New neighborhood
         new_neighborhood = neighborhood_df.to_dict(orient='records')
@@ -348,15 +603,8 @@ def get_k_results_for_spat_corr(x, y, datasource_name, r=100, channels=[], field
 
 
 def get_number_of_cells_in_circle(x, y, datasource_name, r):
-    global source
-    global ball_tree
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
-    index = ball_tree.query_radius([[x, y]], r=r)
-    try:
-        return len(index[0])
-    except:
-        return 0
+    ds = get_datasource(datasource_name)
+    return ds.spatial_index.count_radius(x, y, r)
 
 
 def get_color_scheme(datasource_name, refresh, label_field='celltype'):
@@ -418,82 +666,68 @@ def get_color_scheme(datasource_name, refresh, label_field='celltype'):
     return color_scheme
 
 
-def get_rect_cells(datasource_name, rect, channels):
-    global datasource
-    global source
-    global ball_tree
-
-    # Load if not loaded
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
+def get_rect_cells(datasource_name, rect, channels, polygon=None):
+    """
+    Cells inside an axis-aligned rectangle [x, y, width, height] or, if given, inside
+    the polygon [[x, y], ...]. A three element rect [x, y, r] is a circle (legacy).
+    Only the 'id' and the requested channels columns are returned; without
+    channels every column is.
+    """
+    ds = get_datasource(datasource_name)
 
     # Query
-    index = ball_tree.query_radius([[rect[0], rect[1]]], r=rect[2])
-    print('Query size:', len(index[0]))
-    neighbors = index[0]
+    if polygon:
+        neighbors = spatial_index.query_polygon(ds.spatial_index, polygon)
+    elif len(rect) == 3:
+        neighbors = ds.spatial_index.query_radius(rect[0], rect[1], rect[2])
+    else:
+        neighbors = ds.spatial_index.query_rect(rect[0], rect[1], rect[0] + rect[2], rect[1] + rect[3])
+    print('Query size:', len(neighbors))
     try:
-        neighborhood = []
-        for neighbor in neighbors:
-            row = datasource.iloc[[neighbor]]
-            obj = row.to_dict(orient='records')[0]
-            if 'celltype' not in obj:
-                obj['celltype'] = ''
-            neighborhood.append(obj)
+        if channels:
+            columns = ['id'] + [channel for channel in channels if channel != 'id']
+            neighborhood = ds.frame.iloc[neighbors, get_column_positions(ds.frame, columns)]
+        else:
+            neighborhood = ds.frame.iloc[neighbors]
+            if 'celltype' not in neighborhood.columns:
+                neighborhood = neighborhood.assign(celltype='')
         return neighborhood
     except:
-        return {}
+        return pd.DataFrame()
 
 
 def get_gated_cells(datasource_name, gates):
-    global datasource
-    global source
-    global ball_tree
+    ds = get_datasource(datasource_name)
 
-    # Load if not loaded
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
+    if len(gates) == 0:
+        return pd.DataFrame(columns=['id'])
+    return pd.DataFrame({'id': ds.gating.gated_ids(gates)})
 
-    query_string = ''
-    for key, value in gates.items():
-        if query_string != '':
-            query_string += ' and '
-        query_string += str(value[0]) + ' < ' + key + ' < ' + str(value[1])
-    if query_string == None or query_string == "":
-        return []
-    query = datasource.query(query_string)[['id']].to_dict(orient='records')
-    return query
 
+def get_gating_cache_stats(datasource_name):
+    return get_datasource(datasource_name).gating.stats()
 
-def download_gating_csv(datasource_name, gates, channels):
-    global datasource
-    global source
-    global ball_tree
 
-    # Load if not loaded
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
+def download_gating_csv(datasource_name, gates, channels):
+    ds = get_datasource(datasource_name)
 
-    query_string = ''
     columns = []
     for key, value in gates.items():
         columns.append(key)
-        if query_string != '':
-            query_string += ' and '
-        query_string += str(value[0]) + ' < ' + key + ' < ' + str(value[1])
-    ids = datasource.query(query_string)[['id']].to_numpy().flatten()
+    passed = ds.gating.evaluate(gates)
     if 'idField' in config[datasource_name]['featureData'][0]:
         idField = config[datasource_name]['featureData'][0]['idField']
     else:
         idField = "CellID"
     columns.append(idField)
 
-    csv = datasource.copy()
+    csv = ds.frame.copy()
 
-    csv[idField] = datasource['id']
+    csv[idField] = ds.frame['id']
     for channel in channels:
         if channel in gates:
-            csv.loc[csv[idField].isin(ids), key] = 1
-            csv.loc[~csv[idField].isin(ids), key] = 0
+            csv.loc[passed, key] = 1
+            csv.loc[~passed, key] = 0
         else:
             csv[channel] = 0
 
@@ -501,13 +735,7 @@ def download_gating_csv(datasource_name, gates, channels):
 
 
 def download_gates(datasource_name, gates, channels):
-    global datasource
-    global source
-    global ball_tree
-
-    # Load if not loaded
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
+    get_datasource(datasource_name)
     arr = []
     for key, value in channels.items():
         arr.append([key, value[0], value[1]])
@@ -522,16 +750,10 @@ def download_gates(datasource_name, gates, channels):
 
 
 def get_datasource_description(datasource_name):
-    global datasource
-    global source
-    global ball_tree
-
-    # Load if not loaded
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
-    description = datasource.describe(percentiles=[.005, .01, .25, .5, .75, .95, .99, .995]).to_dict()
+    ds = get_datasource(datasource_name)
+    description = ds.frame.describe(percentiles=[.005, .01, .25, .5, .75, .95, .99, .995]).to_dict()
     for column in description:
-        col = datasource[column]
+        col = ds.frame[column]
         col = col[(col >= description[column]['1%']) & (col <= description[column]['99%'])]
         col = col.to_numpy()
         [hist, bin_edges] = np.histogram(col, bins=25, density=True)
@@ -548,9 +770,8 @@ def get_datasource_description(datasource_name):
 
 
 def spatial_corr(adata, raw=False, log=False, threshold=None, x_coordinate='X_centroid', y_coordinate='Y_centroid',
-                 marker=None, k=500, label='spatial_corr', index='id', channels=[]):
-    global ball_tree
-
+                 marker=None, k=500, label='spatial_corr', index='id', channels=[], dtype=np.float64, chunk_size=None,
+                 ks=None):
     """
     Parameters
     ----------
@@ -572,6 +793,16 @@ def spatial_corr(adata, raw=False, log=False, threshold=None, x_coordinate='X_ce
         DESCRIPTION. The default is 500.
     label : TYPE, optional
         DESCRIPTION. The default is 'spatial_corr'.
+    dtype : numpy dtype, optional
+        Precision of the standardized expression values. float32 halves the
+        memory of the gathered neighbour values. The default is float64.
+    chunk_size : int, optional
+        Number of cells processed at once. The default keeps about
+        spatial_correlation.CHUNK_ELEMENTS neighbour values in memory.
+    ks : list of int, optional
+        Computes several k from a single neighbour query at max(ks), using
+        cumulative sums along the neighbour axis; k is then ignored. The result
+        has columns '{marker}_{k}' and 'distance_{k}' for every k in ks.
     Returns
     -------
     corrfunc : TYPE
@@ -588,14 +819,10 @@ def spatial_corr(adata, raw=False, log=False, threshold=None, x_coordinate='X_ce
     # channels = [d['fullname'] for d in config[source]['imageData']][1:]
 
     # Start
-    bdata = adata.copy()
-    bdata_features = channels.copy()
-    print('Input shape', bdata[bdata_features].shape)
-    bdata_features.append(index)
-    # Create a DataFrame with the necessary information
-    data = pd.DataFrame({'x': bdata[x_coordinate], 'y': bdata[y_coordinate]})
+    print('Input shape', adata[channels].shape)
+    points = adata[[x_coordinate, y_coordinate]].to_numpy(dtype=np.float64)
     # user defined expression matrix
-    exp = pd.DataFrame(bdata[channels], index=bdata[index])
+    exp = pd.DataFrame(adata[channels].to_numpy(), index=adata[index], columns=channels)
     # log the data if needed
     if log is True:
         exp = np.log1p(exp)
@@ -608,39 +835,22 @@ def spatial_corr(adata, raw=False, log=False, threshold=None, x_coordinate='X_ce
         if isinstance(marker, str):
             marker = [marker]
         exp = exp[marker]
-    # find the nearest neighbours
-    tree = BallTree(data, leaf_size=2)
-    dist, ind = tree.query(data, k=k, return_distance=True)
-    neighbours = pd.DataFrame(ind, index=bdata[index])
-    # find the mean dist
-    rad_approx = np.mean(dist.T, axis=0)
-    # Calculate the correlation
-    mean = np.mean(exp).values
-    std = np.std(exp).values
-    A = (exp - mean) / std
-
-    def corrfunc(marker, A, neighbours, ind):
-        print('Processing ' + str(marker))
-        # Map phenotype
-        ind_values = dict(zip(list(range(len(ind))), A[marker]))  # Used for mapping
-        # Loop through (all functionized methods were very slow)
-        neigh = neighbours.copy()
-        for i in neigh.columns:
-            neigh[i] = neigh[i].dropna().map(ind_values, na_action='ignore')
-        # multiply the matrices
-        Y = neigh.T * A[marker]
-        # corrfunc = np.mean(Y, axis=1)
-        corrfunc = np.mean(Y.T, axis=1)
-        # return
-        return corrfunc
-
-    # apply function to all markers    # Create lamda function
-    r_corrfunc = lambda x: corrfunc(marker=x, A=A, neighbours=neighbours, ind=ind)
-    all_data = list(map(r_corrfunc, exp.columns))  # Apply function
-    # Merge all the results into a single dataframe
-    df = pd.concat(all_data, axis=1)
-    df.columns = exp.columns
-    df['distance'] = rad_approx
+    k_values = [k] if ks is None else list(ks)
+    A = spatial_correlation.standardize(exp.to_numpy(), dtype)
+
+    # The correlation of a cell is A[cell] * mean(A[neighbours of cell])
+    corr, rad_approx = spatial_correlation.compute(points, A, k_values, chunk_size=chunk_size)
+
+    if ks is None:
+        df = pd.DataFrame(corr[0], index=exp.index, columns=exp.columns)
+        df['distance'] = rad_approx[:, 0]
+    else:
+        columns = {}
+        for position, k_value in enumerate(k_values):
+            for i, name in enumerate(exp.columns):
+                columns[f'{name}_{k_value}'] = corr[position][:, i]
+            columns[f'distance_{k_value}'] = rad_approx[:, position]
+        df = pd.DataFrame(columns, index=exp.index)
     # add it to anndata object
     # adata.uns[label] = df
     print('Output shape', df.shape)
@@ -649,10 +859,10 @@ def spatial_corr(adata, raw=False, log=False, threshold=None, x_coordinate='X_ce
 
 
 def generate_zarr_png(datasource_name, channel, level, tile):
-    if config is None:
-        load_datasource(datasource_name)
-    global channels
-    global seg
+    if is_segmentation_channel(channel):
+        return generate_label_tile(datasource_name, level, tile)
+    ds = get_datasource(datasource_name)
+    channels = ds.channels
     [tx, ty] = tile.replace('.png', '').split('_')
     tx = int(tx)
     ty = int(ty)
@@ -661,49 +871,320 @@ def generate_zarr_png(datasource_name, channel, level, tile):
     tile_height = config[datasource_name]['tileHeight']
     ix = tx * tile_width
     iy = ty * tile_height
-    segmentation = False
-    try:
-        channel_num = int(re.match(r".*_(\d*)$", channel).groups()[0])
-    except AttributeError:
-        segmentation = True
-    if segmentation:
-        tile = seg[level][iy:iy + tile_height, ix:ix + tile_width]
-
-        tile = tile.view('uint8').reshape(tile.shape + (-1,))[..., [0, 1, 2]]
-        tile = np.append(tile, np.zeros((tile.shape[0], tile.shape[1], 1), dtype='uint8'), axis=2)
+    channel_num = int(re.match(r".*_(\d*)$", channel).groups()[0])
+    if isinstance(channels, zarr.Array):
+        tile = channels[channel_num, iy:iy + tile_height, ix:ix + tile_width]
     else:
-        if isinstance(channels, zarr.Array):
-            tile = channels[channel_num, iy:iy + tile_height, ix:ix + tile_width]
-        else:
-            tile = channels[level][channel_num, iy:iy + tile_height, ix:ix + tile_width]
-            tile = tile.astype('uint16')
+        tile = channels[level][channel_num, iy:iy + tile_height, ix:ix + tile_width]
+        tile = tile.astype('uint16')
 
     # tile = np.ascontiguousarray(tile, dtype='uint32')
     # png = tile.view('uint8').reshape(tile.shape + (-1,))[..., [2, 1, 0]]
     return tile
 
 
+def generate_label_tile(datasource_name, level, tile, encoding=tile_encoding.DEFAULT_ENCODING, labels=None):
+    """
+    Segmentation tile as RGBA, or as uint32 labels for the npy encodings (see
+    label_tiles). With labels, the digest of a set registered by
+    set_visible_labels, the other cells are cleared.
+    """
+    ds = get_datasource(datasource_name)
+    visible = None
+    if labels is not None:
+        visible = ds.label_filters.get(labels)
+        if visible is None:
+            raise KeyError('Unknown label filter ' + labels)
+    [tx, ty] = tile.replace('.png', '').split('_')
+    level = int(level)
+    tile_width = config[datasource_name]['tileWidth']
+    tile_height = config[datasource_name]['tileHeight']
+    ix = int(tx) * tile_width
+    iy = int(ty) * tile_height
+    tile = ds.seg[level][iy:iy + tile_height, ix:ix + tile_width]
+    if encoding.startswith('npy'):
+        return label_tiles.raw_labels(tile, visible)
+    return label_tiles.pack_rgba(tile, visible)
+
+
+def set_visible_labels(datasource_name, labels):
+    """
+    Registers the cell labels shown by filtered segmentation tiles, returns the
+    digest to request them with.
+    """
+    return get_datasource(datasource_name).label_filters.add(labels)
+
+
+def has_visible_labels(datasource_name, labels):
+    return get_datasource(datasource_name).label_filters.get(labels) is not None
+
+
+def generate_zarr_tiles(datasource_name, channels, level, tile):
+    """
+    Like generate_zarr_png for several channels of the same tile, returned as
+    {channel: tile}. Runs of adjacent channels are read with a single slice, so
+    the chunks of the tile are decoded once per run instead of once per channel.
+    """
+    ds = get_datasource(datasource_name)
+    tiles = {}
+    channel_nums = {}
+    for channel in channels:
+        if is_segmentation_channel(channel):
+            tiles[channel] = generate_zarr_png(datasource_name, channel, level, tile)
+        else:
+            channel_nums[channel] = int(re.match(r".*_(\d*)$", channel).groups()[0])
+    if len(channel_nums) == 0:
+        return tiles
+    [tx, ty] = tile.replace('.png', '').split('_')
+    level = int(level)
+    tile_width = config[datasource_name]['tileWidth']
+    tile_height = config[datasource_name]['tileHeight']
+    ix = int(tx) * tile_width
+    iy = int(ty) * tile_height
+    image = ds.channels if isinstance(ds.channels, zarr.Array) else ds.channels[level]
+    nums = sorted(set(channel_nums.values()))
+    runs = np.split(np.array(nums), np.flatnonzero(np.diff(nums) != 1) + 1)
+    stacks = {}
+    for run in runs:
+        stack = image[int(run[0]):int(run[-1]) + 1, iy:iy + tile_height, ix:ix + tile_width]
+        if not isinstance(ds.channels, zarr.Array):
+            stack = stack.astype('uint16')
+        for i, num in enumerate(run):
+            stacks[num] = stack[i]
+    for channel, num in channel_nums.items():
+        tiles[channel] = stacks[num]
+    return tiles
+
+
+def is_segmentation_channel(channel):
+    return re.match(r".*_(\d*)$", channel) is None
+
+
+def is_image_channel(datasource_name, channel):
+    """
+    Whether channel is the tile name (<name>_<index>) of a channel of the image.
+    """
+    match = re.match(r".*_(\d+)$", channel)
+    if match is None:
+        return False
+    ds = get_datasource(datasource_name)
+    image = ds.channels if isinstance(ds.channels, zarr.Array) else ds.channels[0]
+    return int(match.groups()[0]) < (1 if image.ndim == 2 else image.shape[0])
+
+
+def get_tile_encoding(channel, encoding):
+    """
+    The encoding used for a requested one (see tile_encoding), None if unknown.
+    """
+    return tile_encoding.resolve(encoding, rgba=is_segmentation_channel(channel))
+
+
+def get_tile_key(datasource_name, channel, level, tile, encoding=tile_encoding.DEFAULT_ENCODING, labels=None):
+    ds = get_datasource(datasource_name)
+    if labels is not None and is_segmentation_channel(channel):
+        channel = channel + '?labels=' + labels
+    return datasource_name, ds.image_token, channel, int(level), tile, encoding
+
+
+def get_tile_etag(datasource_name, channel, level, tile, encoding=tile_encoding.DEFAULT_ENCODING, labels=None):
+    return tile_cache.key_digest(get_tile_key(datasource_name, channel, level, tile, encoding, labels))
+
+
+def get_encoded_tiles(datasource_name, channels, level, tile, encodings, labels=None):
+    """
+    Encoded tiles of several channels at the same position, with encodings
+    resolved by get_tile_encoding. Channels missing from the tile cache are read
+    together (see generate_zarr_tiles), labels filters the segmentation.
+    """
+    keys = [get_tile_key(datasource_name, channel, level, tile, encoding, labels)
+            for channel, encoding in zip(channels, encodings)]
+    payloads = [encoded_tiles.get(key) for key in keys]
+    missing = [channel for channel, data in zip(channels, payloads)
+               if data is None and not is_segmentation_channel(channel)]
+    tiles = generate_zarr_tiles(datasource_name, missing, level, tile) if len(missing) > 0 else {}
+    for i, (channel, encoding, key) in enumerate(zip(channels, encodings, keys)):
+        if payloads[i] is None:
+            if is_segmentation_channel(channel):
+                array = generate_label_tile(datasource_name, level, tile, encoding, labels)
+            else:
+                array = tiles[channel]
+            payloads[i] = tile_encoding.encode(array, encoding)
+            encoded_tiles.put(key, payloads[i])
+    return payloads
+
+
+def get_encoded_tile(datasource_name, channel, level, tile, encoding=tile_encoding.DEFAULT_ENCODING, labels=None):
+    """
+    Encoded tile, served from the tile cache when it was encoded before. encoding
+    has to be resolved with get_tile_encoding, labels filters the segmentation.
+    """
+    key = get_tile_key(datasource_name, channel, level, tile, encoding, labels)
+    data = encoded_tiles.get(key)
+    if data is None:
+        if is_segmentation_channel(channel):
+            array = generate_label_tile(datasource_name, level, tile, encoding, labels)
+        else:
+            array = generate_zarr_png(datasource_name, channel, level, tile)
+        data = tile_encoding.encode(array, encoding)
+        encoded_tiles.put(key, data)
+    return data
+
+
+def get_tile_grid(datasource_name, channel, level):
+    """
+    Number of tiles (x, y) of a pyramid level, None if the level does not exist.
+    """
+    ds = get_datasource(datasource_name)
+    tile_width = config[datasource_name]['tileWidth']
+    tile_height = config[datasource_name]['tileHeight']
+    try:
+        image = get_pyramid_level(ds.seg if is_segmentation_channel(channel) else ds.channels, int(level))
+        if image is None or image.ndim < 2:
+            return None
+        return -(-image.shape[-1] // tile_width), -(-image.shape[-2] // tile_height)
+    except (KeyError, IndexError, ValueError, TypeError):
+        return None
+
+
+def get_pyramid_level(image, level):
+    """
+    A level of a multiscale group (the datasets of its multiscales attribute), or
+    a single level image (array) at level 0. None if the level does not exist.
+    """
+    if image is None:
+        return None
+    if isinstance(image, (zarr.Array, np.ndarray)):
+        return image if level == 0 else None
+    multiscales = image.attrs.get('multiscales')
+    num_levels = len(multiscales[0]['datasets']) if multiscales else len(image)
+    if not 0 <= level < num_levels:
+        return None
+    return image[level]
+
+
+def is_tile_cached(datasource_name, channel, level, tile, encoding):
+    return encoded_tiles.contains(get_tile_key(datasource_name, channel, level, tile, encoding))
+
+
+def call_resident_only(function, *args):
+    """
+    Calls function without loading datasources, NotResidentError is raised for
+    one that is not in memory.
+    """
+    resident_only.active = True
+    try:
+        return function(*args)
+    finally:
+        resident_only.active = False
+
+
+def is_prefetch_done(datasource_name, channel, level, tile, encoding):
+    """
+    Whether the prefetcher can skip a tile: it is cached or its datasource was
+    evicted since the tile was queued (prefetching never loads a datasource).
+    """
+    try:
+        return call_resident_only(is_tile_cached, datasource_name, channel, level, tile, encoding)
+    except NotResidentError:
+        return True
+
+
+def prefetch_tile(datasource_name, channel, level, tile, encoding):
+    """
+    Decodes a tile into the tile cache for the prefetcher, see is_prefetch_done.
+    """
+    try:
+        call_resident_only(get_encoded_tile, datasource_name, channel, level, tile, encoding)
+    except NotResidentError:
+        pass
+
+
+def prefetch_tiles(datasource_name, channel, level, tile, encoding=tile_encoding.DEFAULT_ENCODING):
+    """
+    Queues the neighbours of a requested tile for decoding into the tile cache.
+    """
+    tile_prefetch.request(datasource_name, channel, level, tile, encoding)
+
+
+def get_composite_key(datasource_name, layers, level, tile, encoding):
+    name = 'composite:' + json.dumps([[layer['channel'], layer['range'], layer['color']] for layer in layers])
+    return get_tile_key(datasource_name, name, level, tile, encoding)
+
+
+def get_composite_etag(datasource_name, layers, level, tile, encoding):
+    return tile_cache.key_digest(get_composite_key(datasource_name, layers, level, tile, encoding))
+
+
+def get_composite_tile(datasource_name, layers, level, tile, encoding):
+    """
+    Encoded RGB tile of the channels in layers, given as
+    [{'channel': 'channel_00_files', 'range': [lo, hi], 'color': '#ff0000'}, ...]
+    in raw image values, blended additively.
+    """
+    key = get_composite_key(datasource_name, layers, level, tile, encoding)
+    data = encoded_tiles.get(key)
+    if data is None:
+        tiles = generate_zarr_tiles(datasource_name, [layer['channel'] for layer in layers], level, tile)
+        rgb = tile_compositor.composite([(tiles[layer['channel']], layer['range'], layer['color'])
+                                         for layer in layers])
+        data = tile_encoding.encode(rgb, encoding)
+        encoded_tiles.put(key, data)
+    return data
+
+
+def get_image_reader_stats():
+    with datasources_lock:
+        resident = list(datasources.values())
+    return {ds.name: ds.reader_stats() for ds in resident}
+
+
+def get_tile_cache_stats():
+    stats = encoded_tiles.stats()
+    stats['composite_tables'] = tile_compositor.stats()
+    stats['prefetch'] = tile_prefetch.stats()
+    return stats
+
+
 def get_ome_metadata(datasource_name):
-    if config is None:
-        load_datasource(datasource_name)
-    global metadata
-    return metadata
+    return get_datasource(datasource_name).metadata
 
 
-def convertOmeTiff(filePath, channelFilePath=None, dataDirectory=None, isLabelImg=False):
+def convertOmeTiff(filePath, channelFilePath=None, dataDirectory=None, isLabelImg=False, imageFormat='tiff'):
+    """
+    With imageFormat 'zarr', images are converted to chunked multiscale zarr
+    stores in dataDirectory (see zarr_pyramid) and the store is returned as
+    channelFile or segmentation. Otherwise channels are read from the given file
+    and single-level segmentations are converted to a BigTIFF pyramid.
+    """
     channel_info = {}
     channelNames = []
+    if imageFormat == 'zarr':
+        directory = Path(dataDirectory) / (re.sub(r'\.ome|\.tiff|\.tif', '', filePath.name) + '.zarr')
+        args = {}
+        args['in_path'] = Path(filePath)
+        args['out_path'] = directory
+        args['is_mask'] = isLabelImg
+        info = zarr_pyramid.main(py_args=args)
+        if isLabelImg:
+            return {'segmentation': str(directory)}
+        channel_info.update(info)
+        channel_info['channelFile'] = str(directory)
+        for i in range(info['num_channels']):
+            channelName = re.sub(r'\.ome|\.tiff|\.tif|\.png', '', filePath.name) + "_" + str(i)
+            channelNames.append(channelName)
+        channel_info['channel_names'] = channelNames
+        return channel_info
     if isLabelImg == False:
-        channel_io = tf.TiffFile(str(filePath), is_ome=False)
-        channels = zarr.open(channel_io.series[0].aszarr())
-        if isinstance(channels, zarr.Array):
-            channel_info['maxLevel'] = 1
-            chunks = channels.chunks
-            shape = channels.shape
-        else:
-            channel_info['maxLevel'] = len(channels)
-            shape = channels[0].shape
-            chunks = (1, 1024, 1024)
+        with tf.TiffFile(str(filePath), is_ome=False) as channel_io:
+            channels = zarr.open(channel_io.series[0].aszarr())
+            if isinstance(channels, zarr.Array):
+                channel_info['maxLevel'] = 1
+                chunks = channels.chunks
+                shape = channels.shape
+            else:
+                channel_info['maxLevel'] = len(channels)
+                shape = channels[0].shape
+                chunks = (1, 1024, 1024)
         chunks = (chunks[-2], chunks[-1])
         channel_info['tileHeight'] = chunks[0]
         channel_info['tileWidth'] = chunks[1]
@@ -716,11 +1197,10 @@ def convertOmeTiff(filePath, channelFilePath=None, dataDirectory=None, isLabelIm
         channel_info['channel_names'] = channelNames
         return channel_info
     else:
-        channel_io = tf.TiffFile(str(channelFilePath), is_ome=False)
-        seg_io = tf.TiffFile(str(filePath), is_ome=False)
-        seg_zar = zarr.open(seg_io.series[0].aszarr())
-        if isinstance(seg_zar, zarr.core.Array):
-            channels = zarr.open(channel_io.series[0].aszarr())
+        # Only the structure of the segmentation is needed, the handle is closed right away
+        with tf.TiffFile(str(filePath), is_ome=False) as seg_io:
+            is_single_level = isinstance(zarr.open(seg_io.series[0].aszarr()), zarr.core.Array)
+        if is_single_level:
             directory = Path(dataDirectory + "/" + filePath.name)
             args = {}
             args['in_paths'] = [Path(filePath)]
@@ -0,0 +1,124 @@
+# Columnar on-disk cache for the single-cell feature table.
+#
+# Parsing the feature CSV of a whole slide (millions of cells) takes minutes, so
+# the parsed table is stored once as one .npy file per column next to the CSV.
+# The cache is keyed by a fingerprint of the CSV (size, mtime and a hash of its
+# head and tail) and is rebuilt transparently whenever the CSV changes.
+
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+CACHE_VERSION = 2
+CACHE_DIRECTORY = 'feature_cache'
+MANIFEST_FILE = 'manifest.json'
+# Bytes hashed from the start and the end of the CSV for the fingerprint
+FINGERPRINT_SAMPLE_SIZE = 1 << 20
+
+
+def get_cache_path(csv_path):
+    return Path(csv_path).parent / CACHE_DIRECTORY
+
+
+def fingerprint(csv_path):
+    """
+    Cheap identity of a CSV file: size, modification time and a sha1 over its
+    first and last megabyte, so the cache key does not require reading the file.
+    """
+    stat = os.stat(csv_path)
+    sha1 = hashlib.sha1()
+    with open(csv_path, 'rb') as f:
+        sha1.update(f.read(FINGERPRINT_SAMPLE_SIZE))
+        if stat.st_size > FINGERPRINT_SAMPLE_SIZE:
+            f.seek(max(FINGERPRINT_SAMPLE_SIZE, stat.st_size - FINGERPRINT_SAMPLE_SIZE))
+            sha1.update(f.read(FINGERPRINT_SAMPLE_SIZE))
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': sha1.hexdigest()}
+
+
+def read_manifest(cache_path):
+    try:
+        with open(Path(cache_path) / MANIFEST_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_valid(csv_path, cache_path=None):
+    cache_path = cache_path or get_cache_path(csv_path)
+    manifest = read_manifest(cache_path)
+    if manifest is None or manifest.get('version') != CACHE_VERSION:
+        return False
+    return manifest.get('source') == fingerprint(csv_path)
+
+
+def build(csv_path, cache_path=None):
+    """
+    Parses the CSV once and writes every column as a .npy file. Non numeric
+    columns (e.g. cell type labels) are stored as integer codes with their
+    categories kept in the manifest, as JSON values of their own type. Tables
+    with other category values are returned without caching. The manifest is
+    written last, so an interrupted build is never mistaken for a valid cache.
+    Returns the table as read back from the cache, so it is the same on every
+    load.
+    """
+    cache_path = Path(cache_path or get_cache_path(csv_path))
+    source = fingerprint(csv_path)
+    print("Building feature cache for", csv_path)
+    frame = pd.read_csv(csv_path)
+
+    tmp_path = cache_path.with_name(cache_path.name + '.tmp')
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    columns = []
+    for i, name in enumerate(frame.columns):
+        column = {'name': name, 'file': 'col_{:05d}.npy'.format(i)}
+        values = frame[name]
+        if values.dtype.kind in 'biuf':
+            np.save(tmp_path / column['file'], values.to_numpy())
+        else:
+            categorical = pd.Categorical(values)
+            column['categories'] = categorical.categories.tolist()
+            if not all(isinstance(c, (str, int, float, bool)) for c in column['categories']):
+                print("Feature cache not built, column", name, "has values that cannot be stored")
+                shutil.rmtree(tmp_path)
+                return frame
+            np.save(tmp_path / column['file'], categorical.codes)
+        columns.append(column)
+    manifest = {'version': CACHE_VERSION, 'source': source, 'rows': len(frame), 'columns': columns}
+    with open(tmp_path / MANIFEST_FILE, 'w') as f:
+        json.dump(manifest, f, indent=4)
+
+    if cache_path.exists():
+        shutil.rmtree(cache_path)
+    os.rename(tmp_path, cache_path)
+    print("Feature cache built.")
+    return read(cache_path)
+
+
+def load(csv_path, cache_path=None, rebuild=False):
+    """
+    Returns the feature table of csv_path, served from the columnar cache and
+    (re)building the cache first if it is missing or stale.
+    """
+    cache_path = Path(cache_path or get_cache_path(csv_path))
+    if rebuild or not is_valid(csv_path, cache_path):
+        return build(csv_path, cache_path)
+    return read(cache_path)
+
+
+def read(cache_path):
+    manifest = read_manifest(cache_path)
+    data = {}
+    for column in manifest['columns']:
+        values = np.load(cache_path / column['file'], mmap_mode='r')
+        if 'categories' in column:
+            data[column['name']] = pd.Categorical.from_codes(values, column['categories']).astype(object)
+        else:
+            data[column['name']] = np.array(values)
+    return pd.DataFrame(data, columns=[column['name'] for column in manifest['columns']])
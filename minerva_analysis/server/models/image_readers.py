@@ -0,0 +1,195 @@
+# Thread-local readers of pyramidal TIFF images.
+#
+# A TiffFile reads through one file handle, guarded by a lock around every seek
+# and read, so a single handle shared by all server threads serializes concurrent
+# tile reads. A ReaderPool opens one TiffFile and zarr view per thread and image
+# instead, closes all of them when the datasource is evicted, and counts the open
+# handles and the latency of chunk reads. Multiscale zarr stores written at import
+# (see zarr_pyramid) are read through the same pools, their directory store opens
+# a file per chunk, so they hold no handles.
+#
+# Requests may still hold the readers of a datasource when it is evicted. Every
+# chunk read holds the lock of its handle, so close waits for reads in progress,
+# and a read on a closed handle reopens it. Once the pool is closed, handles are
+# closed again after each read, so readers used after eviction leave none open.
+
+import hashlib
+import os
+import threading
+import time
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+
+import tifffile as tf
+import zarr
+
+from minerva_analysis.server.utils import zarr_pyramid
+
+
+def get_image_token(paths):
+    """
+    Identity of the image files (absolute path, size and modification time), part
+    of the tile cache keys so tiles of replaced images are not reused, and the
+    source of the layers built from a segmentation (cell outlines, label index).
+    """
+    sha1 = hashlib.sha1()
+    for path in paths:
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+            sha1.update('{}:{}:{}'.format(path, stat.st_size, stat.st_mtime_ns).encode('utf-8'))
+        except OSError:
+            sha1.update(str(path).encode('utf-8'))
+    return sha1.hexdigest()
+
+
+def open_labels(path):
+    """
+    The full resolution labels of a segmentation (TIFF, zarr array or multiscale
+    zarr group) for offline scans, and the TiffFile to close afterwards if any.
+    """
+    if os.path.isdir(path):
+        image = zarr.open(str(path), mode='r')
+        return (image if isinstance(image, zarr.Array) else image[0]), None
+    tiff = tf.TiffFile(str(path), is_ome=False)
+    return zarr.open(tiff.series[0].aszarr(level=0), mode='r'), tiff
+
+
+class TimedStore(MutableMapping):
+    """
+    Read-only zarr store that forwards to a tifffile store and times chunk reads.
+    tiff_file is the TiffFile of the store, None for stores without a handle.
+    """
+
+    def __init__(self, store, pool, tiff_file=None):
+        self.store = store
+        self.pool = pool
+        self.tiff_file = tiff_file
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def reading(self):
+        """
+        Holds the handle open for a read, see the module description.
+        """
+        with self.lock:
+            if self.tiff_file is not None and self.tiff_file.filehandle.closed:
+                self.tiff_file.filehandle.open()
+            try:
+                yield
+            finally:
+                if self.tiff_file is not None and self.pool.closed:
+                    self.tiff_file.filehandle.close()
+
+    def is_open(self):
+        return self.tiff_file is not None and not self.tiff_file.filehandle.closed
+
+    def close_handle(self):
+        with self.lock:
+            if self.tiff_file is not None:
+                self.tiff_file.filehandle.close()
+
+    def __getitem__(self, key):
+        if key.endswith(('.zarray', '.zgroup', '.zattrs')):
+            return self.store[key]
+        tic = time.perf_counter()
+        try:
+            with self.reading():
+                return self.store[key]
+        finally:
+            self.pool.record(time.perf_counter() - tic)
+
+    def __contains__(self, key):
+        return key in self.store
+
+    def __setitem__(self, key, value):
+        raise PermissionError('TimedStore is read-only')
+
+    def __delitem__(self, key):
+        raise PermissionError('TimedStore is read-only')
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self):
+        return len(self.store)
+
+    def close(self):
+        self.store.close()
+
+
+class ReaderPool:
+
+    def __init__(self, path, series=0):
+        self.path = str(path)
+        self.series = series
+        self.is_zarr = zarr_pyramid.is_multiscale(self.path)
+        self.local = threading.local()
+        # TimedStores of the TiffFiles of all threads
+        self.stores = []
+        self.reads = 0
+        self.read_seconds = 0.0
+        self.max_read_seconds = 0.0
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def open(self):
+        if self.is_zarr:
+            self.local.store = TimedStore(zarr.DirectoryStore(self.path), self)
+            self.local.image = zarr.open(self.local.store, mode='r')
+            return
+        tiff_file = tf.TiffFile(self.path, is_ome=False)
+        store = TimedStore(tiff_file.series[self.series].aszarr(), self, tiff_file)
+        image = zarr.open(store, mode='r')
+        with self.lock:
+            self.stores.append(store)
+        if self.closed:
+            store.close_handle()
+        self.local.store = store
+        self.local.image = image
+
+    def description(self):
+        """
+        The OME-XML of the image, None if it has none.
+        """
+        if self.is_zarr:
+            return zarr_pyramid.read_metadata(self.path)
+        if getattr(self.local, 'image', None) is None:
+            self.open()
+        with self.local.store.reading():
+            return self.local.store.tiff_file.pages[0].tags['ImageDescription'].value
+
+    def get(self):
+        """
+        The zarr array (single level) or group (pyramid) of the calling thread.
+        """
+        if getattr(self.local, 'image', None) is None:
+            self.open()
+        return self.local.image
+
+    def record(self, seconds):
+        with self.lock:
+            self.reads += 1
+            self.read_seconds += seconds
+            self.max_read_seconds = max(self.max_read_seconds, seconds)
+
+    def close(self):
+        """
+        Closes the handles of all threads, waiting for reads in progress. Readers
+        still in use afterwards reopen their handle for each read.
+        """
+        with self.lock:
+            self.closed = True
+            stores = list(self.stores)
+        for store in stores:
+            store.close_handle()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'path': self.path,
+                'open_handles': sum(store.is_open() for store in self.stores),
+                'reads': self.reads,
+                'mean_read_ms': self.read_seconds / self.reads * 1000 if self.reads else 0.0,
+                'max_read_ms': self.max_read_seconds * 1000
+            }
@@ -0,0 +1,238 @@
+# Index of the cells of a segmentation mask by label.
+#
+# One pass over the full resolution labels, tile by tile in worker processes,
+# collects the bounding box, pixel area and centroid of every label. Statistics of
+# the same label in different tiles are merged by min / max / sum, so cells
+# crossing tile borders need no special handling. The index is stored next to the
+# feature cache:
+#   <datasource>/label_index/labels.npy     uint32 (cells,), sorted
+#   <datasource>/label_index/bounds.npy     int32 (cells, 4), x0, y0, x1, y1 (exclusive)
+#   <datasource>/label_index/areas.npy      int64 (cells,), pixels
+#   <datasource>/label_index/centroids.npy  float64 (cells, 2), x, y
+#   <datasource>/label_index/positions.npy  int32 (largest label + 1,), row of each label or -1
+#   <datasource>/label_index/manifest.json  source fingerprint, image size and cell count
+# positions makes a lookup by label a single array access; it is left out when the
+# largest label is far above the cell count, lookups then bisect labels.
+#
+# Usage: python -m minerva_analysis.server.models.label_index --labels mask.ome.tif \
+#            --out minerva_analysis/data/<datasource>/label_index
+
+import argparse
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from scipy import ndimage
+
+from minerva_analysis.server.models import image_readers
+
+LAYER_VERSION = 1
+LAYER_DIRECTORY = 'label_index'
+MANIFEST_FILE = 'manifest.json'
+TILE_SIZE = 2048
+# positions is written if the largest label is at most this many times the number of cells (and 2 ** 28)
+MAX_POSITIONS_RATIO = 16
+MAX_POSITIONS = 2 ** 28
+
+# Label image of the worker processes, set by init_worker
+worker_state = {}
+
+
+def scan_tile(labels, origin):
+    """
+    Statistics of the labels of a tile at origin (y, x): labels, bounds (x0, y0,
+    x1, y1), areas and coordinate sums (x, y), without the background 0.
+    """
+    oy, ox = origin
+    ids, inverse = np.unique(labels, return_inverse=True)
+    inverse = inverse.reshape(labels.shape)
+    areas = np.bincount(inverse.ravel(), minlength=len(ids))
+    sum_y = np.bincount(inverse.ravel(), weights=np.repeat(np.arange(labels.shape[0]), labels.shape[1]),
+                        minlength=len(ids))
+    sum_x = np.bincount(inverse.ravel(), weights=np.tile(np.arange(labels.shape[1]), labels.shape[0]),
+                        minlength=len(ids))
+    bounds = np.array([(xs.start, ys.start, xs.stop, ys.stop) for ys, xs in ndimage.find_objects(inverse + 1)],
+                      dtype=np.int64).reshape(-1, 4) + np.array([ox, oy, ox, oy])
+    sums = np.stack([sum_x + ox * areas, sum_y + oy * areas], axis=1)
+    foreground = ids != 0
+    return ids[foreground], bounds[foreground], areas[foreground], sums[foreground]
+
+
+def init_worker(path, tile_size):
+    worker_state['labels'], worker_state['tiff'] = image_readers.open_labels(path)
+    worker_state['tile_size'] = tile_size
+
+
+def scan_worker_tile(origin):
+    oy, ox = origin
+    tile_size = worker_state['tile_size']
+    tile = worker_state['labels'][oy:oy + tile_size, ox:ox + tile_size]
+    if tile.dtype == np.int32:
+        tile = tile.view('uint32')
+    return scan_tile(tile, origin)
+
+
+def merge(ids, bounds, areas, sums):
+    """
+    Merges the statistics of labels seen in several tiles, returns them sorted by
+    label.
+    """
+    order = np.argsort(ids, kind='stable')
+    ids, bounds, areas, sums = ids[order], bounds[order], areas[order], sums[order]
+    starts = np.flatnonzero(np.concatenate([[True], ids[1:] != ids[:-1]])) if len(ids) > 0 else np.zeros(0, int)
+    if len(starts) == 0:
+        return ids, bounds.astype(np.int32), areas.astype(np.int64), sums.astype(np.float64)
+    merged_bounds = np.concatenate([np.minimum.reduceat(bounds[:, :2], starts),
+                                    np.maximum.reduceat(bounds[:, 2:], starts)], axis=1)
+    merged_areas = np.add.reduceat(areas, starts)
+    merged_sums = np.add.reduceat(sums, starts)
+    return ids[starts], merged_bounds.astype(np.int32), merged_areas.astype(np.int64), merged_sums
+
+
+def get_layer_path(datasource_directory):
+    return Path(datasource_directory) / LAYER_DIRECTORY
+
+
+def read_manifest(path):
+    try:
+        with open(Path(path) / MANIFEST_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def build(path, labels_path, source, tile_size=TILE_SIZE, n_workers=None):
+    """
+    Scans the segmentation at labels_path and writes the index to path. source
+    is the fingerprint of the segmentation the index belongs to. The index is
+    written to a temporary directory that is renamed into place once complete.
+    """
+    path = Path(path)
+    n_workers = n_workers or os.cpu_count() or 1
+    image, tiff = image_readers.open_labels(labels_path)
+    shape = image.shape[-2:]
+    if tiff is not None:
+        tiff.close()
+    origins = [(y, x) for y in range(0, shape[0], tile_size) for x in range(0, shape[1], tile_size)]
+    print("Indexing the labels of a {} x {} segmentation in {} tiles, {} workers".format(
+        shape[1], shape[0], len(origins), n_workers))
+    results = []
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker,
+                             initargs=(str(labels_path), tile_size)) as executor:
+        for i, result in enumerate(executor.map(scan_worker_tile, origins)):
+            results.append(result)
+            if (i + 1) % max(1, len(origins) // 20) == 0 or i + 1 == len(origins):
+                print("Label index: {}/{} tiles".format(i + 1, len(origins)))
+    labels, bounds, areas, sums = merge(*[np.concatenate(column) for column in zip(*results)])
+    centroids = sums / areas[:, np.newaxis] if len(labels) > 0 else np.zeros((0, 2))
+
+    tmp_path = path.with_name(path.name + '.tmp')
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    np.save(tmp_path / 'labels.npy', labels.astype(np.uint32))
+    np.save(tmp_path / 'bounds.npy', bounds)
+    np.save(tmp_path / 'areas.npy', areas)
+    np.save(tmp_path / 'centroids.npy', centroids)
+    max_label = int(labels[-1]) if len(labels) > 0 else 0
+    has_positions = max_label < min(MAX_POSITIONS, MAX_POSITIONS_RATIO * max(len(labels), 1024))
+    if has_positions:
+        positions = np.lib.format.open_memmap(tmp_path / 'positions.npy', mode='w+', dtype=np.int32,
+                                              shape=(max_label + 1,))
+        positions[:] = -1
+        positions[labels] = np.arange(len(labels), dtype=np.int32)
+        positions.flush()
+        del positions
+    manifest = {'version': LAYER_VERSION, 'source': source, 'width': int(shape[1]), 'height': int(shape[0]),
+                'cells': len(labels), 'max_label': max_label, 'has_positions': bool(has_positions)}
+    with open(tmp_path / MANIFEST_FILE, 'w') as f:
+        json.dump(manifest, f, indent=4)
+
+    if path.exists():
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    print("Label index built, {} cells.".format(len(labels)))
+
+
+def load(path, source):
+    """
+    Memory maps the index at path, or returns None if it is missing or was built
+    for another segmentation.
+    """
+    path = Path(path)
+    manifest = read_manifest(path)
+    if manifest is None or manifest.get('version') != LAYER_VERSION or manifest.get('source') != source:
+        return None
+    for name in ['labels', 'bounds', 'areas', 'centroids'] + (['positions'] if manifest['has_positions'] else []):
+        manifest[name] = np.load(path / (name + '.npy'), mmap_mode='r')
+    return manifest
+
+
+def find(index, labels):
+    """
+    Rows of the index of labels, -1 for labels not in the mask.
+    """
+    labels = np.asarray(labels, dtype=np.int64).reshape(-1)
+    if 'positions' in index:
+        positions = index['positions']
+        inside = (labels >= 0) & (labels < len(positions))
+        rows = np.full(len(labels), -1, dtype=np.int64)
+        rows[inside] = positions[labels[inside]]
+        return rows
+    if len(index['labels']) == 0:
+        return np.full(len(labels), -1, dtype=np.int64)
+    rows = np.minimum(np.searchsorted(index['labels'], labels), len(index['labels']) - 1)
+    return np.where(index['labels'][rows] == labels, rows, -1)
+
+
+def lookup(index, labels):
+    """
+    Bounds, area and centroid of each of labels as a list of dicts, None for
+    labels not in the mask.
+    """
+    result = []
+    for label, row in zip(np.asarray(labels).reshape(-1), find(index, labels)):
+        if row < 0:
+            result.append(None)
+            continue
+        x0, y0, x1, y1 = (int(value) for value in index['bounds'][row])
+        cx, cy = (float(value) for value in index['centroids'][row])
+        result.append({'id': int(label), 'bounds': [x0, y0, x1, y1], 'area': int(index['areas'][row]),
+                       'centroid': [cx, cy]})
+    return result
+
+
+def validate(index, ids, sample=20):
+    """
+    Compares the cell ids of the feature table with the labels of the mask.
+    """
+    ids = np.unique(np.asarray(ids, dtype=np.int64))
+    missing_in_mask = ids[find(index, ids) < 0]
+    labels = np.asarray(index['labels'], dtype=np.int64)
+    missing_in_table = labels[~np.isin(labels, ids)]
+    return {
+        'table_cells': int(len(ids)),
+        'mask_cells': int(len(labels)),
+        'missing_in_mask': int(len(missing_in_mask)),
+        'missing_in_table': int(len(missing_in_table)),
+        'missing_in_mask_sample': missing_in_mask[:sample].tolist(),
+        'missing_in_table_sample': missing_in_table[:sample].tolist(),
+        'valid': len(missing_in_mask) == 0
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Builds the label index of a segmentation mask")
+    parser.add_argument('--labels', required=True, help="Segmentation (TIFF or zarr)")
+    parser.add_argument('--out', required=True, help="Index directory, <datasource directory>/" + LAYER_DIRECTORY)
+    parser.add_argument('--workers', type=int, help="Worker processes (default: all cores)")
+    args = parser.parse_args(argv)
+    # The source the server checks when loading the index
+    build(args.out, args.labels, image_readers.get_image_token([args.labels]), n_workers=args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# Tiles of the segmentation mask.
+#
+# The viewer decodes a segmentation tile as RGBA with the low 24 bits of the cell
+# label in R (lowest byte), G and B and alpha 0. These bytes are the little-endian
+# uint32 labels with the top byte cleared, so a tile is packed by one masked write
+# of the labels into a preallocated RGBA buffer viewed as uint32. Clients reading
+# npy encodings get the uint32 labels themselves.
+#
+# Tiles can be restricted to a set of visible cells: the set is registered once
+# per datasource (LabelFilters) and referenced by its digest in tile requests, so
+# tiles of equal sets share cache entries and ETags. Other labels are set to 0,
+# the background. Sets are kept as boolean lookup tables indexed by label, or as
+# sorted label arrays when the largest label would make the table too big.
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+RGB_MASK = 0xFFFFFF
+# Largest label for which a set is stored as a lookup table (one byte per label)
+MAX_LOOKUP_LABEL = 2 ** 24
+
+
+def is_visible(labels, visible):
+    """
+    Boolean mask of labels contained in visible, a boolean lookup table or a
+    sorted uint32 array.
+    """
+    if len(visible) == 0:
+        return np.zeros(labels.shape, dtype=bool)
+    if visible.dtype == bool:
+        return np.take(visible, labels, mode='clip') & (labels < len(visible))
+    positions = np.searchsorted(visible, labels)
+    np.minimum(positions, len(visible) - 1, out=positions)
+    return visible[positions] == labels
+
+
+def pack_rgba(labels, visible=None):
+    """
+    (h, w, 4) uint8 RGBA tile of a (h, w) label tile, see the module description.
+    """
+    labels = labels.view('uint32') if labels.dtype == np.int32 else labels
+    rgba = np.empty(labels.shape + (4,), dtype=np.uint8)
+    packed = rgba.view('<u4').reshape(labels.shape)
+    np.bitwise_and(labels, RGB_MASK, out=packed, casting='unsafe')
+    if visible is not None:
+        packed[~is_visible(labels, visible)] = 0
+    return rgba
+
+
+def raw_labels(labels, visible=None):
+    """
+    uint32 labels of a label tile, labels not in visible set to 0.
+    """
+    labels = labels.view('uint32') if labels.dtype == np.int32 else labels
+    if visible is not None:
+        labels = np.where(is_visible(labels, visible), labels, 0).astype(labels.dtype, copy=False)
+    return labels
+
+
+class LabelFilters:
+
+    def __init__(self, max_filters=16):
+        self.max_filters = max_filters
+        # digest -> lookup table or sorted labels (see is_visible), least recently used first
+        self.filters = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, labels):
+        """
+        Registers a set of visible labels and returns its digest.
+        """
+        labels = np.unique(np.asarray(labels, dtype=np.int64)).astype(np.uint32)
+        digest = hashlib.sha1(labels.tobytes()).hexdigest()[:16]
+        if len(labels) > 0 and labels[-1] < MAX_LOOKUP_LABEL:
+            lookup = np.zeros(int(labels[-1]) + 1, dtype=bool)
+            lookup[labels] = True
+            labels = lookup
+        with self.lock:
+            self.filters[digest] = labels
+            self.filters.move_to_end(digest)
+            while len(self.filters) > self.max_filters:
+                self.filters.popitem(last=False)
+        return digest
+
+    def get(self, digest):
+        """
+        The set registered as digest, None if unknown (or evicted).
+        """
+        with self.lock:
+            labels = self.filters.get(digest)
+            if labels is not None:
+                self.filters.move_to_end(digest)
+            return labels
+
+    def nbytes(self):
+        with self.lock:
+            return sum(labels.nbytes for labels in self.filters.values())
@@ -0,0 +1,139 @@
+# Working set of the histogram similarity search (analytics/comparison).
+#
+# The search reads the viewport of each selected channel at one pyramid level and
+# reduces it to 8 bit intensities, whose top 4 bits are the 16 histogram bins of
+# calc_sim. Integers are scaled by their dtype range to 8 bits as by img_as_ubyte
+# (uint16 values are shifted right by 8 bits). Unlike img_as_ubyte, quantize does
+# not depend on the values of the section, so every block of a plane is converted
+# the same way.
+#
+# Several channels are combined by the mean of their 8 bit values (combine). The
+# search used to average the raw values and convert the mean, the combined
+# intensities can therefore differ by one 8 bit step (uint16: floor(mean(v >> 8))
+# instead of floor(mean(v)) >> 8), and no longer wrap around when the sum of the
+# raw values overflowed.
+#
+# SimilarityCache keeps the uint8 planes per (channel, level), filled lazily in
+# blocks of block_size pixels: a search reads and converts only the blocks of its
+# viewport that are not cached yet, so
+# repeated searches on the same viewport and channels do no I/O or conversion.
+# Planes are allocated zeroed, memory is only committed for the blocks filled.
+# The cache belongs to the datasource and is shared by all request threads;
+# planes are evicted least recently used first beyond max_bytes.
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from skimage.util import img_as_ubyte
+
+BLOCK_SIZE = 1024
+
+
+def quantize(section):
+    """
+    uint8 intensities of a channel section, see the module description.
+    """
+    section = np.asarray(section)
+    if section.dtype.kind == 'u' and section.dtype.itemsize > 1:
+        return np.right_shift(section, 8 * section.dtype.itemsize - 8).astype(np.uint8)
+    if section.dtype.kind == 'i' and section.dtype.itemsize > 1:
+        return np.right_shift(np.maximum(section, 0), 8 * section.dtype.itemsize - 9).astype(np.uint8)
+    return img_as_ubyte(section)
+
+
+def combine(sections):
+    """
+    uint8 mean (rounded down) of uint8 channel sections of the same shape.
+    """
+    total = np.zeros(sections[0].shape, dtype=np.uint16)
+    for section in sections:
+        total += section
+    return (total // len(sections)).astype(np.uint8)
+
+
+class QuantizedPlane:
+
+    def __init__(self, shape, block_size):
+        self.block_size = block_size
+        self.pixels = np.zeros(shape, dtype=np.uint8)
+        self.filled = np.zeros((-(-shape[0] // block_size), -(-shape[1] // block_size)), dtype=bool)
+        self.lock = threading.Lock()
+
+    def nbytes(self):
+        return int(self.filled.sum()) * self.block_size ** 2
+
+    def fill(self, image, channel, rows, cols):
+        """
+        Reads and converts the bounding box of the blocks missing in the pixel
+        ranges rows and cols (start, stop) of the plane, if any.
+        """
+        b = self.block_size
+        by0, by1 = rows[0] // b, -(-rows[1] // b)
+        bx0, bx1 = cols[0] // b, -(-cols[1] // b)
+        missing = np.argwhere(~self.filled[by0:by1, bx0:bx1])
+        if len(missing) == 0:
+            return
+        (my0, mx0), (my1, mx1) = missing.min(axis=0) + (by0, bx0), missing.max(axis=0) + (by0 + 1, bx0 + 1)
+        y0, y1, x0, x1 = my0 * b, min(my1 * b, self.pixels.shape[0]), mx0 * b, min(mx1 * b, self.pixels.shape[1])
+        if image.ndim == 2:
+            section = image[y0:y1, x0:x1]
+        else:
+            section = image[channel, y0:y1, x0:x1]
+        self.pixels[y0:y1, x0:x1] = quantize(section)
+        self.filled[my0:my1, mx0:mx1] = True
+
+
+class SimilarityCache:
+
+    def __init__(self, max_bytes, block_size=BLOCK_SIZE):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        # (channel, level) -> QuantizedPlane, least recently used first
+        self.planes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_plane(self, channel, level, shape):
+        with self.lock:
+            key = (channel, level)
+            plane = self.planes.get(key)
+            if plane is None or plane.pixels.shape != tuple(shape):
+                plane = QuantizedPlane(tuple(shape), self.block_size)
+                self.planes[key] = plane
+            self.planes.move_to_end(key)
+            return plane
+
+    def get_section(self, image, channel, level, viewport):
+        """
+        uint8 section [x0, y0, x1, y1] (layer pixels, sliced like a numpy array)
+        of channel of image, the array of pyramid level level.
+        """
+        shape = image.shape[-2:]
+        plane = self.get_plane(channel, level, shape)
+        y0, y1, _ = slice(viewport[1], viewport[3]).indices(shape[0])
+        x0, x1, _ = slice(viewport[0], viewport[2]).indices(shape[1])
+        y1, x1 = max(y0, y1), max(x0, x1)
+        if y1 > y0 and x1 > x0:
+            with plane.lock:
+                plane.fill(image, channel, (y0, y1), (x0, x1))
+            self.evict(plane)
+        section = plane.pixels[y0:y1, x0:x1]
+        section.flags.writeable = False
+        return section
+
+    def evict(self, keep):
+        with self.lock:
+            size = self.nbytes_locked()
+            for key in list(self.planes):
+                if size <= self.max_bytes:
+                    break
+                if self.planes[key] is not keep:
+                    size -= self.planes.pop(key).nbytes()
+
+    def nbytes_locked(self):
+        return sum(plane.nbytes() for plane in self.planes.values())
+
+    def nbytes(self):
+        with self.lock:
+            return self.nbytes_locked()
+
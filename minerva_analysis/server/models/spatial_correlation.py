@@ -0,0 +1,232 @@
+# Neighbourhood spatial correlation of markers.
+#
+# The correlation of a cell for a marker is its standardized expression times the
+# mean standardized expression of its k nearest neighbours. Cells are processed in
+# chunks so the gathered (cells, k, markers) neighbour values stay bounded, and
+# several k are computed from a single neighbour query through prefix sums along
+# the neighbour axis.
+#
+# For whole slides the correlation of every cell for the k offered by the lens is
+# computed once, offline and in worker processes, and stored as a memory-mapped
+# layer next to the feature cache:
+#   <datasource>/spatial_corr/correlation.npy  float32 (len(k_values), cells, markers)
+#   <datasource>/spatial_corr/distance.npy     float32 (cells, len(k_values)), mean neighbour distance
+#   <datasource>/spatial_corr/manifest.json    source fingerprint, coordinates, markers and k values
+#
+# Usage: python -m minerva_analysis.server.models.spatial_correlation --csv cells.csv --channels CD3 CD8 \
+#            --out minerva_analysis/data/<datasource>/spatial_corr
+
+import argparse
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+LAYER_VERSION = 1
+LAYER_DIRECTORY = 'spatial_corr'
+MANIFEST_FILE = 'manifest.json'
+# k values of the lens (see get_k_results_for_spat_corr)
+K_VALUES = list(range(1, 11))
+# Number of gathered neighbour values (cells x k x markers) held at once per process
+CHUNK_ELEMENTS = 2 ** 24
+
+# Tree and standardized values of the worker processes, set by init_worker
+worker_state = {}
+
+
+def standardize(values, dtype=np.float64):
+    """
+    Per marker z-scores (population std, skipping NaNs like pandas).
+    """
+    values = np.asarray(values, dtype=np.float64)
+    return ((values - np.nanmean(values, axis=0)) / np.nanstd(values, axis=0)).astype(dtype)
+
+
+def get_chunk_size(k_max, n_markers):
+    return max(1, CHUNK_ELEMENTS // (k_max * max(1, n_markers)))
+
+
+def neighbour_correlation(tree, A, points, chunk, k_values):
+    """
+    Correlation (len(k_values), cells, markers) and mean neighbour distance
+    (cells, len(k_values)) of the cells in the slice chunk.
+    """
+    k_max = max(k_values)
+    dist, ind = tree.query(points[chunk], k=k_max)
+    if k_max == 1:
+        dist, ind = dist[:, np.newaxis], ind[:, np.newaxis]
+    neighbour_values = A[ind]
+    has_nan = np.isnan(neighbour_values).any()
+    if len(k_values) == 1:
+        mean = np.nanmean if has_nan else np.mean
+        correlation = (mean(neighbour_values, axis=1) * A[chunk])[np.newaxis]
+        return correlation, np.mean(dist, axis=1)[:, np.newaxis]
+    # Prefix sums along the neighbour axis give the mean over the first k neighbours for every k
+    positions = np.asarray(k_values) - 1
+    distance = np.cumsum(dist, axis=1)[:, positions] / np.asarray(k_values)
+    if has_nan:
+        valid = ~np.isnan(neighbour_values)
+        sums = np.cumsum(np.where(valid, neighbour_values, 0), axis=1)
+        counts = np.cumsum(valid, axis=1)[:, positions]
+    else:
+        sums = np.cumsum(neighbour_values, axis=1)
+        counts = np.asarray(k_values)[:, np.newaxis]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        correlation = sums[:, positions] / counts * A[chunk][:, np.newaxis]
+    return correlation.transpose(1, 0, 2), distance
+
+
+def init_worker(points, A, k_values):
+    worker_state['tree'] = cKDTree(points)
+    worker_state['points'] = points
+    worker_state['A'] = A
+    worker_state['k_values'] = k_values
+
+
+def compute_chunk(start, stop):
+    chunk = slice(start, stop)
+    return chunk, neighbour_correlation(worker_state['tree'], worker_state['A'], worker_state['points'], chunk,
+                                        worker_state['k_values'])
+
+
+def compute(points, A, k_values, chunk_size=None, n_workers=1, correlation=None, distance=None):
+    """
+    Fills (and returns) correlation (len(k_values), cells, markers) and distance
+    (cells, len(k_values)) for all cells. With n_workers > 1 the chunks are
+    processed by a pool of worker processes. The output arrays may be memory
+    maps, so whole-slide results never have to be resident at once.
+    """
+    points = np.ascontiguousarray(points, dtype=np.float64)
+    k_values = list(k_values)
+    if max(k_values) > len(points):
+        raise ValueError('k={} is larger than the number of cells ({})'.format(max(k_values), len(points)))
+    if correlation is None:
+        correlation = np.empty((len(k_values),) + A.shape, dtype=A.dtype)
+    if distance is None:
+        distance = np.empty((len(points), len(k_values)))
+    chunk_size = chunk_size or get_chunk_size(max(k_values), A.shape[1])
+    starts = range(0, len(points), chunk_size)
+    if n_workers == 1:
+        tree = cKDTree(points)
+        for start in starts:
+            chunk = slice(start, start + chunk_size)
+            correlation[:, chunk], distance[chunk] = neighbour_correlation(tree, A, points, chunk, k_values)
+        return correlation, distance
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker,
+                             initargs=(points, A, k_values)) as executor:
+        futures = [executor.submit(compute_chunk, start, start + chunk_size) for start in starts]
+        for i, future in enumerate(futures):
+            chunk, (chunk_correlation, chunk_distance) = future.result()
+            correlation[:, chunk] = chunk_correlation
+            distance[chunk] = chunk_distance
+            if (i + 1) % max(1, len(futures) // 20) == 0 or i + 1 == len(futures):
+                print("Spatial correlation: {}/{} chunks".format(i + 1, len(futures)))
+    return correlation, distance
+
+
+def get_layer_path(datasource_directory):
+    return Path(datasource_directory) / LAYER_DIRECTORY
+
+
+def read_manifest(path):
+    try:
+        with open(Path(path) / MANIFEST_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def build(path, frame, x_coordinate, y_coordinate, channels, source, k_values=K_VALUES, n_workers=None):
+    """
+    Computes the whole-slide layer of frame and writes it to path. source is the
+    fingerprint of the feature table the layer belongs to. The manifest is
+    written last and the directory renamed into place, so an interrupted build
+    is never mistaken for a valid layer.
+    """
+    path = Path(path)
+    k_values = list(k_values)
+    n_workers = n_workers or os.cpu_count() or 1
+    print("Building spatial correlation layer for {} cells, {} markers, {} workers".format(
+        len(frame), len(channels), n_workers))
+    points = frame[[x_coordinate, y_coordinate]].to_numpy(dtype=np.float64)
+    A = standardize(frame[channels].to_numpy(), np.float32)
+
+    tmp_path = path.with_name(path.name + '.tmp')
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    correlation = np.lib.format.open_memmap(tmp_path / 'correlation.npy', mode='w+', dtype=np.float32,
+                                            shape=(len(k_values),) + A.shape)
+    distance = np.lib.format.open_memmap(tmp_path / 'distance.npy', mode='w+', dtype=np.float32,
+                                         shape=(len(points), len(k_values)))
+    compute(points, A, k_values, n_workers=n_workers, correlation=correlation, distance=distance)
+    correlation.flush()
+    distance.flush()
+    del correlation, distance
+    manifest = {'version': LAYER_VERSION, 'source': source, 'xCoordinate': x_coordinate,
+                'yCoordinate': y_coordinate, 'channels': list(channels), 'k_values': k_values, 'rows': len(frame)}
+    with open(tmp_path / MANIFEST_FILE, 'w') as f:
+        json.dump(manifest, f, indent=4)
+
+    if path.exists():
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    print("Spatial correlation layer built.")
+
+
+def load(path, source, rows):
+    """
+    Memory maps the layer at path, or returns None if it is missing or was built
+    for another feature table.
+    """
+    path = Path(path)
+    manifest = read_manifest(path)
+    if manifest is None or manifest.get('version') != LAYER_VERSION or manifest.get('source') != source or \
+            manifest.get('rows') != rows:
+        return None
+    manifest['correlation'] = np.load(path / 'correlation.npy', mmap_mode='r')
+    manifest['distance'] = np.load(path / 'distance.npy', mmap_mode='r')
+    return manifest
+
+
+def lookup(layer, indices, channels, k_values):
+    """
+    Correlation columns '{marker}_{k}' and 'distance_{k}' of the cells at indices,
+    in the order of spatial_corr(..., ks=k_values). Returns None if the layer does
+    not cover all channels and k values.
+    """
+    if layer is None or not set(channels) <= set(layer['channels']) or \
+            not set(k_values) <= set(layer['k_values']):
+        return None
+    markers = [layer['channels'].index(channel) for channel in channels]
+    columns = {}
+    for k in k_values:
+        position = layer['k_values'].index(k)
+        values = layer['correlation'][position][indices][:, markers]
+        for i, channel in enumerate(channels):
+            columns[f'{channel}_{k}'] = values[:, i]
+        columns[f'distance_{k}'] = layer['distance'][indices, position]
+    return columns
+
+
+def main():
+    from minerva_analysis.server.models import feature_cache
+
+    parser = argparse.ArgumentParser(description="Builds the whole-slide spatial correlation layer of a feature table")
+    parser.add_argument('--csv', required=True, help="Feature table")
+    parser.add_argument('--channels', nargs='+', required=True, help="Marker columns")
+    parser.add_argument('--out', required=True, help="Layer directory, <datasource directory>/" + LAYER_DIRECTORY)
+    parser.add_argument('--x', default='X_centroid', help="x coordinate column")
+    parser.add_argument('--y', default='Y_centroid', help="y coordinate column")
+    parser.add_argument('--workers', type=int, help="Worker processes (default: all cores)")
+    args = parser.parse_args()
+    frame = feature_cache.load(args.csv).replace(-np.inf, 0)
+    build(args.out, frame, args.x, args.y, args.channels, feature_cache.fingerprint(args.csv), n_workers=args.workers)
+
+
+if __name__ == '__main__':
+    main()
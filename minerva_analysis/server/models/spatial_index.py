@@ -0,0 +1,418 @@
+# Spatial indexes over the cell centroids and their versioned on-disk persistence.
+#
+# Centroids are plain 2D Euclidean points, so besides the general purpose
+# BallTree there are two 2D specialized backends: a scipy cKDTree and a uniform
+# grid that buckets points by cell. All backends expose the same small query API
+# and are selected with app.config['SPATIAL_INDEX_BACKEND']; see
+# utils/benchmarks.py for a comparison at the radii used by the lenses.
+#
+# An index is stored as a directory holding a header.json and one .npy file per
+# array. Arrays are memory mapped on load, so opening an index of millions of
+# cells costs almost nothing, and the header records what the index was built
+# from (backend, feature table fingerprint, coordinate columns, library version).
+# The trees are persisted with their nodes (the arrays of their pickle state), so
+# loading does not rebuild them: for 2M cells restoring the cKDTree takes ~0.02s,
+# rebuilding it ~2.7s.
+# An index whose header does not match the current datasource is never used;
+# the caller rebuilds it instead.
+
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import scipy
+import sklearn
+from scipy.spatial import cKDTree
+from skimage import measure
+from sklearn.neighbors import BallTree
+
+INDEX_VERSION = 3
+INDEX_DIRECTORY = 'spatial_index'
+HEADER_FILE = 'header.json'
+
+
+class BallTreeIndex:
+    kind = 'ball_tree'
+    library_version = sklearn.__version__
+
+    def __init__(self, tree):
+        self.tree = tree
+
+    @classmethod
+    def build(cls, points):
+        return cls(BallTree(points, metric='euclidean'))
+
+    def query_nearest(self, x, y):
+        distance, index = self.tree.query([[x, y]], k=1)
+        return distance[0][0], index[0][0]
+
+    def query_radius(self, x, y, r):
+        return self.tree.query_radius([[x, y]], r=r)[0]
+
+    def count_radius(self, x, y, r):
+        return int(self.tree.query_radius([[x, y]], r=r, count_only=True)[0])
+
+    def query_rect(self, x0, y0, x1, y1):
+        # Circumscribed circle, then the exact bounds
+        r = np.hypot(x1 - x0, y1 - y0) / 2
+        candidates = self.query_radius((x0 + x1) / 2, (y0 + y1) / 2, r)
+        return np.sort(candidates[in_rect(self.get_points(candidates), x0, y0, x1, y1)])
+
+    def get_points(self, indices):
+        return np.asarray(self.tree.data)[indices]
+
+    def nbytes(self):
+        return sum(arr.nbytes for arr in self.tree.get_arrays())
+
+    def get_state(self):
+        return split_state(self.tree.__getstate__())
+
+    @classmethod
+    def from_state(cls, arrays, params):
+        state = join_state(arrays, params, BallTree(np.zeros((1, 2)), metric='euclidean').__getstate__())
+        if state is None:
+            return None
+        tree = BallTree.__new__(BallTree)
+        tree.__setstate__(state)
+        return cls(tree)
+
+
+class KDTreeIndex:
+    kind = 'kd_tree'
+    library_version = scipy.__version__
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.points = tree.data
+
+    @classmethod
+    def build(cls, points):
+        return cls(cKDTree(points, balanced_tree=False, copy_data=False))
+
+    def query_nearest(self, x, y):
+        distance, index = self.tree.query([x, y], k=1)
+        return distance, index
+
+    def query_radius(self, x, y, r):
+        return np.asarray(self.tree.query_ball_point([x, y], r), dtype=np.intp)
+
+    def count_radius(self, x, y, r):
+        return int(self.tree.query_ball_point([x, y], r, return_length=True))
+
+    def query_rect(self, x0, y0, x1, y1):
+        # Circumscribed circle (Chebyshev ball of the half extent), then the exact bounds
+        r = max(x1 - x0, y1 - y0) / 2
+        candidates = np.asarray(self.tree.query_ball_point([(x0 + x1) / 2, (y0 + y1) / 2], r, p=np.inf),
+                                dtype=np.intp)
+        return np.sort(candidates[in_rect(self.get_points(candidates), x0, y0, x1, y1)])
+
+    def get_points(self, indices):
+        return self.points[indices]
+
+    def nbytes(self):
+        # The tree nodes are roughly as large as the points themselves
+        return 2 * self.points.nbytes
+
+    def get_state(self):
+        return split_state(self.tree.__getstate__())
+
+    @classmethod
+    def from_state(cls, arrays, params):
+        state = join_state(arrays, params, cKDTree(np.zeros((1, 2))).__getstate__())
+        if state is None:
+            return None
+        tree = cKDTree.__new__(cKDTree)
+        tree.__setstate__(state)
+        return cls(tree)
+
+
+class GridIndex:
+    """
+    Uniform grid over the slide. Points are sorted by row-major cell id, so the
+    cells of one grid row within a query box form a single contiguous slice of
+    the sort order and a query is a handful of slices plus a vectorized filter.
+    """
+    kind = 'grid'
+    library_version = str(INDEX_VERSION)
+    # Average number of points per grid cell
+    points_per_cell = 8
+
+    def __init__(self, points, order, offsets, origin, cell_size, shape):
+        self.points = points
+        self.order = order
+        self.offsets = offsets
+        self.origin = origin
+        self.cell_size = cell_size
+        self.shape = shape
+
+    @classmethod
+    def build(cls, points):
+        n = len(points)
+        if n == 0:
+            return cls(points, np.empty(0, np.int64), np.zeros(2, np.int64), (0.0, 0.0), 1.0, (1, 1))
+        mins = points.min(axis=0)
+        extent = np.maximum(points.max(axis=0) - mins, 1.0)
+        cell_size = float(np.sqrt(extent[0] * extent[1] * cls.points_per_cell / n))
+        nx = int(extent[0] // cell_size) + 1
+        ny = int(extent[1] // cell_size) + 1
+        cx = np.minimum(((points[:, 0] - mins[0]) / cell_size).astype(np.int64), nx - 1)
+        cy = np.minimum(((points[:, 1] - mins[1]) / cell_size).astype(np.int64), ny - 1)
+        cell_ids = cy * nx + cx
+        order = np.argsort(cell_ids, kind='stable')
+        if n < np.iinfo(np.int32).max:
+            order = order.astype(np.int32)
+        offsets = np.zeros(nx * ny + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cell_ids, minlength=nx * ny), out=offsets[1:])
+        return cls(points, order, offsets, (float(mins[0]), float(mins[1])), cell_size, (ny, nx))
+
+    def cell_range(self, x0, y0, x1, y1):
+        """
+        Range of grid cells (cx0, cy0, cx1, cy1) overlapping the box [x0, x1] x [y0, y1],
+        or None if the box is outside the grid.
+        """
+        ny, nx = self.shape
+        cx0 = int(np.floor((x0 - self.origin[0]) / self.cell_size))
+        cx1 = int(np.floor((x1 - self.origin[0]) / self.cell_size))
+        cy0 = int(np.floor((y0 - self.origin[1]) / self.cell_size))
+        cy1 = int(np.floor((y1 - self.origin[1]) / self.cell_size))
+        if cx1 < 0 or cy1 < 0 or cx0 >= nx or cy0 >= ny or len(self.order) == 0:
+            return None
+        return max(cx0, 0), max(cy0, 0), min(cx1, nx - 1), min(cy1, ny - 1)
+
+    def slices(self, rows, first_cells, last_cells):
+        """
+        Positions in the sort order of the cells first_cells[i]..last_cells[i] of
+        grid row rows[i], concatenated. Empty spans (last < first) are skipped.
+        """
+        nx = self.shape[1]
+        starts = self.offsets[rows * nx + first_cells]
+        ends = self.offsets[rows * nx + np.maximum(last_cells, first_cells - 1) + 1]
+        lengths = ends - starts
+        total = int(lengths.sum())
+        if total == 0:
+            return np.empty(0, dtype=np.int64)
+        # Vectorized concatenation of arange(start, end) for every span
+        shifts = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return shifts + np.arange(total)
+
+    def candidates(self, x0, y0, x1, y1):
+        """
+        Indices of all points in the grid cells overlapping the box [x0, x1] x [y0, y1].
+        """
+        cells = self.cell_range(x0, y0, x1, y1)
+        if cells is None:
+            return np.empty(0, dtype=self.order.dtype)
+        cx0, cy0, cx1, cy1 = cells
+        rows = np.arange(cy0, cy1 + 1)
+        return self.order[self.slices(rows, np.full(len(rows), cx0), np.full(len(rows), cx1))]
+
+    def circle_cells(self, x, y, r):
+        """
+        Splits the cells overlapping the circle into cells lying completely inside
+        it, whose points need no distance test, and border cells. Returns the order
+        positions of both groups.
+        """
+        cells = self.cell_range(x - r, y - r, x + r, y + r)
+        if cells is None:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty
+        cx0, cy0, cx1, cy1 = cells
+        rows = np.arange(cy0, cy1 + 1)
+        # Largest vertical distance from the center to any point of a row
+        row_top = self.origin[1] + rows * self.cell_size
+        dy = np.maximum(np.abs(row_top - y), np.abs(row_top + self.cell_size - y))
+        half_width = np.sqrt(np.maximum(r * r - dy * dy, 0))
+        inner_first = np.ceil((x - half_width - self.origin[0]) / self.cell_size).astype(np.int64)
+        inner_last = np.floor((x + half_width - self.origin[0]) / self.cell_size).astype(np.int64) - 1
+        inner_first = np.clip(inner_first, cx0, cx1 + 1)
+        inner_last = np.where(dy < r, np.clip(inner_last, cx0 - 1, cx1), cx0 - 1)
+        inner_last = np.maximum(inner_last, inner_first - 1)
+        inner = self.slices(rows, inner_first, inner_last)
+        border = np.concatenate([
+            self.slices(rows, np.full(len(rows), cx0), inner_first - 1),
+            self.slices(rows, inner_last + 1, np.full(len(rows), cx1))
+        ])
+        return inner, border
+
+    def squared_distances(self, indices, x, y):
+        points = self.points[indices]
+        return (points[:, 0] - x) ** 2 + (points[:, 1] - y) ** 2
+
+    def query_nearest(self, x, y):
+        if len(self.order) == 0:
+            return np.inf, -1
+        r = self.cell_size
+        while True:
+            candidates = self.candidates(x - r, y - r, x + r, y + r)
+            if len(candidates) > 0:
+                break
+            r *= 2
+        # The closest point of the box is not necessarily the closest overall,
+        # everything within its distance has to be checked
+        distances = self.squared_distances(candidates, x, y)
+        r = np.sqrt(distances.min())
+        candidates = self.candidates(x - r, y - r, x + r, y + r)
+        distances = self.squared_distances(candidates, x, y)
+        closest = np.argmin(distances)
+        return np.sqrt(distances[closest]), candidates[closest]
+
+    def query_radius(self, x, y, r):
+        inner, border = self.circle_cells(x, y, r)
+        border = self.order[border]
+        border = border[self.squared_distances(border, x, y) <= r * r]
+        return np.sort(np.concatenate([self.order[inner], border]))
+
+    def count_radius(self, x, y, r):
+        inner, border = self.circle_cells(x, y, r)
+        border = self.order[border]
+        return len(inner) + int(np.count_nonzero(self.squared_distances(border, x, y) <= r * r))
+
+    def query_rect(self, x0, y0, x1, y1):
+        candidates = self.candidates(x0, y0, x1, y1)
+        return np.sort(candidates[in_rect(self.get_points(candidates), x0, y0, x1, y1)])
+
+    def get_points(self, indices):
+        return self.points[indices]
+
+    def nbytes(self):
+        return self.points.nbytes + self.order.nbytes + self.offsets.nbytes
+
+    def get_state(self):
+        arrays = {'points': self.points, 'order': self.order, 'offsets': self.offsets}
+        params = {'origin': list(self.origin), 'cell_size': self.cell_size, 'shape': list(self.shape)}
+        return arrays, params
+
+    @classmethod
+    def from_state(cls, arrays, params):
+        return cls(arrays['points'], arrays['order'], arrays['offsets'], tuple(params['origin']),
+                   params['cell_size'], tuple(params['shape']))
+
+
+def split_state(state):
+    """
+    Splits the pickle state of a tree into arrays and plain values. Non plain
+    values (the distance metric object of a BallTree) are recreated on load from
+    a freshly built tree, which is safe as the library version is pinned in the
+    header.
+    """
+    arrays = {}
+    params = []
+    for i, value in enumerate(state):
+        if isinstance(value, np.ndarray):
+            arrays['state_{:02d}'.format(i)] = value
+            params.append({'array': 'state_{:02d}'.format(i)})
+        elif value is None or isinstance(value, (bool, int, float, str)):
+            params.append({'value': value})
+        elif isinstance(value, np.generic):
+            params.append({'value': value.item()})
+        else:
+            params.append({'object': type(value).__name__})
+    return arrays, {'state': params}
+
+
+def join_state(arrays, params, template):
+    """
+    The pickle state split by split_state, taking non plain values from the state
+    of a freshly built tree (template). None if the state does not fit it.
+    """
+    if len(template) != len(params['state']):
+        return None
+    state = []
+    for entry, template_value in zip(params['state'], template):
+        if 'array' in entry:
+            state.append(arrays[entry['array']])
+        elif 'value' in entry:
+            state.append(entry['value'])
+        elif type(template_value).__name__ == entry['object']:
+            state.append(template_value)
+        else:
+            return None
+    return tuple(state)
+
+
+def in_rect(points, x0, y0, x1, y1):
+    return (points[:, 0] >= x0) & (points[:, 0] <= x1) & (points[:, 1] >= y0) & (points[:, 1] <= y1)
+
+
+def query_polygon(index, vertices):
+    """
+    Indices of the points of index inside the polygon given by its (x, y) vertices.
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    if len(vertices) < 3:
+        return np.empty(0, dtype=np.intp)
+    (x0, y0), (x1, y1) = vertices.min(axis=0), vertices.max(axis=0)
+    candidates = index.query_rect(x0, y0, x1, y1)
+    return candidates[measure.points_in_poly(index.get_points(candidates), vertices)]
+
+
+BACKENDS = {backend.kind: backend for backend in [BallTreeIndex, KDTreeIndex, GridIndex]}
+
+
+def get_index_path(datasource_directory):
+    return Path(datasource_directory) / INDEX_DIRECTORY
+
+
+def make_header(kind, source, x_coordinate, y_coordinate, n_points):
+    """
+    Describes the index that is expected for a datasource. source is the feature
+    table fingerprint from feature_cache.fingerprint.
+    """
+    return {
+        'version': INDEX_VERSION,
+        'kind': kind,
+        'library': BACKENDS[kind].library_version,
+        'source': source,
+        'xCoordinate': x_coordinate,
+        'yCoordinate': y_coordinate,
+        'points': int(n_points)
+    }
+
+
+def read_header(index_path):
+    try:
+        with open(Path(index_path) / HEADER_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def build_index(points, kind='kd_tree'):
+    return BACKENDS[kind].build(np.ascontiguousarray(points, dtype=np.float64))
+
+
+def save_index(index_path, index, header):
+    index_path = Path(index_path)
+    tmp_path = index_path.with_name(index_path.name + '.tmp')
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    arrays, params = index.get_state()
+    for name, array in arrays.items():
+        np.save(tmp_path / (name + '.npy'), array)
+    header = dict(header, arrays=sorted(arrays), params=params)
+    with open(tmp_path / HEADER_FILE, 'w') as f:
+        json.dump(header, f, indent=4)
+    if index_path.exists():
+        shutil.rmtree(index_path)
+    os.rename(tmp_path, index_path)
+
+
+def load_index(index_path, header):
+    """
+    Returns the persisted index if its header matches the expected header,
+    otherwise None.
+    """
+    index_path = Path(index_path)
+    stored = read_header(index_path)
+    if stored is None:
+        return None
+    for key, value in header.items():
+        if stored.get(key) != value:
+            print("Spatial index is stale ({} changed), ignoring it.".format(key))
+            return None
+    # Copy-on-write mapping: zero-copy, but still writable for older tree versions
+    arrays = {name: np.load(index_path / (name + '.npy'), mmap_mode='c') for name in stored['arrays']}
+    return BACKENDS[stored['kind']].from_state(arrays, stored['params'])
@@ -0,0 +1,107 @@
+# Cache of encoded image tiles.
+#
+# Encoded tiles are kept in a byte-bounded in-memory LRU and, if a directory is
+# configured, also written to disk so they survive restarts and evictions. Keys
+# are tuples such as (datasource, image token, channel, level, tile, encoding);
+# the image token identifies the image files, so tiles of re-imported images are
+# never served from the cache. The disk cache is not size bounded, it holds at
+# most one encoded copy of every tile that was requested.
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+
+def key_digest(key):
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+class TileCache:
+
+    def __init__(self, max_bytes=256 * 1024 ** 2, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = Path(directory) if directory else None
+        # key -> encoded tile, least recently used first
+        self.tiles = OrderedDict()
+        self.tiles_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def disk_path(self, key):
+        digest = key_digest(key)
+        return self.directory / digest[:2] / digest
+
+    def get(self, key):
+        with self.lock:
+            data = self.tiles.get(key)
+            if data is not None:
+                self.tiles.move_to_end(key)
+                self.hits += 1
+                return data
+        if self.directory is not None:
+            try:
+                with open(self.disk_path(key), 'rb') as f:
+                    data = f.read()
+            except OSError:
+                data = None
+            if data is not None:
+                self.put(key, data, write=False)
+                with self.lock:
+                    self.disk_hits += 1
+                return data
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def contains(self, key):
+        """
+        Whether key is cached in memory or on disk, without counting a request.
+        """
+        with self.lock:
+            if key in self.tiles:
+                return True
+        return self.directory is not None and self.disk_path(key).is_file()
+
+    def put(self, key, data, write=True):
+        with self.lock:
+            if key not in self.tiles and len(data) <= self.max_bytes:
+                self.tiles[key] = data
+                self.tiles_bytes += len(data)
+            while self.tiles_bytes > self.max_bytes:
+                _, evicted = self.tiles.popitem(last=False)
+                self.tiles_bytes -= len(evicted)
+        if write and self.directory is not None:
+            path = self.disk_path(key)
+            try:
+                os.makedirs(path.parent, exist_ok=True)
+                tmp_path = path.with_name(path.name + '.{}.tmp'.format(threading.get_ident()))
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print('Could not write tile to the disk cache:', e)
+
+    def discard(self, datasource_name):
+        """
+        Drops the in-memory tiles of a datasource, e.g. when it is deleted.
+        """
+        with self.lock:
+            for key in [key for key in self.tiles if key[0] == datasource_name]:
+                self.tiles_bytes -= len(self.tiles.pop(key))
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.disk_hits + self.misses
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits) / requests if requests else 0.0,
+                'tiles': len(self.tiles),
+                'tiles_bytes': self.tiles_bytes,
+                'max_bytes': self.max_bytes
+            }
@@ -0,0 +1,129 @@
+# Speculative prefetching of image tiles.
+#
+# When a tile is requested, the ring of tiles around it at the same level and its
+# parent and child tiles at the adjacent pyramid levels (level 0 is the full
+# resolution) are queued, so the tiles needed when the user pans or zooms are
+# already in the tile cache. The queue is bounded and processed newest first by a
+# small pool of threads. Prefetches belong to the tile request that caused them;
+# once that tile is no longer among the latest requests of the viewer (the same
+# datasource and channel), the viewport has moved on and they are cancelled.
+
+import threading
+from collections import OrderedDict, deque
+
+
+class TilePrefetcher:
+
+    def __init__(self, fetch, tile_grid, is_cached=None, n_workers=2, max_queue=256, viewport_size=32):
+        """
+        fetch(datasource, channel, level, tile, encoding) loads a tile into the
+        cache, tile_grid(datasource, channel, level) returns the number of tiles
+        (x, y) of a level or None if there is no such level, and
+        is_cached(datasource, channel, level, tile, encoding) tells if a tile can
+        be skipped.
+        """
+        self.fetch = fetch
+        self.tile_grid = tile_grid
+        self.is_cached = is_cached
+        self.n_workers = n_workers
+        self.max_queue = max_queue
+        self.viewport_size = viewport_size
+        # Newest first: (key, origin) with key = (datasource, channel, level, tile, encoding)
+        self.queue = deque()
+        self.queued = set()
+        # (datasource, channel) -> latest requested (level, tile, encoding), newest last
+        self.viewports = {}
+        self.prefetched = 0
+        self.cancelled = 0
+        self.dropped = 0
+        self.errors = 0
+        self.condition = threading.Condition()
+        self.workers = []
+
+    def start(self):
+        for i in range(self.n_workers - len(self.workers)):
+            worker = threading.Thread(target=self.run, name='tile-prefetch-{}'.format(i), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def neighbours(self, datasource, channel, level, tx, ty):
+        candidates = [(level, tx + dx, ty + dy) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dx != 0 or dy != 0]
+        candidates.append((level + 1, tx // 2, ty // 2))
+        if level > 0:
+            candidates += [(level - 1, 2 * tx + dx, 2 * ty + dy) for dy in (0, 1) for dx in (0, 1)]
+        grids = {}
+        for candidate_level, x, y in candidates:
+            if candidate_level not in grids:
+                grids[candidate_level] = self.tile_grid(datasource, channel, candidate_level)
+            grid = grids[candidate_level]
+            if grid is not None and 0 <= x < grid[0] and 0 <= y < grid[1]:
+                yield candidate_level, '{}_{}.png'.format(x, y)
+
+    def request(self, datasource, channel, level, tile, encoding):
+        """
+        Records a requested tile and queues its neighbours.
+        """
+        level = int(level)
+        tx, ty = [int(i) for i in tile.replace('.png', '').split('_')]
+        origin = (level, tile, encoding)
+        with self.condition:
+            viewport = self.viewports.setdefault((datasource, channel), OrderedDict())
+            viewport.pop(origin, None)
+            viewport[origin] = True
+            while len(viewport) > self.viewport_size:
+                viewport.popitem(last=False)
+        if self.n_workers == 0:
+            return
+        self.start()
+        for candidate_level, candidate_tile in self.neighbours(datasource, channel, level, tx, ty):
+            key = (datasource, channel, candidate_level, candidate_tile, encoding)
+            with self.condition:
+                # viewport, not self.viewports, which cancel may have emptied since
+                if key in self.queued or (candidate_level, candidate_tile, encoding) in viewport:
+                    continue
+                self.queue.appendleft((key, origin))
+                self.queued.add(key)
+                while len(self.queue) > self.max_queue:
+                    dropped, _ = self.queue.pop()
+                    self.queued.discard(dropped)
+                    self.dropped += 1
+                self.condition.notify()
+
+    def cancel(self, datasource):
+        with self.condition:
+            kept = deque(item for item in self.queue if item[0][0] != datasource)
+            self.cancelled += len(self.queue) - len(kept)
+            self.queue = kept
+            self.queued = set(key for key, _ in kept)
+            for viewer in [viewer for viewer in self.viewports if viewer[0] == datasource]:
+                del self.viewports[viewer]
+
+    def next_item(self):
+        with self.condition:
+            while True:
+                while len(self.queue) == 0:
+                    self.condition.wait()
+                key, origin = self.queue.popleft()
+                self.queued.discard(key)
+                if origin in self.viewports.get((key[0], key[1]), ()):
+                    return key
+                self.cancelled += 1
+
+    def run(self):
+        while True:
+            key = self.next_item()
+            try:
+                if self.is_cached is not None and self.is_cached(*key):
+                    continue
+                self.fetch(*key)
+                with self.condition:
+                    self.prefetched += 1
+            except Exception as e:
+                with self.condition:
+                    self.errors += 1
+                print('Tile prefetch failed for', key, e)
+
+    def stats(self):
+        with self.condition:
+            return {'queued': len(self.queue), 'prefetched': self.prefetched, 'cancelled': self.cancelled,
+                    'dropped': self.dropped, 'errors': self.errors, 'workers': len(self.workers)}
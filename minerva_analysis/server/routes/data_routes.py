@@ -3,8 +3,9 @@ from flask import render_template, request, Response, jsonify, abort, send_file
 import io
 from PIL import Image
 from minerva_analysis import data_path, get_config
-from minerva_analysis.server.models import data_model
+from minerva_analysis.server.models import compositor, data_model
 from minerva_analysis.server.analytics import comparison
+from minerva_analysis.server.utils import binary_columns, tile_encoding
 from pathlib import Path
 from time import time
 import pandas as pd
@@ -40,14 +41,14 @@ def get_channel_cell_ids():
     datasource = request.args.get('datasource')
     filter = json.loads(request.args.get('filter'))
     resp = data_model.get_channel_cells(datasource, filter)
-    return serialize_and_submit_json(resp)
+    return serialize_and_submit_frame(resp)
 
 
 @app.route('/get_cell_ids_phenotype', methods=['GET'])
 def get_cell_ids_phenotype():
     datasource = request.args.get('datasource')
     resp = data_model.get_cells_phenotype(datasource)
-    return serialize_and_submit_json(resp)
+    return serialize_and_submit_frame(resp)
 
 
 # Gets a row based on the index
@@ -105,7 +106,7 @@ def get_neighborhood():
     max_distance = float(request.args.get('max_distance'))
     datasource = request.args.get('datasource')
     resp = data_model.get_neighborhood(x, y, datasource, r=max_distance)
-    return serialize_and_submit_json(resp)
+    return serialize_and_submit_frame(resp)
 
 
 @app.route('/get_neighborhood_for_spat_corr', methods=['GET'])
@@ -144,6 +145,13 @@ def get_gated_cell_ids():
     datasource = request.args.get('datasource')
     filter = json.loads(request.args.get('filter'))
     resp = data_model.get_gated_cells(datasource, filter)
+    return serialize_and_submit_frame(resp)
+
+
+@app.route('/get_gating_cache_stats', methods=['GET'])
+def get_gating_cache_stats():
+    datasource = request.args.get('datasource')
+    resp = data_model.get_gating_cache_stats(datasource)
     return serialize_and_submit_json(resp)
 
 
@@ -172,15 +180,17 @@ def upload_gates():
 
 @app.route('/get_rect_cells', methods=['GET'])
 def get_rect_cells():
-    # Parse (rect - [x, y, r], channels [string])
+    # Parse (rect - [x, y, width, height] or [x, y, r], polygon - [[x, y], ...], channels - comma separated)
     datasource = request.args.get('datasource')
-    rect = [float(x) for x in request.args.get('rect').split(',')]
+    rect = [float(x) for x in request.args.get('rect', '').split(',') if x != '']
+    polygon = json.loads(request.args.get('polygon', 'null'))
     channels = request.args.get('channels')
+    channels = channels.split(',') if channels else []
 
-    # Retrieve cells - FIXME: Too slow - jam is stalling image loading
-    resp = data_model.get_rect_cells(datasource, rect, channels)
+    # Retrieve cells
+    resp = data_model.get_rect_cells(datasource, rect, channels, polygon=polygon)
     print('Neighborhood size:', len(resp))
-    return serialize_and_submit_json(resp)
+    return serialize_and_submit_frame(resp)
 
 
 @app.route('/get_ome_metadata', methods=['GET'])
@@ -311,22 +321,182 @@ def to_dict(row):
             row.__table__.columns}
 
 
-# E.G /generated/data/melanoma/channel_00_files/13/16_18.png
+# E.G /generated/data/melanoma/channel_00_files/13/16_18.png, optionally ?encoding=png_fast (see tile_encoding),
+# segmentation tiles also ?labels=<digest from /set_visible_labels> to show only those cells
 @app.route('/generated/data/<string:datasource>/<string:channel>/<string:level>/<string:tile>')
 def generate_png(datasource, channel, level, tile):
-    png = data_model.generate_zarr_png(datasource, channel, level, tile)
-    file_object = io.BytesIO()
-    # write PNG in file-object
-    Image.fromarray(png).save(file_object, 'PNG', compress_level=0)
-    # move to beginning of file so `send_file()` it will read from start
-    file_object.seek(0)
-    return send_file(file_object, mimetype='image/PNG')
+    encoding = data_model.get_tile_encoding(channel, request.args.get('encoding'))
+    if encoding is None:
+        abort(400, 'Unknown tile encoding, use one of ' + ', '.join(tile_encoding.ENCODINGS))
+    labels = get_label_filter(datasource)
+    # Tiles are cached server side, and browsers revalidate them by ETag
+    etag = data_model.get_tile_etag(datasource, channel, level, tile, encoding, labels)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(data_model.get_encoded_tile(datasource, channel, level, tile, encoding, labels),
+                            mimetype=tile_encoding.MIMETYPES[encoding])
+        response.headers['X-Tile-Encoding'] = encoding
+    if labels is None:
+        data_model.prefetch_tiles(datasource, channel, level, tile, encoding)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['TILE_CACHE_MAX_AGE']
+    return response
+
+
+# E.G /generated/batch/melanoma/13/16_18.png?channels=channel_00_files,channel_03_files&encoding=npy_zstd
+@app.route('/generated/batch/<string:datasource>/<string:level>/<string:tile>')
+def generate_tile_batch(datasource, level, tile):
+    if not request.args.get('channels'):
+        abort(400, 'Missing channels, a comma separated list of channel names')
+    channels = request.args.get('channels').split(',')
+    encodings = [data_model.get_tile_encoding(channel, request.args.get('encoding')) for channel in channels]
+    if None in encodings:
+        abort(400, 'Unknown tile encoding, use one of ' + ', '.join(tile_encoding.ENCODINGS))
+    labels = get_label_filter(datasource)
+    etag = data_model.get_tile_etag(datasource, ','.join(channels), level, tile, ','.join(encodings), labels)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        payloads = data_model.get_encoded_tiles(datasource, channels, level, tile, encodings, labels)
+        response = Response(tile_encoding.encode_batch(channels, encodings, payloads),
+                            mimetype=tile_encoding.BATCH_MIMETYPE)
+    for channel, encoding in zip(channels, encodings):
+        if labels is None or not data_model.is_segmentation_channel(channel):
+            data_model.prefetch_tiles(datasource, channel, level, tile, encoding)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['TILE_CACHE_MAX_AGE']
+    return response
+
+
+# E.G /generated/composite/melanoma/13/16_18.png?layers=[{"channel": "channel_00_files", "range": [500, 20000],
+# "color": "#0000ff"}, ...]&encoding=png_fast
+@app.route('/generated/composite/<string:datasource>/<string:level>/<string:tile>')
+def generate_composite_png(datasource, level, tile):
+    layers = get_composite_layers(datasource)
+    encoding = tile_encoding.resolve(request.args.get('encoding', 'png_fast'), rgba=True)
+    if encoding is None:
+        abort(400, 'Unknown tile encoding, use one of ' + ', '.join(tile_encoding.ENCODINGS))
+    etag = data_model.get_composite_etag(datasource, layers, level, tile, encoding)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(data_model.get_composite_tile(datasource, layers, level, tile, encoding),
+                            mimetype=tile_encoding.MIMETYPES[encoding])
+        response.headers['X-Tile-Encoding'] = encoding
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['TILE_CACHE_MAX_AGE']
+    return response
+
+
+def get_composite_layers(datasource):
+    """
+    The layers parameter of a composite request, aborts with 400 if it is not a
+    non-empty list of {"channel": <image channel>, "range": [lo, hi], "color": <color>}.
+    """
+    try:
+        layers = json.loads(request.args.get('layers') or '')
+    except ValueError:
+        abort(400, 'Missing or malformed layers, a JSON list of {"channel", "range", "color"} objects')
+    if not isinstance(layers, list) or len(layers) == 0:
+        abort(400, 'Composites need at least one image channel and no segmentation')
+    for layer in layers:
+        if not isinstance(layer, dict) or not isinstance(layer.get('channel'), str):
+            abort(400, 'Every layer needs a channel name')
+        if not data_model.is_image_channel(datasource, layer['channel']):
+            abort(400, 'Unknown image channel ' + layer['channel'])
+        layer_range = layer.get('range')
+        if not isinstance(layer_range, list) or len(layer_range) != 2 or not all(
+                isinstance(value, (int, float)) and not isinstance(value, bool) for value in layer_range):
+            abort(400, 'The range of ' + layer['channel'] + ' has to be [lo, hi]')
+        try:
+            color = compositor.parse_color(layer.get('color'))
+        except (TypeError, ValueError):
+            color = None
+        if color is None or len(color) != 3:
+            abort(400, 'Invalid color of ' + layer['channel'])
+    return layers
+
+
+def get_label_filter(datasource):
+    labels = request.args.get('labels')
+    if labels is not None and not data_model.has_visible_labels(datasource, labels):
+        abort(404, 'Unknown label filter, register the cells with /set_visible_labels again')
+    return labels
+
+
+# POST {"datasource": "melanoma", "labels": [1, 5, 17, ...]}, returns {"labels": "<digest>"}
+@app.route('/set_visible_labels', methods=['POST'])
+def set_visible_labels():
+    post_data = json.loads(request.data)
+    digest = data_model.set_visible_labels(post_data['datasource'], post_data['labels'])
+    return serialize_and_submit_json({'labels': digest})
+
+
+# E.G /get_cell_outlines?datasource=melanoma&level=2&viewport=1000,2000,3000,3500, optionally &labels=<digest from
+# /set_visible_labels> or &ids=12,15,...; returns the labels, offsets of each outline in points (plus the end) and the
+# flat x, y vertices of the outlines, or null if the outline layer is not built (see /start_cell_outlines)
+@app.route('/get_cell_outlines', methods=['GET'])
+def get_cell_outlines():
+    datasource = request.args.get('datasource')
+    level = int(request.args.get('level', 0))
+    viewport = request.args.get('viewport')
+    viewport = [float(x) for x in viewport.split(',')] if viewport else None
+    ids = request.args.get('ids')
+    ids = [int(x) for x in ids.split(',') if x != ''] if ids is not None else None
+    labels = get_label_filter(datasource)
+    resp = data_model.get_cell_outlines(datasource, level, viewport=viewport, labels=labels, ids=ids)
+    return serialize_and_submit_json(resp)
+
+
+@app.route('/start_cell_outlines')
+def start_cell_outlines():
+    datasource = request.args.get('datasource')
+    data_model.start_cell_outlines(datasource)
+    return jsonify(success=True)
+
+
+# E.G /get_cell_bounds?datasource=melanoma&ids=12,15; null if the label index is not built (see /start_label_index)
+@app.route('/get_cell_bounds', methods=['GET'])
+def get_cell_bounds():
+    datasource = request.args.get('datasource')
+    ids = [int(x) for x in request.args.get('ids', '').split(',') if x != '']
+    resp = data_model.get_cell_bounds(datasource, ids)
+    return serialize_and_submit_json(resp)
+
+
+@app.route('/validate_label_index', methods=['GET'])
+def validate_label_index():
+    datasource = request.args.get('datasource')
+    resp = data_model.validate_label_index(datasource)
+    return serialize_and_submit_json(resp)
+
+
+@app.route('/start_label_index')
+def start_label_index():
+    datasource = request.args.get('datasource')
+    data_model.start_label_index(datasource)
+    return jsonify(success=True)
+
+
+@app.route('/get_tile_cache_stats', methods=['GET'])
+def get_tile_cache_stats():
+    return serialize_and_submit_json(data_model.get_tile_cache_stats())
+
+
+@app.route('/get_image_reader_stats', methods=['GET'])
+def get_image_reader_stats():
+    return serialize_and_submit_json(data_model.get_image_reader_stats())
 
 
 @app.route('/start_spatial_correlation')
 def start_spatial_correlation():
-    data_model.spatial_corr([])
-    return 'hi'
+    datasource = request.args.get('datasource')
+    data_model.start_spatial_corr_layer(datasource)
+    return jsonify(success=True)
 
 
 def serialize_and_submit_json(data):
@@ -335,3 +505,18 @@ def serialize_and_submit_json(data):
         mimetype='application/json'
     )
     return response
+
+
+# Cell sets are sent as JSON records unless the client explicitly accepts the binary
+# columnar format (a wildcard Accept header does not count)
+def serialize_and_submit_frame(frame):
+    if any(mimetype == binary_columns.MIMETYPE for mimetype, quality in request.accept_mimetypes if quality > 0):
+        response = app.response_class(
+            response=binary_columns.encode(frame),
+            mimetype=binary_columns.MIMETYPE
+        )
+        response.vary.add('Accept')
+        return response
+    response = serialize_and_submit_json(frame.to_dict(orient='records'))
+    response.vary.add('Accept')
+    return response
@@ -33,6 +33,7 @@ def edit_config_with_request_name(config_name):
 def delete_with_datasource_name(config_name):
     global config_json_path
 
+    data_model.unload_datasource(config_name)
     path = str(data_path / config_name)
     if os.path.exists(path):
         shutil.rmtree(path)
@@ -226,14 +227,16 @@ def upload_file_page():
                     # Process Channel File
 
                     current_task = "Converting OME-TIFF Channels (This Will Take a While)"
-                    channel_info = data_model.convertOmeTiff(channelFile, isLabelImg=False)
+                    imageFormat = request.form.get('image_format') or app.config['IMPORT_FORMAT']
+                    channel_info = data_model.convertOmeTiff(channelFile, dataDirectory=file_path, isLabelImg=False,
+                                                             imageFormat=imageFormat)
                     channelFileNames.extend(channel_info['channel_names'])
                     completed_task += 1
 
                     current_task = "Converting Segmentation Mask"
                     label_info = data_model.convertOmeTiff(labelFile, channelFilePath=channelFile,
                                                            dataDirectory=file_path,
-                                                           isLabelImg=True)
+                                                           isLabelImg=True, imageFormat=imageFormat)
                     completed_task += 1
 
                     current_task = total_tasks
@@ -264,7 +267,7 @@ def upload_file_page():
                     config_data['csvName'] = csvName
                     if len(celltypeFile) == 1:
                         config_data['celltypeData'] = celltypeName
-                    config_data['channelFile'] = str(channelFile)
+                    config_data['channelFile'] = channel_info.get('channelFile', str(channelFile))
                     config_data['new'] = True
                     config_data['labelName'] = labelName
                     config_data['datasources'] = get_config_names()
@@ -451,22 +454,13 @@ def save_config():
             data_model.load_datasource(datasetName, reload=True)
             resp = jsonify(success=True)
 
-            # Save spatial correlation
-            # print('Adding results from spatial correlation')
-            # file_path = str(Path(os.path.join(os.getcwd())) / data_path / datasetName)
-            # csv_path = str(Path(file_path) / csvName)
-            # data = pd.read_csv(csv_path)
-            # x_coordinate = configData[datasetName]['featureData'][0]['xCoordinate']
-            # y_coordinate = configData[datasetName]['featureData'][0]['yCoordinate']
-            # index = configData[datasetName]['featureData'][0]['idField']
-            # channels = [d['fullname'] for d in configData[datasetName]['imageData']][1:]
-            # new_data = data_model.spatial_corr(adata=data, x_coordinate=x_coordinate, y_coordinate=y_coordinate,
-            #                         index=index, channels=channels)
-            # for name, values in new_data.iteritems():
-            #     new_column = name + '_spat_corr'
-            #     data[new_column] = values
-            # data.to_csv(csv_path)
-            # print('Saved new spat_corr column results to csv')
+            # Precompute the whole-slide spatial correlation, the cell outlines and the label index in the background
+            if app.config['SPATIAL_CORR_AT_IMPORT']:
+                data_model.start_spatial_corr_layer(datasetName)
+            if app.config['CELL_OUTLINES_AT_IMPORT']:
+                data_model.start_cell_outlines(datasetName)
+            if app.config['LABEL_INDEX_AT_IMPORT']:
+                data_model.start_label_index(datasetName)
 
             return resp
 
@@ -0,0 +1,222 @@
+# Micro benchmarks for the server hot paths.
+#
+# Usage: python -m minerva_analysis.server.utils.benchmarks spatial_index --points 5000000
+#        python -m minerva_analysis.server.utils.benchmarks spatial_corr --points 20000 --k 10
+#        python -m minerva_analysis.server.utils.benchmarks tile_encoding --image channels.ome.tif --channels 0 5 12
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from sklearn.neighbors import BallTree
+
+from minerva_analysis.server.models import spatial_index
+from minerva_analysis.server.utils import tile_encoding
+
+# Lens radii in image pixels, from a small lens at full resolution to a large lens zoomed out
+LENS_RADII = [25, 50, 100, 250, 500, 1000, 2000]
+
+
+def load_points(csv_path=None, x_coordinate='X_centroid', y_coordinate='Y_centroid', n_points=1000000,
+                size=40000, seed=0):
+    if csv_path is not None:
+        data = pd.read_csv(csv_path, usecols=[x_coordinate, y_coordinate])
+        return data[[x_coordinate, y_coordinate]].to_numpy(dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    return rng.uniform(0, size, size=(n_points, 2))
+
+
+def timed(function, queries):
+    tic = time.perf_counter()
+    for x, y in queries:
+        function(x, y)
+    return (time.perf_counter() - tic) / len(queries) * 1000
+
+
+def benchmark_spatial_index(points, radii=LENS_RADII, n_queries=200, backends=None, seed=0):
+    rng = np.random.default_rng(seed)
+    queries = points[rng.integers(0, len(points), n_queries)] + rng.normal(0, 10, size=(n_queries, 2))
+    backends = backends or list(spatial_index.BACKENDS)
+    print("{} points, {} queries per measurement, times in ms per query".format(len(points), n_queries))
+    results = []
+    for kind in backends:
+        tic = time.perf_counter()
+        index = spatial_index.build_index(points, kind)
+        build = time.perf_counter() - tic
+        nearest = timed(index.query_nearest, queries)
+        print("{:>10}: build {:.2f}s, nearest {:.3f}ms".format(kind, build, nearest))
+        for r in radii:
+            result = {
+                'backend': kind,
+                'radius': r,
+                'query_radius': timed(lambda x, y: index.query_radius(x, y, r), queries),
+                'count_radius': timed(lambda x, y: index.count_radius(x, y, r), queries),
+            }
+            print("{:>10}  r={:<5} query_radius {:8.3f}ms  count_radius {:8.3f}ms".format(
+                kind, r, result['query_radius'], result['count_radius']))
+            results.append(result)
+    return pd.DataFrame(results)
+
+
+def spatial_corr_legacy(adata, x_coordinate='X_centroid', y_coordinate='Y_centroid', k=500, index='id',
+                        channels=[]):
+    """
+    The original per-marker spatial_corr, kept as the baseline of the spatial_corr benchmark.
+    """
+    data = pd.DataFrame({'x': adata[x_coordinate], 'y': adata[y_coordinate]})
+    exp = pd.DataFrame(adata[channels], index=adata[index])
+    tree = BallTree(data, leaf_size=2)
+    dist, ind = tree.query(data, k=k, return_distance=True)
+    neighbours = pd.DataFrame(ind, index=adata[index])
+    rad_approx = np.mean(dist.T, axis=0)
+    A = (exp - exp.mean().values) / exp.std(ddof=0).values
+
+    def corrfunc(marker):
+        ind_values = dict(zip(list(range(len(ind))), A[marker]))
+        neigh = neighbours.copy()
+        for i in neigh.columns:
+            neigh[i] = neigh[i].dropna().map(ind_values, na_action='ignore')
+        Y = neigh.T * A[marker]
+        return np.mean(Y.T, axis=1)
+
+    df = pd.concat([corrfunc(marker) for marker in exp.columns], axis=1)
+    df.columns = exp.columns
+    df['distance'] = rad_approx
+    return df
+
+
+def synthetic_cells(n_cells=20000, n_markers=20, size=4000, seed=0):
+    rng = np.random.default_rng(seed)
+    frame = pd.DataFrame(rng.lognormal(size=(n_cells, n_markers)),
+                         columns=['marker_{}'.format(i) for i in range(n_markers)])
+    frame['X_centroid'] = rng.uniform(0, size, n_cells)
+    frame['Y_centroid'] = rng.uniform(0, size, n_cells)
+    frame['id'] = frame.index
+    return frame
+
+
+def benchmark_spatial_corr(frame, channels, k=10, legacy=True):
+    from minerva_analysis.server.models import data_model
+
+    print("{} cells, {} markers, k={}".format(len(frame), len(channels), k))
+    results = {}
+    for name, dtype in [('float64', np.float64), ('float32', np.float32)]:
+        tic = time.perf_counter()
+        results[name] = data_model.spatial_corr(frame, k=k, index='id', channels=channels, dtype=dtype)
+        print("{:>10}: {:.3f}s".format(name, time.perf_counter() - tic))
+    print("float32 max abs difference {:.2e}".format(
+        np.nanmax(np.abs(results['float32'].to_numpy() - results['float64'].to_numpy()))))
+    if legacy:
+        tic = time.perf_counter()
+        results['legacy'] = spatial_corr_legacy(frame, k=k, index='id', channels=channels)
+        print("{:>10}: {:.3f}s".format('legacy', time.perf_counter() - tic))
+        print("float64 max abs difference to legacy {:.2e}".format(
+            np.nanmax(np.abs(results['legacy'].to_numpy() - results['float64'].to_numpy()))))
+    return results
+
+
+def load_tiles(image_path=None, channels=(0,), level=0, n_tiles=8, tile_size=1024, seed=0):
+    """
+    Tiles of the given channels from an OME-TIFF pyramid level, or synthetic
+    uint16 tiles (smooth background, noise and bright cells) without an image.
+    """
+    rng = np.random.default_rng(seed)
+    if image_path is None:
+        tiles = []
+        for _ in range(n_tiles * len(channels)):
+            background = rng.normal(400, 50, (tile_size // 64, tile_size // 64)).repeat(64, 0).repeat(64, 1)
+            tile = background + rng.gamma(2, 40, (tile_size, tile_size))
+            cells = rng.integers(0, tile_size - 8, (500, 2))
+            for y, x in cells:
+                tile[y:y + 8, x:x + 8] += rng.uniform(1000, 20000)
+            tiles.append(np.clip(tile, 0, 65535).astype(np.uint16))
+        return tiles
+    import tifffile
+    import zarr
+
+    with tifffile.TiffFile(image_path, is_ome=False) as tiff:
+        image = zarr.open(tiff.series[0].aszarr())
+        image = image if isinstance(image, zarr.Array) else image[level]
+        height, width = image.shape[-2:]
+        tiles = []
+        for channel in channels:
+            for _ in range(n_tiles):
+                y = rng.integers(0, max(1, height - tile_size))
+                x = rng.integers(0, max(1, width - tile_size))
+                tiles.append(np.asarray(image[channel, y:y + tile_size, x:x + tile_size]).astype(np.uint16))
+    return tiles
+
+
+def benchmark_tile_encoding(tiles, encodings=None):
+    encodings = encodings or [encoding for encoding in tile_encoding.ENCODINGS
+                              if encoding not in tile_encoding.RGBA_ENCODINGS]
+    raw_bytes = np.mean([tile.nbytes for tile in tiles])
+    print("{} tiles, {:.0f} raw bytes per tile".format(len(tiles), raw_bytes))
+    results = []
+    for encoding in encodings:
+        tic = time.perf_counter()
+        sizes = [len(tile_encoding.encode(tile, encoding)) for tile in tiles]
+        result = {
+            'encoding': encoding,
+            'encode_ms': (time.perf_counter() - tic) / len(tiles) * 1000,
+            'bytes': np.mean(sizes),
+            'ratio': raw_bytes / np.mean(sizes)
+        }
+        print("{:>10}: encode {:8.2f}ms  {:10.0f} bytes per tile  ratio {:.2f}".format(
+            encoding, result['encode_ms'], result['bytes'], result['ratio']))
+        results.append(result)
+    return pd.DataFrame(results)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    parser_index = subparsers.add_parser('spatial_index', help="Compare spatial index backends")
+    parser_index.add_argument('--csv', help="Feature table to take centroids from (default: synthetic)")
+    parser_index.add_argument('--x', default='X_centroid', help="x coordinate column")
+    parser_index.add_argument('--y', default='Y_centroid', help="y coordinate column")
+    parser_index.add_argument('--points', type=int, default=1000000, help="number of synthetic points")
+    parser_index.add_argument('--queries', type=int, default=200)
+    parser_index.add_argument('--radii', type=float, nargs='+', default=LENS_RADII)
+    parser_index.add_argument('--backends', nargs='+', choices=list(spatial_index.BACKENDS))
+
+    parser_corr = subparsers.add_parser('spatial_corr', help="Compare spatial_corr with the per-marker version")
+    parser_corr.add_argument('--csv', help="Feature table (default: synthetic)")
+    parser_corr.add_argument('--channels', nargs='+', help="Marker columns of --csv")
+    parser_corr.add_argument('--points', type=int, default=20000, help="number of synthetic cells")
+    parser_corr.add_argument('--markers', type=int, default=20, help="number of synthetic markers")
+    parser_corr.add_argument('--k', type=int, default=10)
+    parser_corr.add_argument('--no-legacy', dest='legacy', action='store_false',
+                             help="Skip the per-marker version, which is slow on large tables")
+
+    parser_tiles = subparsers.add_parser('tile_encoding', help="Compare tile encodings")
+    parser_tiles.add_argument('--image', help="OME-TIFF to take tiles from (default: synthetic)")
+    parser_tiles.add_argument('--channels', type=int, nargs='+', default=[0])
+    parser_tiles.add_argument('--level', type=int, default=0)
+    parser_tiles.add_argument('--tiles', type=int, default=8, help="tiles per channel")
+    parser_tiles.add_argument('--tile-size', type=int, default=1024)
+    parser_tiles.add_argument('--encodings', nargs='+', choices=tile_encoding.ENCODINGS)
+
+    args = parser.parse_args()
+    if args.benchmark == 'spatial_index':
+        points = load_points(args.csv, args.x, args.y, args.points)
+        benchmark_spatial_index(points, args.radii, args.queries, args.backends)
+    elif args.benchmark == 'spatial_corr':
+        if args.csv is not None:
+            frame = pd.read_csv(args.csv)
+            frame['id'] = frame.index
+            channels = args.channels
+        else:
+            frame = synthetic_cells(args.points, args.markers)
+            channels = [c for c in frame.columns if c.startswith('marker_')]
+        benchmark_spatial_corr(frame, channels, args.k, args.legacy)
+    elif args.benchmark == 'tile_encoding':
+        tiles = load_tiles(args.image, args.channels, args.level, args.tiles, args.tile_size)
+        benchmark_tile_encoding(tiles, args.encodings)
+
+
+if __name__ == '__main__':
+    main()
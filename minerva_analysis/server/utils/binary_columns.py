@@ -0,0 +1,83 @@
+# Binary columnar encoding of a DataFrame for cell-set responses.
+#
+# Layout (all little-endian):
+#   uint32  length of the JSON header in bytes
+#   bytes   JSON header, padded with spaces to a multiple of 8 bytes
+#   bytes   column buffers, each starting at a multiple of 8 bytes
+#
+# The header is {"rows": n, "columns": [{"name", "dtype", "offset", "length"}, ...]}
+# with offsets relative to the start of the buffer section. dtypes are the ones
+# with a matching JavaScript typed array (int8 .. uint32, float32, float64), so
+# a client can wrap every column without copying, e.g.
+# new Float32Array(buffer, bodyStart + column.offset, rows). String columns are
+# dictionary encoded: the buffer holds int32 codes and the column entry carries
+# the "categories" (-1 for missing values).
+
+import json
+import struct
+
+import numpy as np
+import pandas as pd
+
+MIMETYPE = 'application/vnd.minerva.columns'
+ALIGNMENT = 8
+TYPED_ARRAY_DTYPES = ['int8', 'uint8', 'int16', 'uint16', 'int32', 'uint32', 'float32', 'float64']
+
+
+def pad(length):
+    return -length % ALIGNMENT
+
+
+def column_values(values):
+    """
+    Converts a column to an array with a typed array dtype plus optional categories.
+    """
+    if values.dtype.kind in 'biuf':
+        array = values.to_numpy()
+        if array.dtype.name in TYPED_ARRAY_DTYPES:
+            return array, None
+        if array.dtype.kind == 'b':
+            return array.astype(np.uint8), None
+        if array.dtype.kind in 'iu' and len(array) > 0 and \
+                np.iinfo(np.int32).min <= array.min() and array.max() <= np.iinfo(np.int32).max:
+            return array.astype(np.int32), None
+        return array.astype(np.float64), None
+    categorical = pd.Categorical(values)
+    return categorical.codes.astype(np.int32), [str(c) for c in categorical.categories]
+
+
+def encode(frame):
+    columns = []
+    buffers = []
+    offset = 0
+    for name in frame.columns:
+        array, categories = column_values(frame[name])
+        data = np.ascontiguousarray(array).astype(array.dtype.newbyteorder('<'), copy=False).tobytes()
+        column = {'name': str(name), 'dtype': array.dtype.name, 'offset': offset, 'length': len(data)}
+        if categories is not None:
+            column['categories'] = categories
+        columns.append(column)
+        buffers.append(data + b'\x00' * pad(len(data)))
+        offset += len(data) + pad(len(data))
+    header = json.dumps({'rows': len(frame), 'columns': columns}).encode('utf-8')
+    # The 4 byte length prefix is part of the alignment of the buffer section
+    header += b' ' * pad(len(header) + 4)
+    return b''.join([struct.pack('<I', len(header)), header] + buffers)
+
+
+def decode(data):
+    """
+    Inverse of encode, mainly for tests and Python clients. Columns are read-only
+    views into data.
+    """
+    (header_length,) = struct.unpack_from('<I', data, 0)
+    header = json.loads(bytes(data[4:4 + header_length]).decode('utf-8'))
+    body = 4 + header_length
+    result = {}
+    for column in header['columns']:
+        values = np.frombuffer(data, dtype=np.dtype(column['dtype']).newbyteorder('<'), count=header['rows'],
+                               offset=body + column['offset'])
+        if 'categories' in column:
+            values = pd.Categorical.from_codes(values, column['categories'])
+        result[column['name']] = values
+    return pd.DataFrame(result, columns=[column['name'] for column in header['columns']])
@@ -12,6 +12,8 @@ import itertools
 import uuid
 import multiprocessing
 import concurrent.futures
+import collections
+import time
 import numpy as np
 import tifffile
 import zarr
@@ -26,16 +28,114 @@ except ImportError:
     from skimage.util.dtype import convert as dtype_convert
 
 
-def preduce(coords, img_in, img_out, is_mask):
-    (iy1, ix1), (iy2, ix2) = coords
-    (oy1, ox1), (oy2, ox2) = np.array(coords) // 2
+# Default memory ceiling in MB, see memory_plan
+DEFAULT_MAX_MEMORY = 1024
+
+
+def memory_plan(max_memory, num_workers, tile_size, itemsize, width):
+    """
+    Splits a memory ceiling (bytes) into worker processes, tiles in flight and
+    whether input images are read in bands of full rows. Each worker holds the
+    2x2 tile input region as read and as float32, each tile in flight one output
+    tile, and a band tile_size rows of the input. Returns (num_workers, window,
+    read_bands).
+    """
+    tile_bytes = tile_size * tile_size * itemsize
+    worker_bytes = 4 * tile_size * tile_size * (itemsize + 4) + tile_bytes
+    num_workers = int(max(1, min(num_workers, max_memory // 2 // worker_bytes)))
+    window = int(max(1, min(4 * num_workers, max_memory // 2 // tile_bytes)))
+    read_bands = tile_size * width * itemsize <= max_memory // 2
+    return num_workers, window, read_bands
+
+
+def input_tiles(path, tile_size, read_bands):
+    """
+    Yields the tiles of the first image of path in row-major order, padded to
+    tile_size. With read_bands, tile_size rows are read at once, so strips of
+    stripped TIFFs are decoded only once; otherwise single tiles are read.
+    """
+    with tifffile.TiffFile(path) as tiff:
+        img = zarr.open(tiff.series[0].aszarr(level=0), mode="r")
+        height, width = img.shape
+        for y in range(0, height, tile_size):
+            band = img[y:y + tile_size] if read_bands else None
+            for x in range(0, width, tile_size):
+                if band is not None:
+                    tile = band[:, x:x + tile_size]
+                else:
+                    tile = img[y:y + tile_size, x:x + tile_size]
+                if tile.dtype == np.int32:
+                    tile = tile.view('uint32')
+                if tile.shape != (tile_size, tile_size):
+                    tile = np.pad(tile, ((0, tile_size - tile.shape[0]), (0, tile_size - tile.shape[1])))
+                yield tile
+
+
+# Page of the output file read by a worker process, see read_page
+reader_state = {'key': None, 'tiff': None, 'image': None}
+
+
+def read_page(path, page):
+    """
+    The page of path as a zarr array, reopened whenever another page is needed
+    since the file grows while the pyramid is written.
+    """
+    if reader_state['key'] != (path, page):
+        if reader_state['tiff'] is not None:
+            reader_state['tiff'].close()
+        reader_state['tiff'] = tifffile.TiffFile(path)
+        reader_state['image'] = zarr.open(reader_state['tiff'].aszarr(key=page), mode="r")
+        reader_state['key'] = (path, page)
+    return reader_state['image']
+
+
+def downsample(img, is_mask, dtype):
+    """
+    img at half resolution: every other pixel of masks, 2x2 means otherwise.
+    """
     if is_mask:
-        tile = img_in[iy1:iy2:2, ix1:ix2:2]
-    else:
-        tile = skimage.img_as_float32(img_in[iy1:iy2, ix1:ix2])
-        tile = skimage.transform.downscale_local_mean(tile, (2, 2))
-        tile = dtype_convert(tile, img_out.dtype)
-    img_out[oy1:oy2, ox1:ox2] = tile
+        return img[::2, ::2]
+    img = skimage.img_as_float32(img)
+    img = skimage.transform.downscale_local_mean(img, (2, 2))
+    return dtype_convert(img, dtype)
+
+
+def preduce(path, page, origin, tile_size, is_mask, dtype):
+    """
+    Output tile at origin (y, x) of the level below page, padded to tile_size.
+    """
+    img_in = read_page(path, page)
+    oy, ox = origin
+    iy, ix = 2 * oy, 2 * ox
+    tile = downsample(img_in[iy:iy + 2 * tile_size, ix:ix + 2 * tile_size], is_mask, dtype)
+    if tile.shape != (tile_size, tile_size):
+        tile = np.pad(tile, ((0, tile_size - tile.shape[0]), (0, tile_size - tile.shape[1])))
+    return tile
+
+
+def reduce_level(executor, path, first_page, num_channels, shape_out, tile_size, is_mask, dtype, window):
+    """
+    Yields the output tiles of all channels of the next level in file order.
+    Tiles of all channels are computed by the executor, at most window ahead of
+    the writer, so no plane is held in memory.
+    """
+    tasks = iter([
+        (first_page + c, (y, x)) for c in range(num_channels)
+        for y in range(0, shape_out[0], tile_size) for x in range(0, shape_out[1], tile_size)
+    ])
+    futures = collections.deque()
+
+    def submit_next():
+        task = next(tasks, None)
+        if task is not None:
+            futures.append(executor.submit(preduce, str(path), task[0], task[1], tile_size, is_mask, dtype))
+
+    for _ in range(window):
+        submit_next()
+    while len(futures) > 0:
+        future = futures.popleft()
+        submit_next()
+        yield future.result()
 
 
 def imsave(path, img, tile_size, **kwargs):
@@ -153,16 +253,22 @@ def main(py_args=None):
             "--mask", action="store_true", default=False,
             help="adjust processing for label mask or binary mask images (currently just switch to nearest-neighbor downsampling)",
         )
+        parser.add_argument(
+            "--max-memory", metavar="MB", type=int, default=DEFAULT_MAX_MEMORY,
+            help=f"approximate memory ceiling in MB; default is {DEFAULT_MAX_MEMORY}",
+        )
         args = parser.parse_args()
         in_paths = args.in_paths
         out_path = args.out_path
         is_mask = args.mask
         pixel_size = args.pixel_size
+        max_memory = args.max_memory
     else:
         in_paths = py_args['in_paths']
         out_path = py_args['out_path']
         is_mask = py_args['is_mask']
         pixel_size = 1
+        max_memory = py_args.get('max_memory', DEFAULT_MAX_MEMORY)
     if out_path.exists():
         error(out_path, "Output file already exists, aborting.")
 
@@ -170,16 +276,20 @@ def main(py_args=None):
         num_workers = len(os.sched_getaffinity(0))
     else:
         num_workers = multiprocessing.cpu_count()
-    print(f"Using {num_workers} worker threads based on detected CPU count.")
+    print(f"Using {num_workers} worker processes based on detected CPU count.")
     print()
 
+    start = time.perf_counter()
     print("Appending input images")
     for i, path in enumerate(in_paths):
         print(f"    {i + 1}: {path}")
-        img_in = tifffile.imread(path)
+        with tifffile.TiffFile(path) as tiff:
+            img_in = zarr.open(tiff.series[0].aszarr(level=0), mode="r")
+            img_shape = img_in.shape
+            img_dtype = img_in.dtype
         if i == 0:
-            base_shape = img_in.shape
-            dtype = img_in.dtype
+            base_shape = img_shape
+            dtype = img_dtype
             if dtype == np.uint32:
                 if not is_mask:
                     error(
@@ -190,7 +300,6 @@ def main(py_args=None):
                     )
                 ome_dtype = 'uint32'
             elif dtype == np.int32:
-                img_in = img_in.view('uint32')
                 dtype = np.uint32
                 ome_dtype = 'uint32'
             elif dtype == np.uint16:
@@ -207,22 +316,27 @@ def main(py_args=None):
                 'description': '!!xml!!',
                 'software': 'Glencoe/Faas pyramid'
             }
+            num_workers, window, read_bands = memory_plan(
+                max_memory * 1024 ** 2, num_workers, tile_size, np.dtype(dtype).itemsize, base_shape[1]
+            )
+            print(f"    Memory ceiling {max_memory} MB: {num_workers} workers, {window} tiles in flight,"
+                  f" reading {'bands' if read_bands else 'tiles'}")
         else:
-            if img_in.shape != base_shape:
+            if img_shape != base_shape:
                 error(
                     path,
                     f"Expected shape {base_shape} to match first input image,"
-                    f" got {img_in.shape} instead."
+                    f" got {img_shape} instead."
                 )
-            if img_in.dtype != dtype:
+            if img_dtype != dtype and not (img_dtype == np.int32 and dtype == np.uint32):
                 error(
                     path,
                     f"Expected dtype '{dtype}' to match first input image,"
-                    f" got '{img_in.dtype}' instead."
+                    f" got '{img_dtype}' instead."
                 )
             kwargs = {}
-        imsave(out_path, img_in, tile_size, **kwargs)
-        del img_in
+        imsave(out_path, input_tiles(path, tile_size, read_bands), tile_size, shape=tuple(base_shape), dtype=dtype,
+               **kwargs)
     print()
 
     num_channels = len(in_paths)
@@ -238,7 +352,11 @@ def main(py_args=None):
         print()
     print()
 
-    executor = concurrent.futures.ThreadPoolExecutor(num_workers)
+    base_megapixels = num_channels * np.prod(base_shape) / 1e6
+    print(f"Input images appended, {base_megapixels / (time.perf_counter() - start):.1f} megapixels/s")
+    print()
+
+    executor = concurrent.futures.ProcessPoolExecutor(num_workers)
 
     shape_pairs = zip(shapes[:-1], shapes[1:])
     for level, (shape_in, shape_out) in enumerate(shape_pairs):
@@ -246,35 +364,33 @@ def main(py_args=None):
         print("Resizing channels for level {} ({} -> {})".format(
             level + 2, format_shape(shape_in), format_shape(shape_out)
         ))
-
-        ty = np.array(range(0, shape_in[0], tile_size))
-        tx = np.array(range(0, shape_in[1], tile_size))
-        coords = list(zip(
-            itertools.product(ty, tx),
-            itertools.product(ty + tile_size, tx + tile_size)
-        ))
-        img_out = np.empty(shape_out, dtype)
+        level_start = time.perf_counter()
+        num_tiles = len(range(0, shape_out[0], tile_size)) * len(range(0, shape_out[1], tile_size))
+        tiles = reduce_level(executor, out_path, level * num_channels, num_channels, shape_out, tile_size, is_mask,
+                             dtype, window)
 
         for c in range(num_channels):
 
-            tiff = tifffile.TiffFile(out_path)
-            page = level * num_channels + c
-            img_in = zarr.open(tiff.aszarr(key=page), mode="r")
-            for i, _ in enumerate(executor.map(
-                    preduce, coords,
-                    itertools.repeat(img_in), itertools.repeat(img_out),
-                    itertools.repeat(is_mask)
-            )):
-                percent = int((i + 1) / len(coords) * 100)
-                if i % 20 == 0 or percent == 100:
-                    print(f"\r    {c + 1}: {percent}%", end="")
-                    sys.stdout.flush()
-            tiff.close()
-            imsave(out_path, img_out, tile_size)
+            def channel_tiles():
+                for i, tile in enumerate(itertools.islice(tiles, num_tiles)):
+                    percent = int((i + 1) / num_tiles * 100)
+                    if i % 20 == 0 or percent == 100:
+                        print(f"\r    {c + 1}: {percent}%", end="")
+                        sys.stdout.flush()
+                    yield tile
+
+            imsave(out_path, channel_tiles(), tile_size, shape=tuple(shape_out), dtype=dtype)
             print()
 
+        level_megapixels = num_channels * np.prod(shape_in) / 1e6
+        print(f"    {level_megapixels / (time.perf_counter() - level_start):.1f} megapixels/s")
         print()
 
+    executor.shutdown()
+    total_megapixels = base_megapixels * sum(np.prod(shape) for shape in shapes) / np.prod(base_shape)
+    print(f"Pyramid written, {total_megapixels:.0f} megapixels at"
+          f" {total_megapixels / (time.perf_counter() - start):.1f} megapixels/s")
+
     xml = construct_xml(
         os.path.basename(out_path), shapes, num_channels, ome_dtype, pixel_size
     )
@@ -0,0 +1,124 @@
+# Encodings of image tiles, selected per request with ?encoding=<name>.
+#
+#   png       PNG without compression (the default, decodes fastest)
+#   png_fast  PNG with zlib level 1, much smaller at a small encode cost
+#   npy       the raw little-endian array (uint16 for channels) in a .npy container,
+#             whose header carries dtype and shape
+#   npy_lz4   npy bytes compressed by numcodecs LZ4 (4 byte little-endian size + LZ4 block)
+#   npy_zstd  npy bytes as a zstd frame
+#   webp      lossless WebP, for RGBA segmentation tiles only
+#
+# The compressed npy encodings depend on the numcodecs build and are only
+# offered if their codec is available. Segmentation tiles are RGBA in the image
+# encodings and the uint32 cell labels in the npy encodings (see label_tiles).
+#
+# Several encoded tiles (e.g. the channels of one tile position) are sent as one
+# batch (all little-endian):
+#   uint32  length of the JSON header in bytes
+#   bytes   JSON header {"tiles": [{"channel", "encoding", "mimetype", "offset", "length"}, ...]},
+#           padded with spaces so the payloads start at a multiple of 8 bytes
+#   bytes   the encoded tiles, each starting at a multiple of 8 bytes, offsets
+#           relative to the start of the payload section
+
+import io
+import json
+import struct
+
+import numpy as np
+from PIL import Image
+
+try:
+    from numcodecs import LZ4
+except ImportError:
+    LZ4 = None
+try:
+    from numcodecs import Zstd
+except ImportError:
+    Zstd = None
+
+DEFAULT_ENCODING = 'png'
+# Encodings usable for RGBA segmentation tiles only, with the fallback for other tiles
+RGBA_ENCODINGS = {'webp': 'png_fast'}
+MIMETYPES = {
+    'png': 'image/png',
+    'png_fast': 'image/png',
+    'npy': 'application/octet-stream',
+    'webp': 'image/webp'
+}
+if LZ4 is not None:
+    MIMETYPES['npy_lz4'] = 'application/octet-stream'
+if Zstd is not None:
+    MIMETYPES['npy_zstd'] = 'application/octet-stream'
+ENCODINGS = list(MIMETYPES)
+BATCH_MIMETYPE = 'application/vnd.minerva.tiles'
+ALIGNMENT = 8
+
+
+def resolve(encoding, rgba):
+    """
+    The encoding actually used for a tile, or None for an unknown encoding.
+    """
+    encoding = encoding or DEFAULT_ENCODING
+    if encoding not in MIMETYPES:
+        return None
+    if not rgba and encoding in RGBA_ENCODINGS:
+        return RGBA_ENCODINGS[encoding]
+    return encoding
+
+
+def to_npy(tile):
+    file_object = io.BytesIO()
+    tile = np.ascontiguousarray(tile)
+    np.save(file_object, tile.astype(tile.dtype.newbyteorder('<'), copy=False), allow_pickle=False)
+    return file_object.getvalue()
+
+
+def encode(tile, encoding):
+    if encoding == 'png' or encoding == 'png_fast':
+        file_object = io.BytesIO()
+        Image.fromarray(tile).save(file_object, 'PNG', compress_level=0 if encoding == 'png' else 1)
+        return file_object.getvalue()
+    if encoding == 'npy':
+        return to_npy(tile)
+    if encoding == 'npy_lz4':
+        return bytes(LZ4(acceleration=1).encode(to_npy(tile)))
+    if encoding == 'npy_zstd':
+        return bytes(Zstd(level=1).encode(to_npy(tile)))
+    if encoding == 'webp':
+        file_object = io.BytesIO()
+        # exact keeps the label colors of the (fully transparent) segmentation pixels
+        Image.fromarray(tile).save(file_object, 'WEBP', lossless=True, quality=0, method=0, exact=True)
+        return file_object.getvalue()
+    raise ValueError('Unknown tile encoding ' + str(encoding))
+
+
+def pad(length):
+    return -length % ALIGNMENT
+
+
+def encode_batch(channels, encodings, payloads):
+    tiles = []
+    buffers = []
+    offset = 0
+    for channel, encoding, data in zip(channels, encodings, payloads):
+        tiles.append({'channel': channel, 'encoding': encoding, 'mimetype': MIMETYPES[encoding], 'offset': offset,
+                      'length': len(data)})
+        buffers.append(data + b'\x00' * pad(len(data)))
+        offset += len(data) + pad(len(data))
+    header = json.dumps({'tiles': tiles}).encode('utf-8')
+    header += b' ' * pad(len(header) + 4)
+    return b''.join([struct.pack('<I', len(header)), header] + buffers)
+
+
+def decode_batch(data):
+    """
+    Inverse of encode_batch, returns {channel: (encoding, encoded tile)}.
+    """
+    (header_length,) = struct.unpack_from('<I', data, 0)
+    header = json.loads(bytes(data[4:4 + header_length]).decode('utf-8'))
+    body = 4 + header_length
+    result = {}
+    for tile in header['tiles']:
+        start = body + tile['offset']
+        result[tile['channel']] = (tile['encoding'], bytes(data[start:start + tile['length']]))
+    return result
@@ -0,0 +1,189 @@
+# Conversion of (OME-)TIFF images to chunked multiscale zarr stores (OME-NGFF 0.4).
+#
+# Channel images and segmentation masks are written as a zarr group with one array
+# per pyramid level ("0" is the full resolution, each further level halves both
+# sides) and the OME-NGFF "multiscales" attribute. Chunks are single channel
+# tiles of tile_size x tile_size pixels, the tile size stored as tileWidth and
+# tileHeight in the config, so every tile request reads and decompresses exactly
+# one chunk. Chunks are compressed with Blosc/zstd. The OME-XML of the source image,
+# if any, is kept in OME/METADATA.ome.xml as in the bioformats2raw layout.
+#
+#   store.zarr/.zattrs               {"multiscales": [...]}
+#   store.zarr/0, 1, ...             (c, y, x) for channels, (y, x) for masks
+#   store.zarr/OME/METADATA.ome.xml  the source OME-XML
+
+import argparse
+import pathlib
+import time
+
+import numpy as np
+import tifffile
+import zarr
+from numcodecs import Blosc
+
+from minerva_analysis.server.utils import pyramid_assemble
+
+DEFAULT_TILE_SIZE = 1024
+METADATA_KEY = 'OME/METADATA.ome.xml'
+
+
+def get_compressor():
+    return Blosc(cname='zstd', clevel=5, shuffle=Blosc.BITSHUFFLE)
+
+
+def is_multiscale(path):
+    """
+    Whether path is a zarr group written by assemble (or another OME-NGFF writer).
+    """
+    try:
+        return 'multiscales' in zarr.open_group(str(path), mode='r').attrs
+    except (ValueError, KeyError, zarr.errors.GroupNotFoundError):
+        return False
+
+
+def read_metadata(path):
+    """
+    The OME-XML of the source image of a store, None if it had none.
+    """
+    store = zarr.DirectoryStore(str(path))
+    if METADATA_KEY not in store:
+        return None
+    return store[METADATA_KEY].decode('utf-8')
+
+
+def get_shapes(base_shape, tile_size):
+    """
+    (height, width) of every level, down to the first one fitting in one tile.
+    """
+    shapes = [tuple(base_shape)]
+    while max(shapes[-1]) > tile_size:
+        shapes.append(tuple(-(-size // 2) for size in shapes[-1]))
+    return shapes
+
+
+def get_multiscales(name, num_levels, is_mask):
+    if is_mask:
+        axes = [{'name': 'y', 'type': 'space'}, {'name': 'x', 'type': 'space'}]
+    else:
+        axes = [{'name': 'c', 'type': 'channel'}, {'name': 'y', 'type': 'space'}, {'name': 'x', 'type': 'space'}]
+    datasets = []
+    for level in range(num_levels):
+        scale = [2 ** level, 2 ** level] if is_mask else [1, 2 ** level, 2 ** level]
+        datasets.append({'path': str(level), 'coordinateTransformations': [{'type': 'scale', 'scale': scale}]})
+    return [{
+        'version': '0.4',
+        'name': name,
+        'axes': axes,
+        'datasets': datasets,
+        'type': 'nearest' if is_mask else 'local_mean'
+    }]
+
+
+def copy_base(source, target, is_mask, band_height):
+    """
+    Copies the full resolution image in bands of band_height rows, each band
+    covers whole chunks of target so every chunk is written once.
+    """
+    height = target.shape[-2]
+    for c in range(1 if is_mask else target.shape[0]):
+        for y in range(0, height, band_height):
+            band = source[y:y + band_height] if source.ndim == 2 else source[c, y:y + band_height]
+            if band.dtype == np.int32:
+                band = band.view('uint32')
+            if is_mask:
+                target[y:y + band_height] = band
+            else:
+                target[c, y:y + band_height] = band
+            yield band.size
+
+
+def reduce_level(source, target, is_mask, band_height):
+    """
+    Writes target as source at half resolution, band_height target rows at once.
+    """
+    height = target.shape[-2]
+    for c in range(1 if is_mask else target.shape[0]):
+        for y in range(0, height, band_height):
+            # Only the source rows of this band are read from the store
+            rows = source[2 * y:2 * (y + band_height)] if is_mask else source[c, 2 * y:2 * (y + band_height)]
+            band = pyramid_assemble.downsample(rows, is_mask, target.dtype)
+            if is_mask:
+                target[y:y + band_height] = band
+            else:
+                target[c, y:y + band_height] = band
+            yield 4 * band.size
+
+
+def assemble(in_path, out_path, is_mask=False, tile_size=DEFAULT_TILE_SIZE, max_memory=None):
+    """
+    Writes the first image series of the TIFF at in_path as a multiscale zarr
+    store at out_path. Levels are written in bands of whole chunk rows, a band
+    is limited to about max_memory bytes (a single chunk row if it does not
+    fit). Returns a summary with the level count, shape and tile size.
+    """
+    if max_memory is None:
+        max_memory = pyramid_assemble.DEFAULT_MAX_MEMORY * 1024 ** 2
+    out_path = pathlib.Path(out_path)
+    if out_path.exists():
+        raise FileExistsError('{} already exists'.format(out_path))
+    start = time.perf_counter()
+    with tifffile.TiffFile(str(in_path), is_ome=False) as tiff:
+        description = tiff.pages[0].description
+        if '<OME' not in description:
+            description = None
+        source = zarr.open(tiff.series[0].aszarr(level=0), mode='r')
+        dtype = np.dtype('uint32') if source.dtype == np.int32 else source.dtype
+        num_channels = 1 if is_mask or source.ndim == 2 else source.shape[0]
+        shapes = get_shapes(source.shape[-2:], tile_size)
+        # A band of chunk rows is reduced from one twice as high, which is also converted to float32
+        row_bytes = tile_size * shapes[0][1] * (3 * dtype.itemsize + 8)
+        band_height = tile_size * int(max(1, max_memory // row_bytes))
+
+        root = zarr.open_group(str(out_path), mode='w')
+        levels = []
+        for level, shape in enumerate(shapes):
+            levels.append(root.create_dataset(
+                str(level), shape=shape if is_mask else (num_channels,) + shape,
+                chunks=(tile_size, tile_size) if is_mask else (1, tile_size, tile_size),
+                dtype=dtype, compressor=get_compressor(), fill_value=0, dimension_separator='/'
+            ))
+        root.attrs['multiscales'] = get_multiscales(out_path.name, len(shapes), is_mask)
+        if description:
+            root.store[METADATA_KEY] = description.encode('utf-8')
+
+        print('Writing', out_path, 'with', len(shapes), 'levels of', tile_size, 'px tiles')
+        pixels = sum(copy_base(source, levels[0], is_mask, band_height))
+    for level in range(1, len(shapes)):
+        pixels += sum(reduce_level(levels[level - 1], levels[level], is_mask, band_height))
+        print('    level {}: {} x {}'.format(level + 1, shapes[level][1], shapes[level][0]))
+    print('Zarr pyramid written, {:.1f} megapixels/s'.format(pixels / 1e6 / (time.perf_counter() - start)))
+    return {
+        'maxLevel': len(shapes),
+        'height': shapes[0][0],
+        'width': shapes[0][1],
+        'num_channels': num_channels,
+        'tileHeight': tile_size,
+        'tileWidth': tile_size
+    }
+
+
+def main(py_args=None):
+    if py_args is None:
+        parser = argparse.ArgumentParser(description='Convert a TIFF image to a chunked multiscale zarr store.')
+        parser.add_argument('in_path', type=pathlib.Path, help='input TIFF or OME-TIFF')
+        parser.add_argument('out_path', type=pathlib.Path, help='output .zarr directory')
+        parser.add_argument('--mask', action='store_true', default=False,
+                            help='label mask (nearest-neighbor downsampling, a single 2D plane)')
+        parser.add_argument('--tile-size', type=int, default=DEFAULT_TILE_SIZE, help='chunk width and height')
+        parser.add_argument('--max-memory', metavar='MB', type=int, default=pyramid_assemble.DEFAULT_MAX_MEMORY,
+                            help='approximate memory ceiling in MB')
+        args = parser.parse_args()
+        py_args = {'in_path': args.in_path, 'out_path': args.out_path, 'is_mask': args.mask,
+                   'tile_size': args.tile_size, 'max_memory': args.max_memory}
+    return assemble(py_args['in_path'], py_args['out_path'], is_mask=py_args.get('is_mask', False),
+                    tile_size=py_args.get('tile_size', DEFAULT_TILE_SIZE),
+                    max_memory=py_args.get('max_memory', pyramid_assemble.DEFAULT_MAX_MEMORY) * 1024 ** 2)
+
+
+if __name__ == '__main__':
+    main()
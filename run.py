@@ -4,6 +4,8 @@ import multiprocessing
 import sys
 
 if __name__ == '__main__':
+    # Worker processes (e.g. the spatial correlation layer) in frozen builds
+    multiprocessing.freeze_support()
     #use port 8000 if no port is specified via command line argument
     port = 8000 if len(sys.argv) < 2 or not str.isdigit(sys.argv[1]) else sys.argv[1]
 
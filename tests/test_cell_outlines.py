@@ -0,0 +1,22 @@
+import numpy as np
+import tifffile
+
+from minerva_analysis.server.models import cell_outlines, data_model
+
+
+def test_layer_built_by_cli_is_loaded(tmp_path, monkeypatch):
+    labels = np.zeros((256, 256), dtype=np.uint32)
+    labels[20:60, 30:90] = 1
+    labels[100:180, 120:140] = 2
+    segmentation = tmp_path / 'mask.ome.tif'
+    tifffile.imwrite(str(segmentation), labels)
+
+    cell_outlines.main(['--labels', str(segmentation), '--out', str(tmp_path / 'slide' / cell_outlines.LAYER_DIRECTORY),
+                        '--workers', '1'])
+
+    monkeypatch.setattr(data_model, 'data_path', tmp_path)
+    monkeypatch.setattr(data_model, 'config', {'slide': {'segmentation': str(segmentation)}})
+    ds = data_model.LoadedDatasource('slide')
+    data_model.load_cell_outlines(ds)
+    assert ds.cell_outlines is not None
+    assert list(ds.cell_outlines['labels']) == [1, 2]
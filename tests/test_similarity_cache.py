@@ -0,0 +1,21 @@
+import numpy as np
+
+from minerva_analysis.server.models import similarity_cache
+
+
+def test_quantize_scales_by_dtype_range():
+    values = np.array([[0, 255, 256, 40000, 65535]], dtype=np.uint16)
+    assert similarity_cache.quantize(values).tolist() == [[0, 0, 1, 156, 255]]
+    # the same conversion whatever the maximum of the section
+    assert similarity_cache.quantize(values[:, :2]).tolist() == [[0, 0]]
+    signed = np.array([[-5, 0, 256, 32767]], dtype=np.int16)
+    assert similarity_cache.quantize(signed).tolist() == [[0, 0, 2, 255]]
+
+
+def test_combine_averages_quantized_channels():
+    first = np.array([[511, 40000, 65535]], dtype=np.uint16)
+    second = np.array([[767, 40000, 65535]], dtype=np.uint16)
+    combined = similarity_cache.combine([similarity_cache.quantize(first), similarity_cache.quantize(second)])
+    assert combined.dtype == np.uint8
+    # floor(mean(v >> 8)): the mean of the raw values, 639, would give 2
+    assert combined.tolist() == [[1, 156, 255]]